@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+MarkdownReader 的基准测试.
+
+对比重写前的实现 (LegacyMarkdownReader, 逐行 += 拼接, O(n^2) 合并子节点) 与当前实现:
+(1)输出的 Document 逐个比较 text, metadata, hash, 必须完全一致.
+(2)解析耗时: load_data 全部文件.
+(3)内存: tracemalloc, 逐个文件解析并保留全部 Document. retained 为保留的 Document, transient 为解析单个文件时额外的峰值.
+
+document_dir 不存在时, 生成层级较深的模拟帮助中心文档.
+
+python3 markdown_reader_benchmark.py --document_dir ../../data/NXLink
+"""
+import argparse
+import os
+from pathlib import Path
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Optional, Tuple
+
+pwd = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(pwd, '../../'))
+
+from llama_index.schema import Document
+
+from project_settings import project_path
+from toolbox.llama_index.readers.file.markdown_reader import MarkdownReader
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--document_dir",
+        default=(project_path / "data/NXLink").as_posix(),
+        type=str
+    )
+    parser.add_argument("--synthetic_files", default=50, type=int)
+    parser.add_argument("--synthetic_sections", default=400, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+    return args
+
+
+class LegacyMarkdownReader(MarkdownReader):
+    """重写前的实现, 仅用于对比."""
+
+    def remove_images(self, content: str) -> str:
+        pattern = r"!{1}\[\[(.*)\]\]"
+        content = re.sub(pattern, "", content)
+        return content
+
+    def remove_hyperlinks(self, content: str) -> str:
+        pattern = r"\[(.*?)\]\((.*?)\)"
+        content = re.sub(pattern, r"\1", content)
+        return content
+
+    def markdown_to_tups(self, markdown_text: str) -> List[Tuple[Optional[int], Optional[str], str]]:
+        markdown_tups = []
+        lines = markdown_text.split("\n")
+
+        current_header_level = None
+        current_header = None
+        current_text = ""
+
+        for line in lines:
+            if len(str(line).strip()) == 0:
+                continue
+            header_match = re.match(r"^#+\s", line)
+            if header_match:
+                if current_header is not None:
+                    markdown_tups.append((current_header_level, current_header, current_text))
+
+                head_str = header_match.group().rstrip()
+                current_header_level = len(head_str)
+                current_header = line
+                current_text = ""
+            else:
+                current_text += line + "\n"
+        markdown_tups.append((current_header_level, current_header, current_text))
+        return markdown_tups
+
+    def load_data(self, file: Path, extra_info: Optional[Dict] = None) -> List[Document]:
+        extra_info = extra_info or dict()
+
+        tups = self.parse_tups(file)
+
+        doc_idx = 0
+        documents = list()
+        for header_level, header, text in tups:
+            metadata = {
+                "filename": file.as_posix(),
+                "doc_idx": doc_idx,
+                "header": header,
+                "header_level": header_level,
+            }
+            extra_info.update(metadata)
+
+            if header is not None:
+                text = f"{header}\n{text}"
+            document = Document(
+                text=text,
+                metadata=extra_info,
+                excluded_embed_metadata_keys=["filename", "doc_idx", "header_level"],
+                excluded_llm_metadata_keys=["filename", "doc_idx", "header_level"],
+            )
+            documents.append(document)
+            doc_idx += 1
+
+        l = len(documents)
+
+        text = "\n".join([d.text for d in documents])
+        metadata = {
+            "filename": file.as_posix(),
+            "doc_idx": -1,
+            "header": -1,
+            "header_level": -1,
+        }
+        extra_info.update(metadata)
+        document = Document(
+            text=text,
+            metadata=extra_info,
+            excluded_embed_metadata_keys=["filename", "doc_idx", "header_level"],
+            excluded_llm_metadata_keys=["filename", "doc_idx", "header_level"],
+        )
+
+        for i in range(l):
+            d1 = documents[i]
+            header_level1 = d1.metadata["header_level"]
+
+            child_docs = list()
+            for j in range(i + 1, l):
+                d2 = documents[j]
+                header_level2 = d2.metadata["header_level"]
+                if header_level2 <= header_level1:
+                    break
+                child_docs.append(d2)
+
+            child_docs = list(sorted(child_docs, key=lambda x: x.metadata["doc_idx"]))
+            text = "\n".join([d.text for d in [d1] + child_docs])
+            d1.text = text
+
+        result = [document] + documents
+        return result
+
+
+def make_synthetic_corpus(directory: Path, num_files: int, num_sections: int, seed: int):
+    """标题层级随机游走 (1 ~ 6), 模拟层级较深的帮助中心页面."""
+    rng = random.Random(seed)
+    for file_idx in range(num_files):
+        lines = ["帮助中心页面 {}".format(file_idx), ""]
+        level = 1
+        for section_idx in range(num_sections):
+            level = max(1, min(6, level + rng.choice([-2, -1, 0, 1, 1])))
+            lines.append("{} 第 {} 节 配置说明".format("#" * level, section_idx))
+            for _ in range(rng.randint(1, 8)):
+                lines.append("NXLink 支持 WhatsApp, Viber 等渠道, 详见 [文档](https://example.com/doc/{}).".format(section_idx))
+                if rng.random() < 0.3:
+                    lines.append("")
+        with open(directory / "page_{}.md".format(file_idx), "w", encoding="utf-8") as f:
+            f.write("\n".join(lines))
+
+
+def load_corpus(reader: MarkdownReader, filenames: List[Path]) -> List[Document]:
+    documents = list()
+    for filename in filenames:
+        documents.extend(reader.load_data(file=filename))
+    return documents
+
+
+def main():
+    args = get_args()
+
+    document_dir = Path(args.document_dir)
+    temp_directory = None
+    if not document_dir.exists():
+        temp_directory = tempfile.TemporaryDirectory()
+        document_dir = Path(temp_directory.name)
+        make_synthetic_corpus(document_dir, args.synthetic_files, args.synthetic_sections, args.seed)
+        print("document_dir not found, use synthetic corpus: {} files".format(args.synthetic_files))
+
+    filenames = sorted(document_dir.glob("**/*.md"))
+    total_bytes = sum(filename.stat().st_size for filename in filenames)
+    print("files: {}, bytes: {}".format(len(filenames), total_bytes))
+
+    legacy_documents = load_corpus(LegacyMarkdownReader(), filenames)
+    documents = load_corpus(MarkdownReader(), filenames)
+    if len(legacy_documents) != len(documents):
+        raise AssertionError("document count mismatch: {} != {}".format(len(legacy_documents), len(documents)))
+    for d1, d2 in zip(legacy_documents, documents):
+        if d1.text != d2.text or d1.metadata != d2.metadata or d1.hash != d2.hash:
+            raise AssertionError("document mismatch: {}".format(d1.metadata))
+    print("documents: {}, identical: True".format(len(documents)))
+    del legacy_documents, documents
+
+    for name, reader in [("legacy", LegacyMarkdownReader()), ("current", MarkdownReader())]:
+        begin = time.perf_counter()
+        load_corpus(reader, filenames)
+        cost = time.perf_counter() - begin
+
+        # transient: 解析单个文件时, 除已保留的 Document 之外额外占用的内存峰值.
+        tracemalloc.start()
+        documents = list()
+        transient = 0
+        for filename in filenames:
+            retained, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            documents.extend(reader.load_data(file=filename))
+            _, peak = tracemalloc.get_traced_memory()
+            transient = max(transient, peak - retained)
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del documents
+
+        print("{:8s} parse: {:.3f}s, retained: {:.1f}MB, max transient per file: {:.2f}MB".format(
+            name, cost, retained / 2**20, transient / 2**20
+        ))
+
+    if temp_directory is not None:
+        temp_directory.cleanup()
+    return
+
+
+if __name__ == '__main__':
+    main()
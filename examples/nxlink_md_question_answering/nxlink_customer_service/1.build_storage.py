@@ -4,6 +4,7 @@ import argparse
 import json
 import os
 from pathlib import Path
+import shutil
 
 from langchain.llms.openai import OpenAI
 from llama_index.embeddings.openai import OpenAIEmbedding
@@ -21,8 +22,13 @@ from tqdm import tqdm
 
 from project_settings import project_path
 import project_settings as settings
+from toolbox.llama_index.readers.file.markdown_corpus_loader import iter_markdown_files, list_markdown_files
 from toolbox.llama_index.readers.file.markdown_reader import MarkdownReader
-from toolbox.llama_index.indices.markdown_index.base import MarkDownIndex
+from toolbox.llama_index.indices.markdown_index.base import DEFAULT_SUMMARY_QUERY, MarkDownIndex
+from toolbox.llama_index.indices.markdown_index.summarizer import DocumentSummarizer
+from toolbox.llama_index.storage.build_manifest import BuildManifest, get_file_hash
+from toolbox.llama_index.storage.summary_checkpoint import SummaryCheckpoint
+from toolbox.llama_index.vector_stores.int8_vector_store import Int8VectorStore
 
 
 def get_args():
@@ -37,6 +43,11 @@ def get_args():
         default=(project_path / "cache/persist_dir").as_posix(),
         type=str
     )
+    parser.add_argument("--num_workers", default=None, type=int)
+    parser.add_argument("--summary_workers", default=8, type=int)
+    parser.add_argument("--requests_per_minute", default=None, type=float)
+    parser.add_argument("--tokens_per_minute", default=None, type=float)
+    parser.add_argument("--max_retries", default=5, type=int)
     parser.add_argument(
         "--openai_api_key",
         default=settings.environment.get("openai_api_key", default=None, dtype=str),
@@ -46,76 +57,165 @@ def get_args():
     return args
 
 
+def get_service_context(openai_api_key: str) -> ServiceContext:
+    service_context: ServiceContext = ServiceContext.from_defaults(
+        llm_predictor=LLMPredictor(
+            llm=OpenAI(
+                openai_api_key=openai_api_key
+            )
+        ),
+        embed_model=OpenAIEmbedding(api_key=openai_api_key),
+    )
+    return service_context
+
+
+def build_index(documents, persist_dir: str, service_context: ServiceContext, summarizer: DocumentSummarizer) -> MarkDownIndex:
+    if os.path.exists(persist_dir):
+        shutil.rmtree(persist_dir)
+
+    storage_context: StorageContext = StorageContext.from_defaults(vector_store=Int8VectorStore())
+    index: MarkDownIndex = MarkDownIndex.from_documents(
+        documents,
+        storage_context=storage_context,
+        service_context=service_context,
+        response_synthesizer=summarizer.response_synthesizer,
+        summarizer=summarizer,
+    )
+    index.storage_context.persist(persist_dir=persist_dir)
+    with open(os.path.join(persist_dir, "index_struct.json"), "w", encoding="utf-8") as f:
+        json.dump(index.index_struct.to_dict(), f)
+    return index
+
+
+def load_index(persist_dir: str, service_context: ServiceContext) -> MarkDownIndex:
+    with open(os.path.join(persist_dir, "index_struct.json"), "r", encoding="utf-8") as f:
+        json_str = f.read()
+    index_struct = MarkDownIndex.index_struct_cls.from_json(json_str)
+    storage_context: StorageContext = StorageContext.from_defaults(
+        persist_dir=persist_dir,
+        vector_store=Int8VectorStore.from_persist_dir(persist_dir),
+    )
+    index = MarkDownIndex(
+        index_struct=index_struct,
+        storage_context=storage_context,
+        service_context=service_context,
+    )
+    return index
+
+
 def main():
+    """
+    增量构建: build_manifest.json 记录每个 Markdown 文件的内容哈希与其索引的节点.
+    (1)只有新增与内容变化的文件重新解析, summary, embedding. 删除的文件同时删除其索引目录.
+    (2)未变化的文件直接从 persist_dir 加载.
+    (3)每个文件构建完成后立即保存清单, 中断后重新运行不会重复构建.
+    (4)有文件变化时重建 ComposableGraph 的根索引 (只对各索引的 summary 做 embedding).
+    (5)各 header 的 summary 并发执行, 限流并重试. 结果写入 summary_checkpoint.jsonl, 中断的文件重新构建时已完成的 summary 不再调用 LLM.
+    """
     args = get_args()
 
     reader = MarkdownReader()
 
     document_dir = Path(args.document_dir)
-
-    children_indices = list()
-    index_summaries = list()
-    custom_query_engines = dict()
-    for filename in tqdm(document_dir.glob("**/*.md")):
-        filename = Path(filename)
-        rel_filename = filename.relative_to(document_dir)
-        persist_dir = os.path.join(args.persist_dir, *rel_filename.parts[:-1], rel_filename.stem)
-
-        documents = reader.load_data(file=filename)
-        storage_context: StorageContext = StorageContext.from_defaults()
-        service_context: ServiceContext = ServiceContext.from_defaults(
-            llm_predictor=LLMPredictor(
-                llm=OpenAI(
-                    openai_api_key=args.openai_api_key
-                )
-            ),
-            embed_model=OpenAIEmbedding(api_key=args.openai_api_key),
-        )
-        response_synthesizer = TreeSummarize(
+    graph_persist_dir = os.path.join(args.persist_dir, "ComposableGraph")
+
+    manifest = BuildManifest(
+        manifest_file=os.path.join(args.persist_dir, "build_manifest.json"),
+        config={
+            "remove_hyperlinks": reader._remove_hyperlinks,
+            "remove_images": reader._remove_images,
+            "summary_query": DEFAULT_SUMMARY_QUERY,
+            "text_qa_template": DEFAULT_TEXT_QA_PROMPT.original_template,
+            "embed_model": "OpenAIEmbedding",
+            "vector_store": "Int8VectorStore",
+        }
+    )
+    filenames = {filename.relative_to(document_dir).as_posix(): filename for filename in list_markdown_files(document_dir)}
+    file_hashes = {key: get_file_hash(filename.as_posix()) for key, filename in filenames.items()}
+    added, changed, deleted, unchanged = manifest.diff(file_hashes)
+    print("added: {}, changed: {}, deleted: {}, unchanged: {}".format(len(added), len(changed), len(deleted), len(unchanged)))
+
+    def get_persist_dir(key: str) -> str:
+        rel_filename = Path(key)
+        return os.path.join(args.persist_dir, *rel_filename.parts[:-1], rel_filename.stem)
+
+    service_context = get_service_context(args.openai_api_key)
+    summarizer = DocumentSummarizer(
+        response_synthesizer=TreeSummarize(
             service_context=service_context,
             text_qa_template=DEFAULT_TEXT_QA_PROMPT,
             streaming=False,
-        )
-        index: MarkDownIndex = MarkDownIndex.from_documents(
-            documents,
-            storage_context=storage_context,
-            service_context=service_context,
-            response_synthesizer=response_synthesizer,
-        )
-        index.storage_context.persist(persist_dir=persist_dir)
-        with open(os.path.join(persist_dir, "index_struct.json"), "w", encoding="utf-8") as f:
-            json.dump(index.index_struct.to_dict(), f)
+        ),
+        summary_query=DEFAULT_SUMMARY_QUERY,
+        num_workers=args.summary_workers,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        max_retries=args.max_retries,
+        checkpoint=SummaryCheckpoint(
+            checkpoint_file=os.path.join(args.persist_dir, "summary_checkpoint.jsonl"),
+            namespace=manifest.config_hash,
+        ),
+    )
+
+    for key in deleted:
+        persist_dir = get_persist_dir(key)
+        if os.path.exists(persist_dir):
+            shutil.rmtree(persist_dir)
+        manifest.remove(key)
+        manifest.save()
+
+    indices = dict()
+    to_build = [filenames[key] for key in added + changed]
+    for filename, documents in tqdm(iter_markdown_files(document_dir, reader=reader, num_workers=args.num_workers, filenames=to_build)):
+        key = filename.relative_to(document_dir).as_posix()
+        index = build_index(documents, get_persist_dir(key), service_context, summarizer)
+        manifest.update(key, file_hashes[key], node_ids=list(index.index_struct.nodes_dict.values()))
+        manifest.save()
+        indices[key] = index
+
+    for key in unchanged:
+        indices[key] = load_index(get_persist_dir(key), service_context)
 
+    children_indices = list()
+    index_summaries = list()
+    custom_query_engines = dict()
+    for key in sorted(indices.keys()):
+        index = indices[key]
         children_indices.append(index)
         index_summaries.append(index.summary)
         custom_query_engines[index.index_id] = index.as_query_engine(similarity_top_k=1)
 
-    storage_context: StorageContext = StorageContext.from_defaults()
-    service_context: ServiceContext = ServiceContext.from_defaults(
-        llm_predictor=LLMPredictor(
-            llm=OpenAI(
-                openai_api_key=args.openai_api_key
-            )
-        ),
-        embed_model=OpenAIEmbedding(api_key=args.openai_api_key),
-    )
+    if len(added) + len(changed) + len(deleted) == 0 and os.path.exists(graph_persist_dir):
+        with open(os.path.join(graph_persist_dir, "index_struct.json"), "r", encoding="utf-8") as f:
+            json_str = f.read()
+        root_index = VectorStoreIndex(
+            index_struct=VectorStoreIndex.index_struct_cls.from_json(json_str),
+            service_context=service_context,
+            storage_context=StorageContext.from_defaults(persist_dir=graph_persist_dir),
+        )
+        graph = ComposableGraph(
+            all_indices={index.index_id: index for index in children_indices + [root_index]},
+            root_id=root_index.index_id,
+            storage_context=root_index.storage_context,
+        )
+    else:
+        # composable graph
+        graph = ComposableGraph.from_indices(
+            VectorStoreIndex,
+            children_indices=children_indices,
+            index_summaries=index_summaries,
+            service_context=service_context,
+            storage_context=StorageContext.from_defaults(),
+        )
 
-    # composable graph
-    graph = ComposableGraph.from_indices(
-        VectorStoreIndex,
-        children_indices=children_indices,
-        index_summaries=index_summaries,
-        service_context=service_context,
-        storage_context=storage_context,
-    )
+        # persist
+        if os.path.exists(graph_persist_dir):
+            shutil.rmtree(graph_persist_dir)
+        graph.root_index.storage_context.persist(persist_dir=graph_persist_dir)
+        with open(os.path.join(graph_persist_dir, "index_struct.json"), "w", encoding="utf-8") as f:
+            json.dump(graph.root_index.index_struct.to_dict(), f)
     custom_query_engines[graph.root_id] = graph.root_index.as_query_engine(similarity_top_k=1)
 
-    # persist
-    persist_dir = os.path.join(args.persist_dir, "ComposableGraph")
-    graph.root_index.storage_context.persist(persist_dir=persist_dir)
-    with open(os.path.join(persist_dir, "index_struct.json"), "w", encoding="utf-8") as f:
-        json.dump(graph.root_index.index_struct.to_dict(), f)
-
     query_engine = ComposableGraphQueryEngine(
         graph=graph,
         custom_query_engines=custom_query_engines,
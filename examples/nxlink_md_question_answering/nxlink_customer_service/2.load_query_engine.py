@@ -23,6 +23,7 @@ from project_settings import project_path
 import project_settings as settings
 from toolbox.llama_index.readers.file.markdown_reader import MarkdownReader
 from toolbox.llama_index.indices.markdown_index.base import MarkDownIndex
+from toolbox.llama_index.vector_stores.int8_vector_store import Int8VectorStore
 
 
 def get_args():
@@ -64,7 +65,10 @@ def main():
         with open(os.path.join(persist_dir, "index_struct.json"), "r", encoding="utf-8") as f:
             json_str = f.read()
         index_struct = MarkDownIndex.index_struct_cls.from_json(json_str)
-        storage_context: StorageContext = StorageContext.from_defaults(persist_dir=persist_dir)
+        storage_context: StorageContext = StorageContext.from_defaults(
+            persist_dir=persist_dir,
+            vector_store=Int8VectorStore.from_persist_dir(persist_dir),
+        )
         service_context: ServiceContext = ServiceContext.from_defaults(
             llm_predictor=LLMPredictor(
                 llm=OpenAI(
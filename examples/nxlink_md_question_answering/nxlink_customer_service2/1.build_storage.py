@@ -7,7 +7,6 @@ from pathlib import Path
 
 import chromadb
 from chromadb.api.models.Collection import Collection
-from chromadb.config import Settings
 from langchain.llms.openai import OpenAI
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.indices.composability.graph import ComposableGraph
@@ -25,8 +24,12 @@ from tqdm import tqdm
 
 from project_settings import project_path
 import project_settings as settings
+from toolbox.llama_index.readers.file.markdown_corpus_loader import iter_markdown_files, list_markdown_files
 from toolbox.llama_index.readers.file.markdown_reader import MarkdownReader
-from toolbox.llama_index.indices.markdown_index.base import MarkDownIndex
+from toolbox.llama_index.indices.markdown_index.base import DEFAULT_SUMMARY_QUERY, MarkDownIndex
+from toolbox.llama_index.indices.markdown_index.summarizer import DocumentSummarizer
+from toolbox.llama_index.storage.build_manifest import BuildManifest, get_file_hash
+from toolbox.llama_index.storage.summary_checkpoint import SummaryCheckpoint
 
 
 def get_args():
@@ -41,6 +44,11 @@ def get_args():
         default=(project_path / "cache/persist_dir/nxlink_customer_service2/").as_posix(),
         type=str
     )
+    parser.add_argument("--num_workers", default=None, type=int)
+    parser.add_argument("--summary_workers", default=8, type=int)
+    parser.add_argument("--requests_per_minute", default=None, type=float)
+    parser.add_argument("--tokens_per_minute", default=None, type=float)
+    parser.add_argument("--max_retries", default=5, type=int)
     parser.add_argument(
         "--openai_api_key",
         default=settings.environment.get("openai_api_key", default=None, dtype=str),
@@ -50,29 +58,54 @@ def get_args():
     return args
 
 
+def persist_index(index: MarkDownIndex, persist_dir: str):
+    index.storage_context.persist(persist_dir=persist_dir)
+    with open(os.path.join(persist_dir, "index_struct.json"), "w", encoding="utf-8") as f:
+        json.dump(index.index_struct.to_dict(), f)
+
+
 def main():
+    """
+    增量构建: build_manifest.json 记录每个 Markdown 文件的内容哈希与其索引的节点.
+    (1)所有文件共用一个 MarkDownIndex. 只有新增与内容变化的文件重新解析, summary, embedding, 用 update_file 替换其节点.
+    删除的文件用 delete_file 删除其节点.
+    (2)ChromaVectorStore 保存文本, store_nodes_override=True 使节点同时写入 index_struct 与 docstore, 才能按文件查找与删除节点.
+    (3)每个文件处理完成后立即保存索引与清单, 中断后重新运行不会重复构建.
+    (4)清单为空 (首次构建或构建配置变化) 时清空 chroma collection, 全部重建.
+    (5)各 header 的 summary 并发执行, 限流并重试. 结果写入 summary_checkpoint.jsonl.
+    """
     args = get_args()
 
-    # chroma
-    chroma_client = chromadb.Client(Settings(
-        persist_directory=args.persist_dir
-    ))
-    collection = chroma_client.create_collection(name="nxlink_customer_service2")
-
-    # data
     reader = MarkdownReader()
     document_dir = Path(args.document_dir)
 
-    documents = list()
-    for filename in tqdm(document_dir.glob("**/*.md")):
-        documents_ = reader.load_data(file=filename)
-        documents.extend(documents_)
-
-    storage_context: StorageContext = StorageContext.from_defaults(
-        vector_store=ChromaVectorStore(
-            chroma_collection=collection
-        )
+    manifest = BuildManifest(
+        manifest_file=os.path.join(args.persist_dir, "build_manifest.json"),
+        config={
+            "remove_hyperlinks": reader._remove_hyperlinks,
+            "remove_images": reader._remove_images,
+            "summary_query": DEFAULT_SUMMARY_QUERY,
+            "text_qa_template": DEFAULT_TEXT_QA_PROMPT.original_template,
+            "embed_model": "OpenAIEmbedding",
+            "vector_store": "ChromaVectorStore",
+        }
     )
+    index_struct_file = os.path.join(args.persist_dir, "index_struct.json")
+    rebuild = len(manifest.files) == 0 or not os.path.exists(index_struct_file)
+    if rebuild:
+        manifest.files = dict()
+
+    filenames = {filename.relative_to(document_dir).as_posix(): filename for filename in list_markdown_files(document_dir)}
+    file_hashes = {key: get_file_hash(filename.as_posix()) for key, filename in filenames.items()}
+    added, changed, deleted, unchanged = manifest.diff(file_hashes)
+    print("added: {}, changed: {}, deleted: {}, unchanged: {}".format(len(added), len(changed), len(deleted), len(unchanged)))
+
+    # chroma
+    chroma_client = chromadb.PersistentClient(path=args.persist_dir)
+    if rebuild and "nxlink_customer_service2" in [c.name for c in chroma_client.list_collections()]:
+        chroma_client.delete_collection(name="nxlink_customer_service2")
+    collection = chroma_client.get_or_create_collection(name="nxlink_customer_service2")
+
     service_context: ServiceContext = ServiceContext.from_defaults(
         llm_predictor=LLMPredictor(
             llm=OpenAI(
@@ -86,16 +119,59 @@ def main():
         text_qa_template=DEFAULT_TEXT_QA_PROMPT,
         streaming=False,
     )
-    index: MarkDownIndex = MarkDownIndex.from_documents(
-        documents,
-        storage_context=storage_context,
-        service_context=service_context,
+    summarizer = DocumentSummarizer(
         response_synthesizer=response_synthesizer,
+        summary_query=DEFAULT_SUMMARY_QUERY,
+        num_workers=args.summary_workers,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        max_retries=args.max_retries,
+        checkpoint=SummaryCheckpoint(
+            checkpoint_file=os.path.join(args.persist_dir, "summary_checkpoint.jsonl"),
+            namespace=manifest.config_hash,
+        ),
     )
-    index.storage_context.persist(persist_dir=args.persist_dir)
 
-    with open(os.path.join(args.persist_dir, "index_struct.json"), "w", encoding="utf-8") as f:
-        json.dump(index.index_struct.to_dict(), f)
+    vector_store = ChromaVectorStore(chroma_collection=collection)
+    if rebuild:
+        index = MarkDownIndex(
+            nodes=list(),
+            storage_context=StorageContext.from_defaults(vector_store=vector_store),
+            service_context=service_context,
+            store_nodes_override=True,
+            response_synthesizer=response_synthesizer,
+            summarizer=summarizer,
+        )
+    else:
+        with open(index_struct_file, "r", encoding="utf-8") as f:
+            json_str = f.read()
+        index = MarkDownIndex(
+            index_struct=MarkDownIndex.index_struct_cls.from_json(json_str),
+            storage_context=StorageContext.from_defaults(vector_store=vector_store, persist_dir=args.persist_dir),
+            service_context=service_context,
+            store_nodes_override=True,
+            response_synthesizer=response_synthesizer,
+            summarizer=summarizer,
+        )
+
+    for key in deleted:
+        index.delete_file((document_dir / key).as_posix())
+        persist_index(index, args.persist_dir)
+        manifest.remove(key)
+        manifest.save()
+
+    to_build = [filenames[key] for key in added + changed]
+    for filename, documents in tqdm(iter_markdown_files(document_dir, reader=reader, num_workers=args.num_workers, filenames=to_build)):
+        key = filename.relative_to(document_dir).as_posix()
+        index.update_file(filename.as_posix(), documents)
+        persist_index(index, args.persist_dir)
+
+        ref_doc_info = index.ref_doc_info
+        node_ids = [node_id for ref_doc_id in index.get_ref_doc_ids_by_filename(filename.as_posix())
+                    for node_id in ref_doc_info[ref_doc_id].node_ids]
+        manifest.update(key, file_hashes[key], node_ids=node_ids)
+        manifest.save()
+    print("summarizer stats: {}".format(summarizer.stats()))
 
     query_engine = index.as_query_engine()
 
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import logging
+import math
+import threading
+import time
+
+from flask import Response, request
+
+from toolbox.cache.lru_cache import LRUCache
+from toolbox.concurrency.token_bucket import TokenBucket
+
+logger = logging.getLogger('server')
+
+
+class AdmissionController(object):
+    """
+    准入控制.
+    (1)最多 max_in_flight 个请求同时处理.
+    (2)超出时最多 max_queue_size 个请求排队, 每个请求最多等待 queue_timeout 秒.
+    (3)队列已满或等待超时的请求被立即拒绝.
+    """
+    def __init__(self, max_in_flight: int, max_queue_size: int, queue_timeout: float, retry_after: float = 1):
+        self.max_in_flight = max_in_flight
+        self.max_queue_size = max_queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+
+        self._semaphore = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiting = 0
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def acquire(self) -> bool:
+        if not self._semaphore.acquire(blocking=False):
+            with self._lock:
+                if self._waiting >= self.max_queue_size:
+                    self.rejected += 1
+                    return False
+                self._waiting += 1
+            try:
+                acquired = self._semaphore.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+            if not acquired:
+                with self._lock:
+                    self.timeouts += 1
+                return False
+
+        with self._lock:
+            self._in_flight += 1
+            self.admitted += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_queue_size": self.max_queue_size,
+            "in_flight": self._in_flight,
+            "waiting": self._waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+        }
+
+
+class ClientRateLimiter(object):
+    """
+    按客户端的令牌桶限流. 最多保留 max_clients 个客户端的令牌桶, 超出时淘汰最久未访问的.
+    """
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+
+        self._buckets = LRUCache(max_size=max_clients)
+        self._lock = threading.Lock()
+
+        self.rejected = 0
+
+    def try_acquire(self, client_id: str):
+        """
+        :return: (ok, retry_after)
+        """
+        with self._lock:
+            bucket = self._buckets.get(client_id)
+            if bucket is None:
+                bucket = TokenBucket(rate=self.rate, capacity=self.burst)
+                self._buckets.set(client_id, bucket)
+
+        if bucket.try_acquire():
+            return True, 0.0
+
+        with self._lock:
+            self.rejected += 1
+        return False, bucket.time_until_available()
+
+    def stats(self) -> dict:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "clients": len(self._buckets),
+            "rejected": self.rejected,
+        }
+
+
+def get_client_id() -> str:
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    if forwarded_for:
+        return forwarded_for.split(',')[0].strip()
+    return request.remote_addr or 'unknown'
+
+
+def rejected_response(status_code: int, message: str, retry_after: float, http_status_code: int, begin: float):
+    retry_after = max(1, int(math.ceil(retry_after)))
+    response = {
+        'status_code': status_code,
+        'result': None,
+        'message': message,
+        'detail': None,
+        'time_cost': round(time.time() - begin, 4),
+    }
+    logger.info('response: {}'.format(response))
+    return response, http_status_code, {'Retry-After': str(retry_after)}
+
+
+def admission_route_wrap(admission_controller: AdmissionController = None,
+                         rate_limiter: ClientRateLimiter = None):
+    """
+    需放在 common_route_wrap 之外. 被拒绝的请求不进入 view func:
+    (1)客户端超过限流: status_code 60429, http 429.
+    (2)服务过载: status_code 60529, http 503. 与 60503 (LLM 不可用, 服务未就绪) 区分, 客户端可以稍后重试.
+    两者都带有 Retry-After 响应头.
+    """
+    def wrap(f):
+        def inner(*args, **kwargs):
+            begin = time.time()
+
+            if rate_limiter is not None:
+                ok, retry_after = rate_limiter.try_acquire(get_client_id())
+                if not ok:
+                    return rejected_response(60429, 'too many requests. ', retry_after, 429, begin)
+
+            if admission_controller is None:
+                return f(*args, **kwargs)
+
+            if not admission_controller.acquire():
+                return rejected_response(60529, 'server overloaded. ', admission_controller.retry_after, 503, begin)
+
+            try:
+                ret = f(*args, **kwargs)
+            except BaseException:
+                admission_controller.release()
+                raise
+
+            if isinstance(ret, Response) and ret.is_streamed:
+                # 流式响应在发送结束后释放.
+                ret.call_on_close(admission_controller.release)
+            else:
+                admission_controller.release()
+            return ret
+        return inner
+    return wrap
@@ -6,9 +6,21 @@ import jsonschema
 
 from server.exception import ExpectedError
 from toolbox.logging.misc import json_2_str
+from toolbox.metrics.prometheus import default_registry
 
 logger = logging.getLogger('server')
 
+http_requests_total = default_registry.counter(
+    'http_requests_total',
+    'requests by handler and status_code.',
+    ('handler', 'status_code'),
+)
+http_request_duration_seconds = default_registry.histogram(
+    'http_request_duration_seconds',
+    'request latency by handler.',
+    ('handler',),
+)
+
 
 result_schema = {
     'type': 'object',
@@ -66,6 +78,9 @@ def common_route_wrap(f):
         cost = time.time() - begin
         response['time_cost'] = round(cost, 4)
 
+        http_requests_total.inc(handler=f.__name__, status_code=response['status_code'])
+        http_request_duration_seconds.observe(cost, handler=f.__name__)
+
         abstract_response = json_2_str(response)
         if 'traceback' in response:
             abstract_response['traceback'] = response['traceback']
@@ -0,0 +1,9 @@
+# -*- encoding=UTF-8 -*-
+from flask import Response
+
+from toolbox.metrics.prometheus import default_registry
+
+
+def metrics():
+    """Prometheus text exposition format."""
+    return Response(default_registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
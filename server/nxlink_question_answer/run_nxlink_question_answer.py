@@ -1,23 +1,33 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
-import argparse
-import logging
 import os
 import sys
-from datetime import datetime, timedelta
 
 pwd = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(os.path.join(pwd, '../../'))
 
+# settings 只依赖 dotenv, 不导入网络相关的模块. 先加载 dotenv, 与其它配置一样读取 gevent_monkey_patch.
+from server.nxlink_question_answer import settings
+
+# gevent monkey patch 必须在其它模块导入之前执行, 使 Elasticsearch 与 OpenAI 的阻塞 IO 变为协程友好的.
+if settings.gevent_monkey_patch:
+    from gevent import monkey
+    monkey.patch_all()
+
+import argparse
+import logging
+from datetime import datetime, timedelta
+
 from flask import Flask
 from gevent import pywsgi
 
 from server import log
-from server.nxlink_question_answer import settings
 
 log.setup(log_directory=settings.log_directory)
 
 from server.flask_server.view_func.heart_beat import heart_beat
+from server.flask_server.view_func.metrics import metrics
+from server.nxlink_question_answer.service.nxlink_qa import warm_up
 from server.nxlink_question_answer.view_func import nxlink_qa
 
 logger = logging.getLogger('server')
@@ -31,8 +41,13 @@ flask_app = Flask(
 )
 
 flask_app.add_url_rule(rule="/HeartBeat", view_func=heart_beat, methods=["GET", "POST"], endpoint="HeartBeat")
+flask_app.add_url_rule(rule="/metrics", view_func=metrics, methods=["GET"], endpoint="Metrics")
 flask_app.add_url_rule(rule="/NXLinkQA", view_func=nxlink_qa.nxlink_qa_page, methods=["GET"], endpoint="NXLinkQAPage")
 flask_app.add_url_rule(rule="/NXLinkQA/query", view_func=nxlink_qa.query_view_func, methods=["POST"], endpoint="NXLinkQAQuery")
+flask_app.add_url_rule(rule="/NXLinkQA/query_stream", view_func=nxlink_qa.query_stream_view_func, methods=["POST"], endpoint="NXLinkQAQueryStream")
+flask_app.add_url_rule(rule="/NXLinkQA/batch_query", view_func=nxlink_qa.batch_query_view_func, methods=["POST"], endpoint="NXLinkQABatchQuery")
+flask_app.add_url_rule(rule="/NXLinkQA/ready", view_func=nxlink_qa.ready_view_func, methods=["GET"], endpoint="NXLinkQAReady")
+flask_app.add_url_rule(rule="/NXLinkQA/stats", view_func=nxlink_qa.stats_view_func, methods=["GET"], endpoint="NXLinkQAStats")
 
 # http://10.75.27.247:12023/NXLinkQA
 # http://127.0.0.1:12023/NXLinkQA
@@ -57,4 +72,8 @@ if __name__ == '__main__':
         listener=('0.0.0.0', args.port),
         application=flask_app
     )
+    if settings.warm_up_enable:
+        # 先监听端口, 再预热. 预热完成前 /NXLinkQA/ready 返回 503, 查询请求等待服务实例构建完成.
+        server.start()
+        warm_up()
     server.serve_forever()
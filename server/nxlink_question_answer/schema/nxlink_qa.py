@@ -13,5 +13,21 @@ nxlink_qa_request_schema = {
 }
 
 
+nxlink_qa_batch_request_schema = {
+    "type": "object",
+    "required": ["queries"],
+    "properties": {
+        "queries": {
+            "type": "array",
+            "items": {
+                "type": "string",
+            },
+            "minItems": 1,
+            "maxItems": 256,
+        },
+    }
+}
+
+
 if __name__ == '__main__':
     pass
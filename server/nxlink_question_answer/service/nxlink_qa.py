@@ -1,38 +1,329 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import hashlib
+import itertools
 import json
 import logging
 import os
-from typing import List
+import queue
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
 
-import elasticsearch as es
-from elasticsearch import Elasticsearch, helpers
-import jieba
-from langchain.chains.llm import LLMChain
-from langchain.llms import OpenAI, HuggingFaceHub
-from langchain.prompts import PromptTemplate
-from langchain.prompts.few_shot import FewShotPromptTemplate
+import numpy as np
 
+from server.exception import ExpectedError
 from server.nxlink_question_answer import settings
+from toolbox.cache.lru_cache import LRUCache
+from toolbox.cache.semantic_cache import SemanticCache
+from toolbox.concurrency.circuit_breaker import CircuitBreaker
+from toolbox.concurrency.executor import BlockingCallExecutor
+from toolbox.concurrency.single_flight import SingleFlight
+from toolbox.metrics.prometheus import default_registry
+from toolbox.metrics.span import Span
+from toolbox.retrieval.bm25 import BM25Index
+from toolbox.retrieval.dense import DenseIndex
+from toolbox.retrieval.embedding_store import Int8EmbeddingStore
+from toolbox.retrieval.ivf import IVFIndex
+from toolbox.retrieval.rank_fusion import reciprocal_rank_fusion
+from toolbox.text.normalization import normalize_text
+from toolbox.text.tokenizer import CachedTokenizer, JiebaTokenizer, mine_domain_words
 
 logger = logging.getLogger("server")
 
-example_prompt = PromptTemplate.from_template(settings.fap_example_prompt_str)
+# langchain, elasticsearch, jieba 导入耗时较长, 在首次使用时导入, 以缩短服务启动与命令行工具的导入时间.
+_example_prompt = None
+
+cache_requests_total = default_registry.counter(
+    "nxlink_qa_cache_requests_total",
+    "answer cache lookups by cache type and result (hit, miss).",
+    ("cache", "result"),
+)
+llm_requests_total = default_registry.counter(
+    "nxlink_qa_llm_requests_total",
+    "llm calls by result (success, timeout, error, circuit_open, cancelled).",
+    ("result",),
+)
+answers_total = default_registry.counter(
+    "nxlink_qa_answers_total",
+    "answers by answer_source.",
+    ("answer_source",),
+)
+llm_circuit_open = default_registry.gauge(
+    "nxlink_qa_llm_circuit_open",
+    "1 if the llm circuit breaker is not closed.",
+)
+tokenizer_cache_hit_rate = default_registry.gauge(
+    "nxlink_qa_tokenizer_cache_hit_rate",
+    "hit rate of the memoized tokenize and normalize calls.",
+    ("cache",),
+)
+single_flight_requests_total = default_registry.counter(
+    "nxlink_qa_single_flight_requests_total",
+    "cache-missed queries by single_flight role (leader, coalesced).",
+    ("role",),
+)
+executor_pending = default_registry.gauge(
+    "nxlink_qa_executor_pending",
+    "calls submitted but not completed, by executor.",
+    ("executor",),
+)
+
+
+def get_example_prompt():
+    global _example_prompt
+    if _example_prompt is None:
+        from langchain.prompts import PromptTemplate
+        _example_prompt = PromptTemplate.from_template(settings.fap_example_prompt_str)
+    return _example_prompt
 
 
 def get_faq_prompt_template(examples: List[dict]):
-    prompt = FewShotPromptTemplate(
-        example_prompt=example_prompt,
-        examples=examples,
-        prefix=settings.faq_prefix_prompt_str,
-        suffix=settings.faq_suffix_prompt_str,
-        example_separator="",
-        input_variables=["user_question"]
-    )
+    from langchain.prompts.few_shot import FewShotPromptTemplate
+
+    with Span("prompt"):
+        prompt = FewShotPromptTemplate(
+            example_prompt=get_example_prompt(),
+            examples=examples,
+            prefix=settings.faq_prefix_prompt_str,
+            suffix=settings.faq_suffix_prompt_str,
+            example_separator="",
+            input_variables=["user_question"]
+        )
     return prompt
 
 
-class NXLinkFAQElasticIndex(object):
+def iter_nxlink_faq(nxlink_faq_file: str):
+    with open(nxlink_faq_file, "r", encoding="utf-8") as f:
+        for row in f:
+            row = json.loads(row)
+            filename = row["filename"]
+            faq: List[dict] = row["faq"]
+
+            for qa in faq:
+                yield {
+                    "question": qa["standard_question"],
+                    "answer": qa["answer"],
+                    "filename": filename,
+                    "header": qa["section"],
+                    "product": "nxlink",
+                }
+
+
+def get_file_hash(filename: str) -> str:
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_domain_words(nxlink_faq_file: str, cache_directory: str = None, min_count: int = 2) -> List[str]:
+    """
+    从 FAQ 问题与 Markdown 标题中挖掘领域词. 结果按 FAQ 文件哈希缓存在 cache_directory 中.
+    """
+    base_tokenizer = JiebaTokenizer(cache_directory=cache_directory)
+
+    cache_file = None
+    if cache_directory:
+        cache_file = os.path.join(cache_directory, "domain_words_{}_{}_{}.txt".format(
+            get_file_hash(nxlink_faq_file)[:16], base_tokenizer.version, min_count
+        ))
+        if os.path.exists(cache_file):
+            with open(cache_file, "r", encoding="utf-8") as f:
+                return [line.strip() for line in f if len(line.strip()) != 0]
+
+    texts = list()
+    for row in iter_nxlink_faq(nxlink_faq_file):
+        texts.append(row["question"])
+        texts.append(re.sub(r"#+", " ", row["header"]))
+    words = mine_domain_words(texts, base_tokenizer.lcut, base_tokenizer.freq, min_count=min_count)
+    logger.info("mine domain words finish, words: {}".format(len(words)))
+
+    if cache_file is not None:
+        os.makedirs(cache_directory, exist_ok=True)
+        temp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+        with open(temp_file, "w", encoding="utf-8") as f:
+            for word in words:
+                f.write("{}\n".format(word))
+        os.replace(temp_file, cache_file)
+    return words
+
+
+_text_tokenizer: CachedTokenizer = None
+_text_tokenizer_lock = threading.Lock()
+
+
+def get_text_tokenizer() -> CachedTokenizer:
+    """
+    FAQ 入库, 检索, 精确匹配与答案缓存共用的分词器, 分词与归一化结果在 LRU 中记忆化.
+    词典为 jieba 默认词典, 加上从 FAQ 挖掘的领域词与 tokenizer_user_words_file 中的用户词.
+    首次构建后, 领域词表与前缀词典缓存在 tokenizer_cache_directory 中, 之后启动时直接加载.
+    """
+    global _text_tokenizer
+
+    if _text_tokenizer is not None:
+        return _text_tokenizer
+
+    with _text_tokenizer_lock:
+        if _text_tokenizer is not None:
+            return _text_tokenizer
+
+        user_words = list()
+        nxlink_faq_file = os.path.join(settings.nxlink_question_answer_dataset, settings.nxlink_faq_filename)
+        if settings.tokenizer_domain_words_enable and os.path.exists(nxlink_faq_file):
+            user_words.extend(get_domain_words(
+                nxlink_faq_file,
+                cache_directory=settings.tokenizer_cache_directory,
+                min_count=settings.tokenizer_domain_words_min_count,
+            ))
+        if settings.tokenizer_user_words_file:
+            with open(settings.tokenizer_user_words_file, "r", encoding="utf-8") as f:
+                user_words.extend([line.strip().lower() for line in f if len(line.strip()) != 0])
+
+        tokenizer = CachedTokenizer(
+            tokenizer=JiebaTokenizer(
+                user_words=user_words,
+                cache_directory=settings.tokenizer_cache_directory,
+            ),
+            max_size=settings.tokenizer_cache_max_size,
+        )
+        tokenizer.initialize()
+        for name in ["tokenize", "normalize"]:
+            tokenizer_cache_hit_rate.set_function(
+                lambda name=name: tokenizer.stats()[name]["hit_rate"],
+                cache=name,
+            )
+        _text_tokenizer = tokenizer
+    return _text_tokenizer
+
+
+def text_split(text: str) -> List[str]:
+    return get_text_tokenizer().tokenize(text)
+
+
+def text_split_uncached(text: str) -> List[str]:
+    """FAQ 入库时使用, 不写入 LRU, 以免挤掉高频 query."""
+    return get_text_tokenizer().tokenizer.lcut(text)
+
+
+def text_normalize(text: str) -> str:
+    return get_text_tokenizer().normalize(text)
+
+
+def is_gevent_patched() -> bool:
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+
+def iter_tokenized_nxlink_faq(nxlink_faq_file: str, num_workers: int = 1, batch_size: int = 2000):
+    """
+    流式读取 FAQ 并对 question 分词, 写入 question_preprocessed 字段.
+    num_workers > 1 时在进程池中分词, 当前 batch 被消费时下一个 batch 已在分词, 内存中最多保留两个 batch.
+    gevent monkey patch 之后 ProcessPoolExecutor 的管理线程是协程, fork 后可能死锁, 此时在当前进程分词.
+    """
+    if num_workers > 1 and is_gevent_patched():
+        logger.warning("gevent monkey patched, ignore faq_tokenize_num_workers: {}".format(num_workers))
+        num_workers = 1
+
+    rows_iter = iter_nxlink_faq(nxlink_faq_file)
+    if num_workers <= 1:
+        for row in rows_iter:
+            row["question_preprocessed"] = text_split_uncached(row["question"])
+            yield row
+        return
+
+    # 在 fork 子进程之前加载词典, 子进程直接继承.
+    get_text_tokenizer()
+
+    chunksize = max(1, batch_size // (num_workers * 4))
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        pending = None
+        while True:
+            batch = list(itertools.islice(rows_iter, batch_size))
+            tokens_iter = None
+            if len(batch) != 0:
+                tokens_iter = executor.map(text_split_uncached, [row["question"] for row in batch], chunksize=chunksize)
+
+            if pending is not None:
+                pending_batch, pending_tokens_iter = pending
+                for row, tokens in zip(pending_batch, pending_tokens_iter):
+                    row["question_preprocessed"] = tokens
+                    yield row
+
+            if len(batch) == 0:
+                break
+            pending = (batch, tokens_iter)
+
+
+def iter_tokenized_nxlink_faq_with_snapshot(nxlink_faq_file: str,
+                                            snapshot_directory: str = None,
+                                            num_workers: int = 1,
+                                            batch_size: int = 2000,
+                                            ):
+    """
+    带本地快照的 iter_tokenized_nxlink_faq.
+    (1)快照文件为 {snapshot_directory}/nxlink_faq_{FAQ 文件哈希}_{分词器版本}.jsonl, 每行是一个分词后的 row.
+    (2)快照存在时直接读取, 不再分词. 否则分词的同时写入临时文件, 完整读取后原子地重命名为快照文件.
+    (3)snapshot_directory 为 None 或空字符串时, 不使用快照.
+    """
+    if not snapshot_directory:
+        yield from iter_tokenized_nxlink_faq(nxlink_faq_file, num_workers=num_workers, batch_size=batch_size)
+        return
+
+    snapshot_file = os.path.join(
+        snapshot_directory,
+        "nxlink_faq_{}_{}.jsonl".format(get_file_hash(nxlink_faq_file)[:16], get_text_tokenizer().version)
+    )
+    if os.path.exists(snapshot_file):
+        logger.info("load tokenized faq from snapshot: {}".format(snapshot_file))
+        with open(snapshot_file, "r", encoding="utf-8") as f:
+            for row in f:
+                yield json.loads(row)
+        return
+
+    os.makedirs(snapshot_directory, exist_ok=True)
+    temp_file = "{}.{}.tmp".format(snapshot_file, os.getpid())
+    try:
+        with open(temp_file, "w", encoding="utf-8") as f:
+            for row in iter_tokenized_nxlink_faq(nxlink_faq_file, num_workers=num_workers, batch_size=batch_size):
+                f.write("{}\n".format(json.dumps(row, ensure_ascii=False)))
+                yield row
+        os.replace(temp_file, snapshot_file)
+        logger.info("save tokenized faq snapshot: {}".format(snapshot_file))
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+
+class NXLinkFAQIndex(object):
+    """
+    FAQ 检索后端接口.
+    query 返回 dict 列表, 包含 score, question, answer, filename, header, product 字段, 按 score 降序.
+    index_version 标识索引内容的版本, 索引重建后改变.
+    """
+    index_version: str = None
+
+    def text_split(self, text: str):
+        return text_split(text)
+
+    def doc_count(self) -> int:
+        raise NotImplementedError
+
+    def query(self, query: str, product: str = "nxlink") -> List[dict]:
+        raise NotImplementedError
+
+    def batch_query(self, queries: List[str], product: str = "nxlink") -> List[List[dict]]:
+        return [self.query(query, product) for query in queries]
+
+
+class NXLinkFAQElasticIndex(NXLinkFAQIndex):
 
     mapping = {
         "properties": {
@@ -61,20 +352,42 @@ class NXLinkFAQElasticIndex(object):
         }
     }
 
+    index_settings = {
+        "index": {
+            "max_result_window": 100000
+        }
+    }
+
     def __init__(self,
                  nxlink_faq_file: str,
                  elastic_host: str,
                  elastic_port: int,
                  elastic_index: str,
-                 elastic_query_top_k: int = 5
+                 elastic_query_top_k: int = 5,
+                 elastic_build_wait_timeout: float = 300,
+                 elastic_bulk_chunk_size: int = 500,
+                 elastic_bulk_thread_count: int = 4,
+                 tokenize_num_workers: int = 1,
+                 tokenize_batch_size: int = 2000,
+                 snapshot_directory: str = None,
                  ):
         self.nxlink_faq_file = nxlink_faq_file
         self.elastic_host = elastic_host
         self.elastic_port = elastic_port
         self.elastic_index = elastic_index
         self.elastic_query_top_k = elastic_query_top_k
+        self.elastic_build_wait_timeout = elastic_build_wait_timeout
+        self.elastic_bulk_chunk_size = elastic_bulk_chunk_size
+        self.elastic_bulk_thread_count = elastic_bulk_thread_count
+        self.tokenize_num_workers = tokenize_num_workers
+        self.tokenize_batch_size = tokenize_batch_size
+        self.snapshot_directory = snapshot_directory
+
+        self.index_version: str = None
+
+        from elasticsearch import Elasticsearch
 
-        self.es_client = es.Elasticsearch(
+        self.es_client = Elasticsearch(
             hosts=[self.elastic_host],
             port=self.elastic_port
         )
@@ -84,78 +397,127 @@ class NXLinkFAQElasticIndex(object):
 
         self._build_elastic_index()
 
+    def _compute_index_version(self) -> str:
+        """FAQ 文件内容, 分词词典与索引结构的哈希. 都不变时, 不需要重建索引."""
+        h = hashlib.sha256()
+        h.update(json.dumps(self.index_settings, sort_keys=True).encode("utf-8"))
+        h.update(json.dumps(self.mapping, sort_keys=True).encode("utf-8"))
+        h.update(get_file_hash(self.nxlink_faq_file).encode("utf-8"))
+        h.update(get_text_tokenizer().version.encode("utf-8"))
+        return h.hexdigest()[:16]
+
+    def _get_alias_indices(self) -> List[str]:
+        if not self.es_client.indices.exists_alias(name=self.elastic_index):
+            return list()
+        js = self.es_client.indices.get_alias(name=self.elastic_index)
+        return list(js.keys())
+
+    def _wait_for_alias(self, index: str, timeout: float) -> bool:
+        begin = time.time()
+        while time.time() - begin < timeout:
+            if index in self._get_alias_indices():
+                return True
+            time.sleep(1)
+        return False
+
     def _build_elastic_index(self):
-        logger.info("build_elastic_index start. ")
+        """
+        elastic_index 是别名, 实际数据在以内容哈希命名的物理索引中.
+        (1)别名已指向当前版本的物理索引时, 跳过构建.
+        (2)否则在旧索引旁边构建新索引, 之后通过 update_aliases 原子地切换别名, 再删除旧索引.
+        构建期间别名仍指向旧索引, 其它 worker 的查询不受影响.
+        """
+        self.index_version = self._compute_index_version()
+        index = "{}_{}".format(self.elastic_index, self.index_version)
+
+        old_indices = self._get_alias_indices()
+        if index in old_indices:
+            logger.info("build_elastic_index skip, index: {} is up to date. ".format(index))
+            return
 
-        if self.es_client.indices.exists(index=self.elastic_index):
-            self.es_client.indices.delete(index=self.elastic_index)
+        logger.info("build_elastic_index start, index: {}. ".format(index))
+
+        if self.es_client.indices.exists(index=index):
+            # 其它 worker 正在构建同一版本的索引. 等待其完成, 超时则认为是中断遗留的索引.
+            if self._wait_for_alias(index, timeout=self.elastic_build_wait_timeout):
+                logger.info("build_elastic_index skip, index: {} built by another worker. ".format(index))
+                return
+            self.es_client.indices.delete(index=index)
 
         # 设置索引最大数量据.
         body = {
-            "settings": {
-                "index": {
-                    "max_result_window": 100000
-                }
-            }
+            "settings": self.index_settings
         }
-        self.es_client.indices.create(index=self.elastic_index, body=body)
+        self.es_client.indices.create(index=index, body=body)
 
         # 设置文档结构
+        mapping = dict(self.mapping)
+        mapping["_meta"] = {"index_version": self.index_version}
         self.es_client.indices.put_mapping(
-            index=self.elastic_index,
+            index=index,
             doc_type='_doc',
-            body=self.mapping,
+            body=mapping,
             params={"include_type_name": "true"}
         )
 
-        # 写入新的数据
-        rows = list()
-        with open(self.nxlink_faq_file, "r", encoding="utf-8") as f:
-            for row in f:
-                row = json.loads(row)
-                filename = row["filename"]
-                faq: List[dict] = row["faq"]
+        # 写入期间关闭刷新
+        self.es_client.indices.put_settings(index=index, body={"index": {"refresh_interval": "-1"}})
 
-                for qa in faq:
-                    section = qa["section"]
-                    question = qa["standard_question"]
-                    answer = qa["answer"]
+        # 写入新的数据
+        from elasticsearch import helpers
 
-                    question_preprocessed = self.text_split(question)
+        begin = time.time()
+        count = 0
+        actions = (
+            {
+                '_op_type': 'index',
+                '_index': index,
+                '_source': row
+            } for row in iter_tokenized_nxlink_faq_with_snapshot(
+                self.nxlink_faq_file,
+                snapshot_directory=self.snapshot_directory,
+                num_workers=self.tokenize_num_workers,
+                batch_size=self.tokenize_batch_size,
+            )
+        )
+        for ok, info in helpers.parallel_bulk(
+                client=self.es_client,
+                actions=actions,
+                thread_count=self.elastic_bulk_thread_count,
+                chunk_size=self.elastic_bulk_chunk_size,
+        ):
+            count += 1
+        cost = time.time() - begin
+        logger.info("build_elastic_index bulk finish, docs: {}, cost: {:.2f}s, throughput: {:.1f} docs/s. ".format(
+            count, cost, count / cost if cost > 0 else 0.0
+        ))
 
-                    row = {
-                        "question": question,
-                        "question_preprocessed": question_preprocessed,
-                        "answer": answer,
-                        "filename": filename,
-                        "header": section,
-                        "product": "nxlink",
+        # 恢复刷新设置, 刷新数据
+        self.es_client.indices.put_settings(index=index, body={"index": {"refresh_interval": None}})
+        self.es_client.indices.refresh(index=index)
 
-                    }
-                    rows.append({
-                        '_op_type': 'index',
-                        '_index': self.elastic_index,
-                        '_source': row
-                    })
-            helpers.bulk(client=self.es_client, actions=rows)
+        # 切换别名
+        actions = list()
+        if self.es_client.indices.exists(index=self.elastic_index) and len(old_indices) == 0:
+            # 旧版本直接以 elastic_index 命名的物理索引.
+            actions.append({"remove_index": {"index": self.elastic_index}})
+        for old_index in old_indices:
+            actions.append({"remove": {"index": old_index, "alias": self.elastic_index}})
+        actions.append({"add": {"index": index, "alias": self.elastic_index}})
+        self.es_client.indices.update_aliases(body={"actions": actions})
 
-            # 刷新数据
-            self.es_client.indices.refresh(index=self.elastic_index)
+        for old_index in old_indices:
+            self.es_client.indices.delete(index=old_index, ignore_unavailable=True)
 
-        logger.info("build_elastic_index finish. ")
+        logger.info("build_elastic_index finish, index: {}, removed: {}. ".format(index, old_indices))
         return
 
-    def text_split(self, text: str):
-        text = str(text).lower()
-        tokens = jieba.lcut(text)
-        tokens = [token for token in tokens if not len(token.strip()) == 0]
-        return tokens
-
-    def query(self, query: str):
-        tokens = self.text_split(query)
+    def get_search_body(self, query: str, product: str = "nxlink") -> dict:
+        with Span("tokenize"):
+            tokens = self.text_split(query)
         query_preprocessed = " ".join(tokens)
 
-        query = {
+        body = {
             "query": {
                 "bool": {
                     "must": [{
@@ -164,17 +526,16 @@ class NXLinkFAQElasticIndex(object):
                         }
                     }],
                     "filter": [
-                        {"term": {"product": "nxlink"}},
+                        {"term": {"product": product}},
                     ]
                 },
             },
+            "size": self.elastic_query_top_k,
         }
-        js = self.es_client.search(
-            index=self.elastic_index,
-            size=self.elastic_query_top_k,
-            body=query
-        )
+        return body
 
+    @staticmethod
+    def parse_hits(js: dict) -> List[dict]:
         hits = js["hits"]["hits"]
 
         result = list()
@@ -183,7 +544,6 @@ class NXLinkFAQElasticIndex(object):
             source = hit['_source']
 
             question = source["question"]
-            question_preprocessed = source["question_preprocessed"]
             answer = source["answer"]
             filename = source["filename"]
             header = source["header"]
@@ -200,59 +560,1207 @@ class NXLinkFAQElasticIndex(object):
 
         return result
 
+    def doc_count(self) -> int:
+        js = self.es_client.count(index=self.elastic_index)
+        return js["count"]
+
+    def query(self, query: str, product: str = "nxlink"):
+        body = self.get_search_body(query, product)
+        with Span("es_search"):
+            js = self.es_client.search(
+                index=self.elastic_index,
+                body=body
+            )
+        return self.parse_hits(js)
+
+    def batch_query(self, queries: List[str], product: str = "nxlink") -> List[List[dict]]:
+        if len(queries) == 0:
+            return list()
+
+        body = list()
+        for query in queries:
+            body.append({"index": self.elastic_index})
+            body.append(self.get_search_body(query, product))
+        with Span("es_msearch"):
+            js = self.es_client.msearch(body=body)
+
+        result = list()
+        for response in js["responses"]:
+            if "error" in response:
+                raise AssertionError("elasticsearch msearch failed: {}".format(response["error"]))
+            result.append(self.parse_hits(response))
+        return result
+
+
+class NXLinkFAQBM25Index(NXLinkFAQIndex):
+    """
+    进程内 BM25 倒排索引, 可替代 NXLinkFAQElasticIndex, 适用于小规模部署 (不需要 Elasticsearch).
+    分词与打分方式与 NXLinkFAQElasticIndex 一致.
+    """
+    def __init__(self,
+                 nxlink_faq_file: str,
+                 query_top_k: int = 5,
+                 tokenize_num_workers: int = 1,
+                 tokenize_batch_size: int = 2000,
+                 snapshot_directory: str = None,
+                 ):
+        self.nxlink_faq_file = nxlink_faq_file
+        self.query_top_k = query_top_k
+        self.tokenize_num_workers = tokenize_num_workers
+        self.tokenize_batch_size = tokenize_batch_size
+        self.snapshot_directory = snapshot_directory
+
+        self.rows: List[dict] = list()
+        self.products: np.ndarray = np.zeros(shape=(0,), dtype=np.int32)
+        self.product_ids: Dict[str, int] = dict()
+        self.bm25_index = BM25Index()
+
+        self._build_bm25_index()
+
+    def _build_bm25_index(self):
+        logger.info("build_bm25_index start. ")
+
+        h = hashlib.sha256()
+        h.update(get_file_hash(self.nxlink_faq_file).encode("utf-8"))
+        h.update(get_text_tokenizer().version.encode("utf-8"))
+        self.index_version = h.hexdigest()[:16]
+
+        rows = list()
+        documents = list()
+        products = list()
+        for row in iter_tokenized_nxlink_faq_with_snapshot(
+                self.nxlink_faq_file,
+                snapshot_directory=self.snapshot_directory,
+                num_workers=self.tokenize_num_workers,
+                batch_size=self.tokenize_batch_size,
+        ):
+            product_id = self.product_ids.setdefault(row["product"], len(self.product_ids))
+
+            documents.append(row.pop("question_preprocessed"))
+            rows.append(row)
+            products.append(product_id)
+
+        self.bm25_index.build(documents)
+        self.rows = rows
+        self.products = np.array(products, dtype=np.int32)
+
+        logger.info("build_bm25_index finish. docs: {}".format(len(rows)))
+        return
+
+    def doc_count(self) -> int:
+        return len(self.rows)
+
+    def query(self, query: str, product: str = "nxlink"):
+        with Span("tokenize"):
+            tokens = self.text_split(query)
+
+        product_id = self.product_ids.get(product)
+        if product_id is None:
+            return list()
+        doc_mask = self.products == product_id
+
+        with Span("bm25_search"):
+            doc_ids, scores = self.bm25_index.search(tokens, top_k=self.query_top_k, doc_mask=doc_mask)
+
+        result = list()
+        for doc_id, score in zip(doc_ids.tolist(), scores.tolist()):
+            row = self.rows[doc_id]
+            result.append({
+                "score": score,
+                "question": row["question"],
+                "answer": row["answer"],
+                "filename": row["filename"],
+                "header": row["header"],
+                "product": row["product"],
+            })
+        return result
+
+
+class NXLinkFAQDenseIndex(NXLinkFAQIndex):
+    """
+    向量检索, 召回关键词不同但语义相近的问题.
+    启动时计算全部 FAQ 问题的向量, 存为连续的 float32 矩阵, 查询时矩阵乘法取 top_k.
+    score 为余弦相似度, 低于 query_min_score 的结果不返回.
+
+    snapshot_directory 不为空时, 向量以 int8 量化保存在 {snapshot_directory}/faq_embeddings_{index_version} 中,
+    之后启动时以只读 mmap 加载, 不再计算向量, 各 worker 进程共享页缓存.
+    keep_float 为 True 时同时保存 float32 向量, 用于 top 候选的重打分 (目录名带 _float 后缀).
+
+    index_type 为 ivf 时使用 IVFIndex 近似检索, 快照目录为 {snapshot_directory}/faq_ivf_{index_version}_{ivf_nlist}.
+    ivf_nprobe 调节召回率与延迟. add 可增量添加问答, 不需要重建索引.
+    add 的问答与向量追加到 {快照目录}_added.jsonl, 加载快照后重放, 重启后不丢失.
+    没有 snapshot_directory 时 add 只在内存中. FAQ 文件变化 (index_version 改变) 后不再加载之前 add 的问答.
+    """
+    def __init__(self,
+                 nxlink_faq_file: str,
+                 embed_fn: Callable[[List[str]], np.ndarray],
+                 embedding_version: str,
+                 query_top_k: int = 10,
+                 query_min_score: float = 0.3,
+                 snapshot_directory: str = None,
+                 index_type: str = "flat",
+                 ivf_nlist: int = 0,
+                 ivf_nprobe: int = 16,
+                 keep_float: bool = False,
+                 ):
+        if index_type not in ("flat", "ivf"):
+            raise AssertionError("invalid index_type: {}".format(index_type))
+        self.nxlink_faq_file = nxlink_faq_file
+        self.embed_fn = embed_fn
+        self.embedding_version = embedding_version
+        self.query_top_k = query_top_k
+        self.query_min_score = query_min_score
+        self.snapshot_directory = snapshot_directory
+        self.index_type = index_type
+        self.ivf_nlist = ivf_nlist
+        self.ivf_nprobe = ivf_nprobe
+        self.keep_float = keep_float
+
+        self.rows: List[dict] = list()
+        self.products: np.ndarray = np.zeros(shape=(0,), dtype=np.int32)
+        self.product_ids: Dict[str, int] = dict()
+        self.dense_index = DenseIndex()
+        self._add_lock = threading.Lock()
+        # _added.jsonl 上次中断时最后一行可能没有换行符, 追加之前先补一个换行.
+        self._added_needs_newline = False
+
+        self._build_dense_index()
+
+    def _build_dense_index(self):
+        logger.info("build_dense_index start. ")
+        begin = time.time()
+
+        h = hashlib.sha256()
+        h.update(get_file_hash(self.nxlink_faq_file).encode("utf-8"))
+        h.update(self.embedding_version.encode("utf-8"))
+        self.index_version = h.hexdigest()[:16]
+
+        rows = list()
+        products = list()
+        for row in iter_nxlink_faq(self.nxlink_faq_file):
+            product_id = self.product_ids.setdefault(row["product"], len(self.product_ids))
+            rows.append(row)
+            products.append(product_id)
+
+        if self.index_type == "ivf":
+            self.dense_index = self._build_ivf_index(rows)
+            self._load_added(rows, products)
+        elif self.snapshot_directory:
+            store_directory = os.path.join(
+                self.snapshot_directory,
+                "faq_embeddings_{}{}".format(self.index_version, "_float" if self.keep_float else "")
+            )
+            if not Int8EmbeddingStore.exists(store_directory):
+                embeddings = self.embed_fn([row["question"] for row in rows])
+                Int8EmbeddingStore.from_embeddings(
+                    ids=[str(idx) for idx in range(len(rows))],
+                    embeddings=embeddings,
+                    keep_float=self.keep_float,
+                ).save(store_directory)
+            self.dense_index = Int8EmbeddingStore.load(store_directory, mmap=True)
+        else:
+            embeddings = self.embed_fn([row["question"] for row in rows])
+            self.dense_index.build(embeddings)
+        self.rows = rows
+        self.products = np.array(products, dtype=np.int32)
+
+        logger.info("build_dense_index finish. docs: {}, cost: {:.2f}s".format(len(rows), time.time() - begin))
+        return
+
+    def get_ivf_directory(self) -> Optional[str]:
+        if not self.snapshot_directory:
+            return None
+        return os.path.join(self.snapshot_directory, "faq_ivf_{}_{}".format(self.index_version, self.ivf_nlist))
+
+    def get_added_file(self) -> Optional[str]:
+        ivf_directory = self.get_ivf_directory()
+        if ivf_directory is None:
+            return None
+        return "{}_added.jsonl".format(ivf_directory)
+
+    def _load_added(self, rows: List[dict], products: List[int]):
+        """重放 add 追加的问答. 进程在写入过程中退出时, 最后一行可能不完整, 跳过无法解析的行."""
+        added_file = self.get_added_file()
+        if added_file is None or not os.path.exists(added_file):
+            return
+        added_rows = list()
+        embeddings = list()
+        broken = 0
+        with open(added_file, "r", encoding="utf-8") as f:
+            for line in f:
+                self._added_needs_newline = not line.endswith("\n")
+                try:
+                    js = json.loads(line)
+                except json.JSONDecodeError:
+                    broken += 1
+                    continue
+                added_rows.append(js["row"])
+                embeddings.append(js["embedding"])
+        if len(added_rows) != 0:
+            self.dense_index.add(np.array(embeddings, dtype=np.float32))
+        for row in added_rows:
+            rows.append(row)
+            products.append(self.product_ids.setdefault(row["product"], len(self.product_ids)))
+        logger.info("load added faq: {}, rows: {}, broken rows: {}".format(added_file, len(added_rows), broken))
+
+    def _build_ivf_index(self, rows: List[dict]) -> IVFIndex:
+        ivf_directory = self.get_ivf_directory()
+        if ivf_directory is not None and IVFIndex.exists(ivf_directory):
+            return IVFIndex.load(ivf_directory, mmap=True, nprobe=self.ivf_nprobe)
+
+        embeddings = self.embed_fn([row["question"] for row in rows])
+        ivf_index = IVFIndex(nlist=self.ivf_nlist or None, nprobe=self.ivf_nprobe).build(embeddings)
+        if ivf_directory is not None:
+            ivf_index.save(ivf_directory)
+        logger.info("build ivf index. nlist: {}, nprobe: {}".format(ivf_index.nlist, ivf_index.nprobe))
+        return ivf_index
+
+    def add(self, rows: List[dict]):
+        """
+        增量添加问答 (只支持 ivf), 行格式与 iter_nxlink_faq 一致. 可与查询并发.
+        先更新 rows, products, 再写入向量索引, 查询到的 doc_id 总能找到对应的行.
+        有快照目录时, 先追加到 _added.jsonl 再修改内存中的索引, 返回之后的问答重启后仍然存在.
+        """
+        if self.index_type != "ivf":
+            raise AssertionError("add only supported by ivf index, index_type: {}".format(self.index_type))
+        if len(rows) == 0:
+            return
+        embeddings = self.embed_fn([row["question"] for row in rows])
+        added_file = self.get_added_file()
+        with self._add_lock:
+            if added_file is not None:
+                with open(added_file, "a", encoding="utf-8") as f:
+                    if self._added_needs_newline:
+                        f.write("\n")
+                        self._added_needs_newline = False
+                    for row, embedding in zip(rows, embeddings.tolist()):
+                        f.write("{}\n".format(json.dumps({"row": row, "embedding": embedding}, ensure_ascii=False)))
+                    f.flush()
+            product_ids = [self.product_ids.setdefault(row["product"], len(self.product_ids)) for row in rows]
+            self.rows.extend(rows)
+            self.products = np.concatenate([self.products, np.array(product_ids, dtype=np.int32)])
+            self.dense_index.add(embeddings)
+        return
+
+    def doc_count(self) -> int:
+        return len(self.rows)
+
+    def batch_query(self, queries: List[str], product: str = "nxlink") -> List[List[dict]]:
+        if len(queries) == 0:
+            return list()
+        product_id = self.product_ids.get(product)
+        if product_id is None:
+            return [list() for _ in queries]
+        doc_mask = self.products == product_id
+
+        with Span("dense_embedding"):
+            query_embeddings = self.embed_fn(queries)
+        with Span("dense_search"):
+            hits = self.dense_index.batch_search(query_embeddings, top_k=self.query_top_k, doc_mask=doc_mask)
+
+        result = list()
+        for doc_ids, scores in hits:
+            faq_recall = list()
+            for doc_id, score in zip(doc_ids.tolist(), scores.tolist()):
+                if score < self.query_min_score:
+                    break
+                row = self.rows[doc_id]
+                faq_recall.append({
+                    "score": score,
+                    "question": row["question"],
+                    "answer": row["answer"],
+                    "filename": row["filename"],
+                    "header": row["header"],
+                    "product": row["product"],
+                })
+            result.append(faq_recall)
+        return result
+
+    def query(self, query: str, product: str = "nxlink"):
+        return self.batch_query([query], product)[0]
+
+
+class NXLinkFAQHybridIndex(NXLinkFAQIndex):
+    """
+    关键词检索 (Elasticsearch 或 BM25) 与向量检索的混合检索.
+    (1)两路检索并发执行, 向量检索在 executor 中, 关键词检索在当前线程中.
+    (2)结果以 Reciprocal Rank Fusion 合并, 取 top_k. 同一问答 (filename, header, question, answer) 只保留一条.
+    (3)score 为 RRF 得分, sparse_score, dense_score 为两路的原始得分, 未召回时为 None.
+    RRF 得分的尺度与 BM25 不同, 启用后 faq_retrieval_only_min_score 需要相应调整.
+    """
+    def __init__(self,
+                 sparse_index: NXLinkFAQIndex,
+                 dense_index: NXLinkFAQDenseIndex,
+                 top_k: int = 5,
+                 rrf_k: int = 60,
+                 max_workers: int = 8,
+                 ):
+        self.sparse_index = sparse_index
+        self.dense_index = dense_index
+        self.top_k = top_k
+        self.rrf_k = rrf_k
+
+        self.executor = BlockingCallExecutor(max_workers=max_workers, name="dense_retrieval")
+
+    @property
+    def index_version(self) -> str:
+        return "{}_{}".format(self.sparse_index.index_version, self.dense_index.index_version)
+
+    def doc_count(self) -> int:
+        return self.sparse_index.doc_count()
+
+    @staticmethod
+    def get_key(faq: dict) -> tuple:
+        return faq["filename"], faq["header"], faq["question"], faq["answer"]
+
+    def fuse(self, sparse_recall: List[dict], dense_recall: List[dict]) -> List[dict]:
+        key_to_faq: Dict[tuple, dict] = dict()
+        sparse_scores: Dict[tuple, float] = dict()
+        dense_scores: Dict[tuple, float] = dict()
+        for faq in sparse_recall:
+            key = self.get_key(faq)
+            key_to_faq.setdefault(key, faq)
+            sparse_scores.setdefault(key, faq["score"])
+        for faq in dense_recall:
+            key = self.get_key(faq)
+            key_to_faq.setdefault(key, faq)
+            dense_scores.setdefault(key, faq["score"])
+
+        fused = reciprocal_rank_fusion(
+            rankings=[
+                [self.get_key(faq) for faq in sparse_recall],
+                [self.get_key(faq) for faq in dense_recall],
+            ],
+            k=self.rrf_k,
+            top_k=self.top_k,
+        )
+
+        result = list()
+        for key, score in fused:
+            faq = dict(key_to_faq[key])
+            faq["score"] = score
+            faq["sparse_score"] = sparse_scores.get(key)
+            faq["dense_score"] = dense_scores.get(key)
+            result.append(faq)
+        return result
+
+    def query(self, query: str, product: str = "nxlink"):
+        future = self.executor.submit(self.dense_index.query, query, product)
+        sparse_recall = self.sparse_index.query(query, product)
+        dense_recall = future.result()
+        with Span("rank_fusion"):
+            return self.fuse(sparse_recall, dense_recall)
+
+    def batch_query(self, queries: List[str], product: str = "nxlink") -> List[List[dict]]:
+        future = self.executor.submit(self.dense_index.batch_query, queries, product)
+        sparse_recalls = self.sparse_index.batch_query(queries, product)
+        dense_recalls = future.result()
+        with Span("rank_fusion"):
+            return [self.fuse(s, d) for s, d in zip(sparse_recalls, dense_recalls)]
+
+
+class NXLinkFAQExactMatchIndex(object):
+    """
+    标准问题精确匹配索引.
+    key 为 (product, normalize_text(question)), 与标准问题仅有大小写, 全半角, 标点, 空白差异的 query 可直接命中.
+    """
+    def __init__(self, nxlink_faq_file: str):
+        self.nxlink_faq_file = nxlink_faq_file
+
+        self.question_to_row: Dict[Tuple[str, str], dict] = dict()
+
+        self._build_exact_match_index()
+
+    def _build_exact_match_index(self):
+        for row in iter_nxlink_faq(self.nxlink_faq_file):
+            key = (row["product"], normalize_text(row["question"]))
+            if len(key[1]) == 0:
+                continue
+            # 重复的标准问题, 保留第一个.
+            self.question_to_row.setdefault(key, row)
+
+        logger.info("build_exact_match_index finish. questions: {}".format(len(self.question_to_row)))
+        return
+
+    def query(self, query: str, product: str = "nxlink") -> Optional[dict]:
+        row = self.question_to_row.get((product, text_normalize(query)))
+        if row is None:
+            return None
+        return {
+            "score": None,
+            "question": row["question"],
+            "answer": row["answer"],
+            "filename": row["filename"],
+            "header": row["header"],
+            "product": row["product"],
+        }
+
 
 class NXLinkQA(object):
+    """
+    FAQ 问答.
+
+    决策顺序:
+    (1)精确匹配标准问题, 直接返回标准答案.
+    (2)检索 FAQ, top1 得分与领先 top2 的比例都超过阈值时, 直接返回 top1 答案.
+    (3)调用 LLM 生成答案. LLM 超时, 出错或熔断时, 退回 top1 答案.
+
+    缓存:
+    (1)answer_cache 的 key 为 (索引版本, prompt 配置指纹, 归一化 query). 索引版本变化时清空缓存. fallback 结果不缓存.
+    (2)semantic_cache 在 answer_cache 未命中时, 按 query 向量的余弦相似度查找近似问题的答案.
+    (3)缓存未命中时, 相同 key 的并发请求通过 single_flight 共享同一次检索与 LLM 调用.
+
+    监控:
+    (1)tokenize, es_search, prompt, llm 等阶段通过 Span 计时, 导出到 /metrics, 并记录到当前请求的 Trace.
+    (2)缓存命中, LLM 调用结果, answer_source 分别计数.
+
+    """
     def __init__(self,
-                 faq_elastic_index: NXLinkFAQElasticIndex,
-                 openai_api_key: str
+                 faq_elastic_index: NXLinkFAQIndex,
+                 openai_api_key: str,
+                 faq_exact_match_index: NXLinkFAQExactMatchIndex = None,
+                 retrieval_only_enable: bool = False,
+                 retrieval_only_min_score: float = 10.0,
+                 retrieval_only_min_margin: float = 0.5,
+                 llm_timeout: float = 30.0,
+                 llm_max_workers: int = 16,
+                 retrieval_max_workers: int = 32,
+                 llm_batch_size: int = 8,
+                 llm_circuit_breaker: CircuitBreaker = None,
+                 answer_cache: LRUCache = None,
+                 semantic_cache: SemanticCache = None,
+                 single_flight: SingleFlight = None,
                  ):
         self.faq_elastic_index = faq_elastic_index
         self.openai_api_key = openai_api_key
+        self.faq_exact_match_index = faq_exact_match_index
+        self.retrieval_only_enable = retrieval_only_enable
+        self.retrieval_only_min_score = retrieval_only_min_score
+        self.retrieval_only_min_margin = retrieval_only_min_margin
+        self.llm_timeout = llm_timeout
+        self.llm_batch_size = llm_batch_size
+        self.llm_circuit_breaker = llm_circuit_breaker or CircuitBreaker()
+        self.answer_cache = answer_cache
+        self.semantic_cache = semantic_cache
+        self.single_flight = single_flight
+
+        from langchain.llms import OpenAI
 
         self.llm = OpenAI(
             temperature=0.7,
             max_tokens=1024,
             n=10,
-            openai_api_key=self.openai_api_key
+            openai_api_key=self.openai_api_key,
+            request_timeout=self.llm_timeout,
         )
+        # batch_predict 只使用每个 prompt 的第一个 completion, n=1, 不为丢弃的 completion 付费.
+        self.batch_llm = OpenAI(
+            temperature=0.7,
+            max_tokens=1024,
+            n=1,
+            openai_api_key=self.openai_api_key,
+            request_timeout=self.llm_timeout,
+        )
+        self.stream_llm = OpenAI(
+            temperature=0.7,
+            max_tokens=1024,
+            streaming=True,
+            openai_api_key=self.openai_api_key,
+            request_timeout=self.llm_timeout,
+        )
+        self.llm_executor = BlockingCallExecutor(max_workers=llm_max_workers, name="llm")
+        self.retrieval_executor = BlockingCallExecutor(max_workers=retrieval_max_workers, name="retrieval")
 
-    def query(self, query: str):
-        faq_recall = self.faq_elastic_index.query(query)
+        self.prompt_fingerprint = self.get_prompt_fingerprint()
+        self._cache_index_version = None
+
+        llm_circuit_open.set_function(lambda: 0 if self.llm_circuit_breaker.state == "closed" else 1)
+        executor_pending.set_function(lambda: self.llm_executor.stats()["pending"], executor="llm")
+        executor_pending.set_function(lambda: self.retrieval_executor.stats()["pending"], executor="retrieval")
+
+    def get_prompt_fingerprint(self) -> str:
+        js = {
+            "faq_prefix_prompt_str": settings.faq_prefix_prompt_str,
+            "fap_example_prompt_str": settings.fap_example_prompt_str,
+            "faq_suffix_prompt_str": settings.faq_suffix_prompt_str,
+            "temperature": self.llm.temperature,
+            "max_tokens": self.llm.max_tokens,
+            "retrieval_only_enable": self.retrieval_only_enable,
+            "retrieval_only_min_score": self.retrieval_only_min_score,
+            "retrieval_only_min_margin": self.retrieval_only_min_margin,
+        }
+        js = json.dumps(js, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(js.encode("utf-8")).hexdigest()[:16]
+
+    def get_cache_key(self, query: str) -> tuple:
+        index_version = self.faq_elastic_index.index_version
+        if index_version != self._cache_index_version:
+            # 索引已重建, 旧答案失效.
+            if self.answer_cache is not None:
+                self.answer_cache.clear()
+            if self.semantic_cache is not None:
+                self.semantic_cache.clear()
+            self._cache_index_version = index_version
+        return index_version, self.prompt_fingerprint, text_normalize(query)
+
+    def get_confident_faq(self, faq_recall: List[dict]) -> Optional[dict]:
+        if not self.retrieval_only_enable or len(faq_recall) == 0:
+            return None
+        top1_score = faq_recall[0]["score"]
+        top2_score = faq_recall[1]["score"] if len(faq_recall) > 1 else 0.0
+        if top1_score < self.retrieval_only_min_score:
+            return None
+        if (top1_score - top2_score) / top1_score < self.retrieval_only_min_margin:
+            return None
+        return faq_recall[0]
+
+    @staticmethod
+    def get_prompt(query: str, faq_recall: List[dict]) -> str:
+        examples = [{"question": o["question"], "answer": o["answer"]} for o in faq_recall]
+        prompt = get_faq_prompt_template(examples).format(user_question=query)
+        return prompt
+
+    def batch_predict(self, prompts: List[str]) -> List[str]:
+        """多个 prompt 在一次 completion 请求中提交."""
+        with Span("llm"):
+            llm_result = self.batch_llm.generate(prompts)
+        answers = [generations[0].text for generations in llm_result.generations]
+        return answers
+
+    def predict(self, query: str, faq_recall: List[dict]) -> str:
         examples = [{"question": o["question"], "answer": o["answer"]} for o in faq_recall]
 
         prompt = get_faq_prompt_template(examples)
 
+        from langchain.chains.llm import LLMChain
+
         llm_chain = LLMChain(llm=self.llm, prompt=prompt)
 
-        answer = llm_chain.predict(user_question=query)
+        with Span("llm"):
+            answer = llm_chain.predict(user_question=query)
+        return answer
+
+    def predict_with_deadline(self, query: str, faq_recall: List[dict]) -> Tuple[Optional[str], Optional[str]]:
+        """
+        :return: (answer, fallback_reason). 成功时 fallback_reason 为 None, 否则 answer 为 None.
+        """
+        if not self.llm_circuit_breaker.allow_request():
+            llm_requests_total.inc(result="circuit_open")
+            return None, "circuit_open"
+
+        future = self.llm_executor.submit(self.predict, query, faq_recall)
+        try:
+            answer = future.result(timeout=self.llm_timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            self.llm_circuit_breaker.record_failure()
+            llm_requests_total.inc(result="timeout")
+            logger.warning("llm predict timeout, llm_timeout: {}".format(self.llm_timeout))
+            return None, "timeout"
+        except Exception as e:
+            self.llm_circuit_breaker.record_failure()
+            llm_requests_total.inc(result="error")
+            logger.exception("llm predict failed: {}".format(e))
+            return None, "error"
+
+        self.llm_circuit_breaker.record_success()
+        llm_requests_total.inc(result="success")
+        return answer, None
+
+    def get_cached_result(self, cache_key: tuple) -> Tuple[Optional[dict], Optional[np.ndarray]]:
+        """
+        :return: (result, embedding). embedding 为 query 向量, 未启用 semantic_cache 时为 None.
+        """
+        if self.answer_cache is not None:
+            with Span("cache_lookup"):
+                result = self.answer_cache.get(cache_key)
+            cache_requests_total.inc(cache="lru", result="miss" if result is None else "hit")
+            if result is not None:
+                result = dict(result)
+                result["cache_hit"] = True
+                result["cache_type"] = "lru"
+                return result, None
+
+        embedding = None
+        if self.semantic_cache is not None:
+            with Span("embedding"):
+                embedding = self.semantic_cache.embed(cache_key[-1])
+            with Span("semantic_cache_lookup"):
+                result = self.semantic_cache.get(embedding)
+            cache_requests_total.inc(cache="semantic", result="miss" if result is None else "hit")
+            if result is not None:
+                if self.answer_cache is not None:
+                    self.answer_cache.set(cache_key, result)
+                result = dict(result)
+                result["cache_hit"] = True
+                result["cache_type"] = "semantic"
+                return result, embedding
+        return None, embedding
+
+    def set_cached_result(self, cache_key: tuple, embedding: Optional[np.ndarray], result: dict):
+        if result["answer_source"] == "fallback":
+            return
+        if self.answer_cache is not None:
+            self.answer_cache.set(cache_key, result)
+        if self.semantic_cache is not None and embedding is not None:
+            self.semantic_cache.set(embedding, result)
+
+    def query(self, query: str):
+        with Span("query"):
+            result = self._query(query)
+        answers_total.inc(answer_source=result["answer_source"])
+        return result
+
+    def _query(self, query: str):
+        cache_key = self.get_cache_key(query)
+        result, embedding = self.get_cached_result(cache_key)
+        if result is not None:
+            return result
+
+        if self.single_flight is not None:
+            result, coalesced = self.single_flight.do(cache_key, self.compute_and_cache, query, cache_key, embedding)
+            single_flight_requests_total.inc(role="coalesced" if coalesced else "leader")
+            if coalesced:
+                result = dict(result)
+                result["coalesced"] = True
+            return result
+        return self.compute_and_cache(query, cache_key, embedding)
+
+    def compute_and_cache(self, query: str, cache_key: tuple, embedding: Optional[np.ndarray]):
+        """
+        在 single_flight 的 leader 中写入缓存: leader 结束 (释放 key) 之前缓存已写入,
+        之后到达的相同请求一定能命中缓存, 不会再次计算.
+        """
+        result = self.compute(query)
+        self.set_cached_result(cache_key, embedding, result)
+        return result
+
+    def retrieve(self, query: str) -> Tuple[Optional[dict], List[dict]]:
+        """
+        精确匹配与检索.
+        :return: (result, faq_recall). result 不为 None 时, 不需要调用 LLM.
+        """
+        # 命中标准问题时直接返回, 不调用检索与 LLM.
+        if self.faq_exact_match_index is not None:
+            with Span("exact_match"):
+                faq = self.faq_exact_match_index.query(query)
+            if faq is not None:
+                result = {
+                    "answer": faq["answer"],
+                    "faq_recall": [faq],
+                    "answer_source": "exact_match",
+                }
+                return result, result["faq_recall"]
+
+        with Span("retrieval"):
+            faq_recall = self.retrieval_executor.call(self.faq_elastic_index.query, query)
+
+        # 检索结果足够确定时, 直接返回.
+        faq = self.get_confident_faq(faq_recall)
+        if faq is not None:
+            result = {
+                "answer": faq["answer"],
+                "faq_recall": faq_recall,
+                "answer_source": "retrieval",
+            }
+            return result, faq_recall
+        return None, faq_recall
+
+    def get_fallback_result(self, faq_recall: List[dict], fallback_reason: str) -> dict:
+        if len(faq_recall) == 0:
+            raise ExpectedError(
+                status_code=60503,
+                message="llm unavailable and no faq recalled. ",
+                detail=fallback_reason,
+            )
+        result = {
+            "answer": faq_recall[0]["answer"],
+            "faq_recall": faq_recall,
+            "answer_source": "fallback",
+            "fallback_reason": fallback_reason,
+        }
+        return result
+
+    def compute(self, query: str):
+        result, faq_recall = self.retrieve(query)
+        if result is not None:
+            return result
+
+        answer, fallback_reason = self.predict_with_deadline(query, faq_recall)
+        if fallback_reason is not None:
+            return self.get_fallback_result(faq_recall, fallback_reason)
 
         result = {
             "answer": answer,
             "faq_recall": faq_recall,
+            "answer_source": "llm",
+        }
+        return result
+
+    def stream_predict(self, prompt: str, chunks: queue.Queue, cancelled: threading.Event):
+        """
+        在 llm_executor 中消费流式 completion, 与 predict 共用 llm_max_workers 的并发限制.
+        片段通过 chunks 传给请求协程, 结束时放入 None, 出错时放入异常. cancelled 置位后在下一个片段处停止.
+        """
+        try:
+            with Span("llm"):
+                for chunk in self.stream_llm.stream(prompt):
+                    if cancelled.is_set():
+                        break
+                    text = chunk["choices"][0]["text"]
+                    if len(text) != 0:
+                        chunks.put(text)
+        except Exception as e:
+            chunks.put(e)
+            return
+        chunks.put(None)
+
+    @staticmethod
+    def iter_result_events(result: dict):
+        yield {"event": "faq_recall", "data": {"faq_recall": result["faq_recall"]}}
+        yield {"event": "token", "data": {"text": result["answer"]}}
+
+    def query_stream(self, query: str):
+        """
+        流式问答, 依次产生事件:
+        (1){"event": "faq_recall", "data": {"faq_recall": [...]}}, 检索完成后立即产生.
+        (2){"event": "token", "data": {"text": "..."}}, LLM 生成的片段. 不调用 LLM 时, 整个答案作为一个片段.
+        (3){"event": "done", "data": result}, result 与 query 的返回值相同.
+
+        缓存未命中时, 与 query 共用 single_flight: 相同 key 正在计算时等待其结果, 整个答案作为一个片段.
+        作为 leader 的流式请求被客户端断开时, 等待的请求重新竞争 leader.
+        """
+        cache_key = self.get_cache_key(query)
+        result, embedding = self.get_cached_result(cache_key)
+        if result is not None:
+            yield from self.iter_result_events(result)
+        elif self.single_flight is None:
+            result = yield from self.compute_stream(query, cache_key, embedding)
+        else:
+            while True:
+                call, leader = self.single_flight.begin(cache_key)
+                single_flight_requests_total.inc(role="leader" if leader else "coalesced")
+                if leader:
+                    break
+                result, abandoned = self.single_flight.wait(call)
+                if not abandoned:
+                    result = dict(result)
+                    result["coalesced"] = True
+                    break
+
+            if leader:
+                try:
+                    result = yield from self.compute_stream(query, cache_key, embedding)
+                except GeneratorExit:
+                    self.single_flight.finish(cache_key, call, abandoned=True)
+                    raise
+                except BaseException as e:
+                    self.single_flight.finish(cache_key, call, exception=e)
+                    raise
+                self.single_flight.finish(cache_key, call, result=result)
+            else:
+                yield from self.iter_result_events(result)
+
+        answers_total.inc(answer_source=result["answer_source"])
+        yield {"event": "done", "data": result}
+
+    def compute_stream(self, query: str, cache_key: tuple, embedding: Optional[np.ndarray]):
+        """产生 faq_recall 与 token 事件, 返回 result 并写入缓存."""
+        result, faq_recall = self.retrieve(query)
+        if result is not None:
+            self.set_cached_result(cache_key, embedding, result)
+
+        yield {"event": "faq_recall", "data": {"faq_recall": faq_recall}}
+
+        if result is not None:
+            yield {"event": "token", "data": {"text": result["answer"]}}
+            return result
+
+        if not self.llm_circuit_breaker.allow_request():
+            llm_requests_total.inc(result="circuit_open")
+            result = self.get_fallback_result(faq_recall, "circuit_open")
+            yield {"event": "token", "data": {"text": result["answer"]}}
+            return result
+
+        prompt = self.get_prompt(query, faq_recall)
+
+        # 熔断器的记录放在 finally 中: 客户端断开时生成器收到 GeneratorExit (不是 Exception),
+        # 此时释放 half_open 的探测名额, 否则熔断器一直停在 half_open.
+        # 整个流式调用 (包括在 llm_executor 中排队) 的截止时间为 llm_timeout, 每次读取片段最多等待到截止时间.
+        outcome = None
+        answer = ""
+        chunks = queue.Queue()
+        cancelled = threading.Event()
+        deadline = time.time() + self.llm_timeout
+        future = self.llm_executor.submit(self.stream_predict, prompt, chunks, cancelled)
+        try:
+            while True:
+                try:
+                    item = chunks.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    raise TimeoutError("llm stream exceeded llm_timeout: {}".format(self.llm_timeout)) from None
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                answer += item
+                yield {"event": "token", "data": {"text": item}}
+            outcome = "success"
+        except Exception as e:
+            outcome = "timeout" if isinstance(e, TimeoutError) else "error"
+            logger.exception("llm stream failed: {}".format(e))
+            if len(answer) != 0:
+                raise
+        finally:
+            # 未开始的调用直接取消, 进行中的调用在下一个片段处停止, 让出 llm_executor.
+            cancelled.set()
+            future.cancel()
+            if outcome == "success":
+                self.llm_circuit_breaker.record_success()
+            elif outcome is not None:
+                self.llm_circuit_breaker.record_failure()
+            else:
+                self.llm_circuit_breaker.release()
+            llm_requests_total.inc(result=outcome or "cancelled")
+
+        if outcome == "success":
+            result = {
+                "answer": answer,
+                "faq_recall": faq_recall,
+                "answer_source": "llm",
+            }
+            self.set_cached_result(cache_key, embedding, result)
+        else:
+            result = self.get_fallback_result(faq_recall, outcome)
+            yield {"event": "token", "data": {"text": result["answer"]}}
+        return result
+
+    def batch_query(self, queries: List[str]) -> List[dict]:
+        """
+        批量问答, 结果与 queries 顺序一致.
+        (1)归一化后相同的 query 只计算一次.
+        (2)缓存, 精确匹配之后, 剩余 query 通过一次 batch_query (Elasticsearch msearch) 检索.
+        (3)需要 LLM 的 query 每 llm_batch_size 个合并为一次 completion 请求, 在 llm_executor 中并发执行.
+        (4)单个 query 失败时, 对应结果的 answer_source 为 error, 不影响其它 query.
+        """
+        key_to_result: Dict[tuple, dict] = dict()
+        key_to_query: Dict[tuple, str] = dict()
+        key_to_embedding: Dict[tuple, Optional[np.ndarray]] = dict()
+        cache_keys = list()
+        for query in queries:
+            cache_key = self.get_cache_key(query)
+            cache_keys.append(cache_key)
+            if cache_key in key_to_result or cache_key in key_to_query:
+                continue
+            result, embedding = self.get_cached_result(cache_key)
+            if result is not None:
+                key_to_result[cache_key] = result
+                continue
+            if self.faq_exact_match_index is not None:
+                faq = self.faq_exact_match_index.query(query)
+                if faq is not None:
+                    result = {
+                        "answer": faq["answer"],
+                        "faq_recall": [faq],
+                        "answer_source": "exact_match",
+                    }
+                    key_to_result[cache_key] = result
+                    self.set_cached_result(cache_key, embedding, result)
+                    continue
+            key_to_query[cache_key] = query
+            key_to_embedding[cache_key] = embedding
+
+        # 检索
+        pending_keys = list(key_to_query.keys())
+        with Span("retrieval"):
+            faq_recalls = self.retrieval_executor.call(
+                self.faq_elastic_index.batch_query,
+                [key_to_query[cache_key] for cache_key in pending_keys]
+            )
+
+        llm_keys = list()
+        key_to_faq_recall: Dict[tuple, List[dict]] = dict()
+        for cache_key, faq_recall in zip(pending_keys, faq_recalls):
+            key_to_faq_recall[cache_key] = faq_recall
+            faq = self.get_confident_faq(faq_recall)
+            if faq is not None:
+                key_to_result[cache_key] = {
+                    "answer": faq["answer"],
+                    "faq_recall": faq_recall,
+                    "answer_source": "retrieval",
+                }
+            else:
+                llm_keys.append(cache_key)
+
+        # LLM
+        deadline = time.time() + self.llm_timeout
+        futures = list()
+        for i in range(0, len(llm_keys), self.llm_batch_size):
+            batch_keys = llm_keys[i: i + self.llm_batch_size]
+            if not self.llm_circuit_breaker.allow_request():
+                llm_requests_total.inc(result="circuit_open")
+                futures.append((batch_keys, None))
+                continue
+            prompts = [self.get_prompt(key_to_query[k], key_to_faq_recall[k]) for k in batch_keys]
+            futures.append((batch_keys, self.llm_executor.submit(self.batch_predict, prompts)))
+
+        for batch_keys, future in futures:
+            answers = None
+            fallback_reason = "circuit_open"
+            if future is not None:
+                try:
+                    answers = future.result(timeout=max(0.0, deadline - time.time()))
+                    self.llm_circuit_breaker.record_success()
+                    llm_requests_total.inc(result="success")
+                except FutureTimeoutError:
+                    # 还在排队的批次不再占用 llm_executor.
+                    future.cancel()
+                    self.llm_circuit_breaker.record_failure()
+                    llm_requests_total.inc(result="timeout")
+                    logger.warning("llm batch predict timeout, llm_timeout: {}".format(self.llm_timeout))
+                    fallback_reason = "timeout"
+                except Exception as e:
+                    self.llm_circuit_breaker.record_failure()
+                    llm_requests_total.inc(result="error")
+                    logger.exception("llm batch predict failed: {}".format(e))
+                    fallback_reason = "error"
+
+            for j, cache_key in enumerate(batch_keys):
+                faq_recall = key_to_faq_recall[cache_key]
+                if answers is not None:
+                    key_to_result[cache_key] = {
+                        "answer": answers[j],
+                        "faq_recall": faq_recall,
+                        "answer_source": "llm",
+                    }
+                    continue
+                try:
+                    key_to_result[cache_key] = self.get_fallback_result(faq_recall, fallback_reason)
+                except ExpectedError as e:
+                    key_to_result[cache_key] = {
+                        "answer": None,
+                        "faq_recall": faq_recall,
+                        "answer_source": "error",
+                        "status_code": e.status_code,
+                        "message": e.message,
+                        "detail": e.detail,
+                    }
+
+        for cache_key in pending_keys:
+            result = key_to_result[cache_key]
+            if result["answer_source"] != "error":
+                self.set_cached_result(cache_key, key_to_embedding[cache_key], result)
+
+        results = [key_to_result[cache_key] for cache_key in cache_keys]
+        for result in results:
+            answers_total.inc(answer_source=result["answer_source"])
+        return results
+
+    def warm_up(self):
+        """
+        启动时执行一次检索, 加载分词词典, 建立 Elasticsearch 连接. 不调用 LLM.
+        """
+        if self.faq_exact_match_index is not None:
+            self.faq_exact_match_index.query("warm up")
+        self.retrieval_executor.call(self.faq_elastic_index.query, "nxlink")
+
+    def stats(self) -> dict:
+        result = {
+            "index_version": self.faq_elastic_index.index_version,
+            "answer_cache": self.answer_cache.stats() if self.answer_cache is not None else None,
+            "semantic_cache": self.semantic_cache.stats() if self.semantic_cache is not None else None,
+            "single_flight": self.single_flight.stats() if self.single_flight is not None else None,
+            "llm_circuit_breaker": self.llm_circuit_breaker.state,
+            "llm_executor": self.llm_executor.stats(),
+            "retrieval_executor": self.retrieval_executor.stats(),
+            "tokenizer": get_text_tokenizer().stats(),
         }
         return result
 
 
+_sentence_embedding_model = None
+_sentence_embedding_model_lock = threading.Lock()
+
+
+def get_sentence_embedding_model():
+    """sentence-transformers 模型, 在 CPU 上运行. 首次使用时加载."""
+    global _sentence_embedding_model
+
+    with _sentence_embedding_model_lock:
+        if _sentence_embedding_model is None:
+            from sentence_transformers import SentenceTransformer
+
+            _sentence_embedding_model = SentenceTransformer(
+                model_name_or_path=settings.sentence_embedding_model,
+                device="cpu",
+            )
+    return _sentence_embedding_model
+
+
+def sentence_embedding(texts: List[str]) -> np.ndarray:
+    model = get_sentence_embedding_model()
+    embeddings = model.encode(
+        texts,
+        batch_size=32,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+    )
+    return embeddings
+
+
+def get_faq_index() -> NXLinkFAQIndex:
+    nxlink_faq_file = os.path.join(settings.nxlink_question_answer_dataset, settings.nxlink_faq_filename)
+
+    if settings.faq_retrieval_backend == "elasticsearch":
+        faq_index = NXLinkFAQElasticIndex(
+            nxlink_faq_file=nxlink_faq_file,
+            elastic_host=settings.elastic_host,
+            elastic_port=settings.elastic_port,
+            elastic_index=settings.elastic_index,
+            elastic_query_top_k=settings.elastic_query_top_k,
+            elastic_build_wait_timeout=settings.elastic_build_wait_timeout,
+            elastic_bulk_chunk_size=settings.elastic_bulk_chunk_size,
+            elastic_bulk_thread_count=settings.elastic_bulk_thread_count,
+            tokenize_num_workers=settings.faq_tokenize_num_workers,
+            tokenize_batch_size=settings.faq_tokenize_batch_size,
+            snapshot_directory=settings.faq_snapshot_directory,
+        )
+    elif settings.faq_retrieval_backend == "bm25":
+        faq_index = NXLinkFAQBM25Index(
+            nxlink_faq_file=nxlink_faq_file,
+            query_top_k=settings.bm25_query_top_k,
+            tokenize_num_workers=settings.faq_tokenize_num_workers,
+            tokenize_batch_size=settings.faq_tokenize_batch_size,
+            snapshot_directory=settings.faq_snapshot_directory,
+        )
+    else:
+        raise AssertionError("invalid faq_retrieval_backend: {}".format(settings.faq_retrieval_backend))
+
+    if settings.faq_dense_retrieval_enable:
+        faq_index = NXLinkFAQHybridIndex(
+            sparse_index=faq_index,
+            dense_index=NXLinkFAQDenseIndex(
+                nxlink_faq_file=nxlink_faq_file,
+                embed_fn=sentence_embedding,
+                embedding_version=settings.sentence_embedding_model,
+                query_top_k=settings.faq_dense_query_top_k,
+                query_min_score=settings.faq_dense_min_score,
+                snapshot_directory=settings.faq_snapshot_directory,
+                index_type=settings.faq_dense_index_type,
+                ivf_nlist=settings.faq_dense_ivf_nlist,
+                ivf_nprobe=settings.faq_dense_ivf_nprobe,
+                keep_float=settings.faq_dense_keep_float,
+            ),
+            top_k=settings.faq_hybrid_top_k,
+            rrf_k=settings.faq_hybrid_rrf_k,
+        )
+    return faq_index
+
+
 _nxlink_qa_service: NXLinkQA = None
+_nxlink_qa_service_lock = threading.Lock()
 
 
 def get_nxlink_qa_instance():
     global _nxlink_qa_service
 
-    if _nxlink_qa_service is None:
+    if _nxlink_qa_service is not None:
+        return _nxlink_qa_service
+
+    # 并发的首次请求等待同一次构建.
+    with _nxlink_qa_service_lock:
+        if _nxlink_qa_service is not None:
+            return _nxlink_qa_service
+        nxlink_faq_file = os.path.join(settings.nxlink_question_answer_dataset, settings.nxlink_faq_filename)
+
+        faq_exact_match_index = None
+        if settings.faq_exact_match_enable:
+            faq_exact_match_index = NXLinkFAQExactMatchIndex(nxlink_faq_file=nxlink_faq_file)
+
         _nxlink_qa_service = NXLinkQA(
-            faq_elastic_index=NXLinkFAQElasticIndex(
-                nxlink_faq_file=os.path.join(settings.nxlink_question_answer_dataset, settings.nxlink_faq_filename),
-                elastic_host=settings.elastic_host,
-                elastic_port=settings.elastic_port,
-                elastic_index=settings.elastic_index,
-                elastic_query_top_k=settings.elastic_query_top_k,
+            faq_elastic_index=get_faq_index(),
+            openai_api_key=settings.openai_api_key,
+            faq_exact_match_index=faq_exact_match_index,
+            retrieval_only_enable=settings.faq_retrieval_only_enable,
+            retrieval_only_min_score=settings.faq_retrieval_only_min_score,
+            retrieval_only_min_margin=settings.faq_retrieval_only_min_margin,
+            llm_timeout=settings.llm_timeout,
+            llm_max_workers=settings.llm_max_workers,
+            retrieval_max_workers=settings.retrieval_max_workers,
+            llm_batch_size=settings.llm_batch_size,
+            llm_circuit_breaker=CircuitBreaker(
+                failure_threshold=settings.llm_circuit_breaker_failure_threshold,
+                recovery_timeout=settings.llm_circuit_breaker_recovery_timeout,
             ),
-            openai_api_key=settings.openai_api_key
+            answer_cache=LRUCache(
+                max_size=settings.answer_cache_max_size,
+                ttl=settings.answer_cache_ttl,
+            ) if settings.answer_cache_enable else None,
+            semantic_cache=SemanticCache(
+                embed_fn=sentence_embedding,
+                max_size=settings.semantic_cache_max_size,
+                threshold=settings.semantic_cache_threshold,
+                ttl=settings.answer_cache_ttl,
+            ) if settings.semantic_cache_enable else None,
+            single_flight=SingleFlight() if settings.single_flight_enable else None,
         )
 
     return _nxlink_qa_service
 
 
+_warm_up_state = {
+    "finished": False,
+    "error": None,
+    "time_cost": None,
+}
+
+
+def warm_up():
+    """
+    启动时构建服务实例, 并执行一次检索. 完成前 readiness 返回未就绪.
+    构建失败时记录错误, 之后的请求会重新尝试构建.
+    """
+    begin = time.time()
+    logger.info("warm up start. ")
+    try:
+        service = get_nxlink_qa_instance()
+        service.warm_up()
+    except Exception as e:
+        logger.exception("warm up failed: {}".format(e))
+        _warm_up_state["error"] = str(e)
+    _warm_up_state["finished"] = True
+    _warm_up_state["time_cost"] = round(time.time() - begin, 4)
+    logger.info("warm up finish, state: {}".format(_warm_up_state))
+    return
+
+
+def readiness() -> dict:
+    """
+    服务实例已构建, 预热已结束 (关闭 warm_up_enable 时不要求), 且索引可访问时就绪.
+    """
+    result = {
+        "ready": False,
+        "index_version": None,
+        "doc_count": None,
+        "warm_up": dict(_warm_up_state),
+        "error": None,
+    }
+
+    service = _nxlink_qa_service
+    if service is None:
+        return result
+    if settings.warm_up_enable and not _warm_up_state["finished"]:
+        return result
+
+    result["index_version"] = service.faq_elastic_index.index_version
+    try:
+        result["doc_count"] = service.faq_elastic_index.doc_count()
+    except Exception as e:
+        result["error"] = str(e)
+        return result
+    result["ready"] = True
+    return result
+
+
 if __name__ == '__main__':
     pass
@@ -4,7 +4,7 @@ import os
 from typing import List
 
 from project_settings import project_path
-from toolbox.os.environment import EnvironmentManager
+from toolbox.os.environment import EnvironmentManager, str2bool
 
 log_directory = os.path.join(project_path, "server/nxlink_question_answer/logs")
 os.makedirs(log_directory, exist_ok=True)
@@ -16,6 +16,11 @@ environment = EnvironmentManager(
 
 port = environment.get(key="port", default=12023, dtype=int)
 
+# run_nxlink_question_answer 在导入其它模块之前读取本项并执行 gevent monkey patch.
+# 只能在进程环境变量或本 dotenv 文件中设置, 不能在之后才加载的配置中修改.
+# 开启时 FAQ 分词不使用进程池 (fork 与 monkey patch 不兼容), faq_tokenize_num_workers 按 1 处理.
+gevent_monkey_patch = environment.get(key="gevent_monkey_patch", default=True, dtype=str2bool)
+
 
 nxlink_question_answer_dataset = environment.get(
     key="nxlink_question_answer_dataset",
@@ -28,10 +33,111 @@ nxlink_faq_filename = environment.get(
     dtype=str
 )
 
+# faq 检索后端: elasticsearch, bm25
+faq_retrieval_backend = environment.get(key="faq_retrieval_backend", default="elasticsearch", dtype=str)
+
 elastic_host = environment.get(key="elastic_host", default="127.0.0.1", dtype=str)
 elastic_port = environment.get(key="elastic_port", default=9200, dtype=int)
 elastic_index = environment.get(key="elastic_index", default="nxlink_elasticsearch_retrieval_index", dtype=str)
 elastic_query_top_k = environment.get(key="elastic_query_top_k", default=5, dtype=int)
+# 等待其它 worker 构建同一版本索引的最长时间 (秒).
+elastic_build_wait_timeout = environment.get(key="elastic_build_wait_timeout", default=300, dtype=float)
+elastic_bulk_chunk_size = environment.get(key="elastic_bulk_chunk_size", default=500, dtype=int)
+elastic_bulk_thread_count = environment.get(key="elastic_bulk_thread_count", default=4, dtype=int)
+
+# FAQ 分词进程数, 小于等于 1 时在当前进程分词. gevent monkey patch 之后不使用进程池.
+faq_tokenize_num_workers = environment.get(key="faq_tokenize_num_workers", default=1, dtype=int)
+faq_tokenize_batch_size = environment.get(key="faq_tokenize_batch_size", default=2000, dtype=int)
+
+bm25_query_top_k = environment.get(key="bm25_query_top_k", default=5, dtype=int)
+
+# 向量检索 (sentence_embedding_model), 与关键词检索并发执行, 以 RRF 合并后取 faq_hybrid_top_k 条.
+# 启用后 score 为 RRF 得分 (约 0.01 ~ 0.03), faq_retrieval_only_min_score 需要相应调整.
+faq_dense_retrieval_enable = environment.get(key="faq_dense_retrieval_enable", default=False, dtype=str2bool)
+faq_dense_query_top_k = environment.get(key="faq_dense_query_top_k", default=10, dtype=int)
+faq_dense_min_score = environment.get(key="faq_dense_min_score", default=0.3, dtype=float)
+faq_hybrid_top_k = environment.get(key="faq_hybrid_top_k", default=3, dtype=int)
+faq_hybrid_rrf_k = environment.get(key="faq_hybrid_rrf_k", default=60, dtype=int)
+# 向量索引类型: flat (精确检索), ivf (近似检索, 适用于百万级问答).
+# faq_dense_ivf_nlist 为 0 时取 4 * sqrt(n). faq_dense_ivf_nprobe 越大召回率越高, 延迟越大.
+faq_dense_index_type = environment.get(key="faq_dense_index_type", default="flat", dtype=str)
+faq_dense_ivf_nlist = environment.get(key="faq_dense_ivf_nlist", default=0, dtype=int)
+faq_dense_ivf_nprobe = environment.get(key="faq_dense_ivf_nprobe", default=16, dtype=int)
+# int8 快照同时保存 float32 向量, 以 float32 对 top 候选重打分. 磁盘与页缓存占用为只保存 int8 时的 5 倍.
+faq_dense_keep_float = environment.get(key="faq_dense_keep_float", default=False, dtype=str2bool)
+
+# FAQ 分词结果的本地快照目录, FAQ 文件未变化时重启不再分词. 空字符串表示不使用快照.
+faq_snapshot_directory = environment.get(
+    key="faq_snapshot_directory",
+    default=os.path.join(project_path, "cache/nxlink_question_answer/snapshot"),
+    dtype=str
+)
+
+# jieba 词典缓存目录. 领域词表与前缀词典 (pickle) 缓存在此目录中, 启动时直接加载.
+tokenizer_cache_directory = environment.get(
+    key="tokenizer_cache_directory",
+    default=os.path.join(project_path, "cache/nxlink_question_answer/tokenizer"),
+    dtype=str
+)
+# 从 FAQ 问题与 Markdown 标题中挖掘领域词 (如 企业微信, nxlink), 加入 jieba 词典.
+tokenizer_domain_words_enable = environment.get(key="tokenizer_domain_words_enable", default=True, dtype=str2bool)
+tokenizer_domain_words_min_count = environment.get(key="tokenizer_domain_words_min_count", default=2, dtype=int)
+# query 分词与归一化结果的 LRU 大小.
+tokenizer_cache_max_size = environment.get(key="tokenizer_cache_max_size", default=10000, dtype=int)
+# 人工维护的用户词表, 每行一个词. 空字符串表示不使用.
+tokenizer_user_words_file = environment.get(key="tokenizer_user_words_file", default="", dtype=str)
+
+# 启动时预热: 构建索引与服务实例, 执行一次检索. 预热完成前 /NXLinkQA/ready 返回 503.
+warm_up_enable = environment.get(key="warm_up_enable", default=True, dtype=str2bool)
+
+# query 与标准问题归一化后完全相同时, 直接返回标准答案.
+faq_exact_match_enable = environment.get(key="faq_exact_match_enable", default=True, dtype=str2bool)
+
+# 检索 top1 得分不低于 min_score, 且 (top1 - top2) / top1 不低于 min_margin 时, 不调用 LLM, 直接返回 top1 答案.
+faq_retrieval_only_enable = environment.get(key="faq_retrieval_only_enable", default=False, dtype=str2bool)
+faq_retrieval_only_min_score = environment.get(key="faq_retrieval_only_min_score", default=10.0, dtype=float)
+faq_retrieval_only_min_margin = environment.get(key="faq_retrieval_only_min_margin", default=0.5, dtype=float)
+
+# LLM 调用超时 (秒). 超时, 出错或熔断时退回 top1 答案.
+llm_timeout = environment.get(key="llm_timeout", default=30.0, dtype=float)
+# LLM, 检索的最大并发调用数, 超出的调用排队.
+llm_max_workers = environment.get(key="llm_max_workers", default=16, dtype=int)
+retrieval_max_workers = environment.get(key="retrieval_max_workers", default=32, dtype=int)
+# 批量问答时, 每次 completion 请求包含的 prompt 数.
+llm_batch_size = environment.get(key="llm_batch_size", default=8, dtype=int)
+llm_circuit_breaker_failure_threshold = environment.get(key="llm_circuit_breaker_failure_threshold", default=5, dtype=int)
+llm_circuit_breaker_recovery_timeout = environment.get(key="llm_circuit_breaker_recovery_timeout", default=30.0, dtype=float)
+
+# 答案缓存, ttl 单位为秒.
+answer_cache_enable = environment.get(key="answer_cache_enable", default=True, dtype=str2bool)
+answer_cache_max_size = environment.get(key="answer_cache_max_size", default=10000, dtype=int)
+answer_cache_ttl = environment.get(key="answer_cache_ttl", default=3600, dtype=float)
+
+# sentence-transformers 向量模型, 在 CPU 上运行.
+sentence_embedding_model = environment.get(
+    key="sentence_embedding_model",
+    default="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+    dtype=str
+)
+
+# 语义缓存, 余弦相似度不低于 threshold 时复用缓存的答案.
+semantic_cache_enable = environment.get(key="semantic_cache_enable", default=False, dtype=str2bool)
+semantic_cache_max_size = environment.get(key="semantic_cache_max_size", default=2048, dtype=int)
+semantic_cache_threshold = environment.get(key="semantic_cache_threshold", default=0.92, dtype=float)
+
+# 合并相同 query 的并发请求.
+single_flight_enable = environment.get(key="single_flight_enable", default=True, dtype=str2bool)
+
+# 准入控制: 最大并发请求数, 最大排队数, 最长排队时间 (秒). 超出时返回 503 与 Retry-After.
+admission_max_in_flight = environment.get(key="admission_max_in_flight", default=64, dtype=int)
+admission_max_queue_size = environment.get(key="admission_max_queue_size", default=128, dtype=int)
+admission_queue_timeout = environment.get(key="admission_queue_timeout", default=2.0, dtype=float)
+admission_retry_after = environment.get(key="admission_retry_after", default=1, dtype=float)
+
+# 按客户端限流: 每秒 rate 个请求, 最多突发 burst 个. 超出时返回 429 与 Retry-After.
+rate_limit_enable = environment.get(key="rate_limit_enable", default=False, dtype=str2bool)
+rate_limit_rate = environment.get(key="rate_limit_rate", default=5.0, dtype=float)
+rate_limit_burst = environment.get(key="rate_limit_burst", default=10.0, dtype=float)
 
 
 faq_prefix_prompt_str = """
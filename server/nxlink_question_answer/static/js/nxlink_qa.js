@@ -1,21 +1,58 @@
 
 
-//click event
-var when_click_search = function () {
-
-  var element_search_button = $("#search");
-
-  if (element_search_button.text() === "running") {
-    alert("please wait this running finish.")
-    return null;
+//render
+var render_faq_recall = function (faq_recall) {
+  var element_nxlink_faq_workspace_table = $("#nxlink_faq_workspace_table");
+  element_nxlink_faq_workspace_table.empty();
+
+  element_nxlink_faq_workspace_table.append(`
+  <thead>
+    <tr>
+      <td>score</td>
+      <td>question</td>
+      <td>answer</td>
+      <td>filename</td>
+      <td>header</td>
+      <td>product</td>
+    </tr>
+  </thead>
+  `)
+
+  for (var i=0; i<faq_recall.length; i++)
+  {
+    if (i % 2 === 0) {
+      element_nxlink_faq_workspace_table.append(`
+          <tr class="alt">
+            <td>${faq_recall[i]['score']}</td>
+            <td>${faq_recall[i]['question']}</td>
+            <td>${faq_recall[i]['answer']}</td>
+            <td>${faq_recall[i]['filename']}</td>
+            <td>${faq_recall[i]['header']}</td>
+            <td>${faq_recall[i]['product']}</td>
+          </tr>
+        `)
+    } else {
+      element_nxlink_faq_workspace_table.append(`
+          <tr>
+            <td>${faq_recall[i]['score']}</td>
+            <td>${faq_recall[i]['question']}</td>
+            <td>${faq_recall[i]['answer']}</td>
+            <td>${faq_recall[i]['filename']}</td>
+            <td>${faq_recall[i]['header']}</td>
+            <td>${faq_recall[i]['product']}</td>
+          </tr>
+        `)
+    }
   }
+}
 
-  //var
-  var query = $("#query").val();
+
+//query
+var query_by_ajax = function (query) {
+  var element_search_button = $("#search");
 
   var url = "NXLinkQA/query";
 
-  element_search_button.text("running");
   $.ajax({
     async: true,
     type: "POST",
@@ -29,48 +66,7 @@ var when_click_search = function () {
       element_search_button.text("search");
 
       //recall
-      var element_nxlink_faq_workspace_table = $("#nxlink_faq_workspace_table");
-      element_nxlink_faq_workspace_table.empty();
-
-      element_nxlink_faq_workspace_table.append(`
-      <thead>
-        <tr>
-          <td>score</td>
-          <td>question</td>
-          <td>answer</td>
-          <td>filename</td>
-          <td>header</td>
-          <td>product</td>
-        </tr>
-      </thead>
-      `)
-
-      for (var i=0; i<js.result.faq_recall.length; i++)
-      {
-        if (i % 2 === 0) {
-          element_nxlink_faq_workspace_table.append(`
-              <tr class="alt">
-                <td>${js.result.faq_recall[i]['score']}</td>
-                <td>${js.result.faq_recall[i]['question']}</td>
-                <td>${js.result.faq_recall[i]['answer']}</td>
-                <td>${js.result.faq_recall[i]['filename']}</td>
-                <td>${js.result.faq_recall[i]['header']}</td>
-                <td>${js.result.faq_recall[i]['product']}</td>
-              </tr>
-            `)
-        } else {
-          element_nxlink_faq_workspace_table.append(`
-              <tr>
-                <td>${js.result.faq_recall[i]['score']}</td>
-                <td>${js.result.faq_recall[i]['question']}</td>
-                <td>${js.result.faq_recall[i]['answer']}</td>
-                <td>${js.result.faq_recall[i]['filename']}</td>
-                <td>${js.result.faq_recall[i]['header']}</td>
-                <td>${js.result.faq_recall[i]['product']}</td>
-              </tr>
-            `)
-        }
-      }
+      render_faq_recall(js.result.faq_recall);
 
       // answer
       var element_answer = $("#answer");
@@ -86,6 +82,100 @@ var when_click_search = function () {
 }
 
 
+//server-sent events: faq_recall, token, done, error
+var query_by_stream = function (query) {
+  var element_search_button = $("#search");
+  var element_answer = $("#answer");
+
+  var url = "NXLinkQA/query_stream";
+
+  var form_data = new FormData();
+  form_data.append("query", query);
+
+  var answer = "";
+  var handle_event = function (event, data) {
+    if (event === "faq_recall") {
+      render_faq_recall(data.faq_recall);
+    } else if (event === "token") {
+      answer += data.text;
+      element_answer.text(answer);
+    } else if (event === "done") {
+      element_answer.text(data.answer);
+    } else if (event === "error") {
+      console.log(`url: ${url}, event: ${event}, data: ${JSON.stringify(data)}`);
+      alert(data.message);
+    }
+  }
+
+  element_answer.text("");
+  fetch(url, {method: "POST", body: form_data}).then(function (response) {
+    if (!response.ok) {
+      return response.json().then(function (js) {
+        throw new Error(js.message);
+      });
+    }
+
+    var reader = response.body.getReader();
+    var decoder = new TextDecoder("utf-8");
+    var buffer = "";
+
+    var read = function () {
+      return reader.read().then(function (chunk) {
+        if (chunk.done) {
+          return;
+        }
+        buffer += decoder.decode(chunk.value, {stream: true});
+
+        var blocks = buffer.split("\n\n");
+        buffer = blocks.pop();
+        for (var i=0; i<blocks.length; i++) {
+          var event = "message";
+          var data = "";
+          var lines = blocks[i].split("\n");
+          for (var j=0; j<lines.length; j++) {
+            if (lines[j].startsWith("event: ")) {
+              event = lines[j].slice(7);
+            } else if (lines[j].startsWith("data: ")) {
+              data += lines[j].slice(6);
+            }
+          }
+          handle_event(event, JSON.parse(data));
+        }
+        return read();
+      });
+    }
+    return read();
+  }).catch(function (error) {
+    console.log(`url: ${url}, error: ${error}`);
+    alert(error.message);
+  }).finally(function () {
+    element_search_button.text("search");
+  });
+}
+
+
+//click event
+var when_click_search = function () {
+
+  var element_search_button = $("#search");
+
+  if (element_search_button.text() === "running") {
+    alert("please wait this running finish.")
+    return null;
+  }
+
+  //var
+  var query = $("#query").val();
+
+  element_search_button.text("running");
+  if (window.fetch && window.ReadableStream && window.TextDecoder) {
+    query_by_stream(query);
+  } else {
+    query_by_ajax(query);
+  }
+}
+
+
 $(document).ready(function(){
 
   $("#search").click(function(){
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+近似向量检索 (IVFIndex) 的基准测试.
+
+生成聚类分布的随机向量 (模拟问答的语义簇), 对比精确检索:
+(1)recall@k: IVF 结果与精确 top_k 的交集比例.
+(2)QPS: 单 query 逐条检索 (与线上查询方式一致).
+(3)build: 训练中心与建立倒排表的耗时.
+
+python3 ann_benchmark.py --sizes 10000 100000 1000000 --nprobe 1 4 16 64
+"""
+import argparse
+import os
+import sys
+import time
+
+pwd = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(pwd, '../../../'))
+
+import numpy as np
+
+from toolbox.retrieval.dense import l2_normalize, top_k_rows
+from toolbox.retrieval.ivf import IVFIndex
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=[10000, 100000, 1000000], nargs='+', type=int)
+    parser.add_argument('--dim', default=256, type=int)
+    parser.add_argument('--num_clusters', default=200, type=int)
+    parser.add_argument('--noise', default=0.8, type=float)
+    parser.add_argument('--num_queries', default=200, type=int)
+    parser.add_argument('--top_k', default=10, type=int)
+    parser.add_argument('--nprobe', default=[1, 4, 16, 64], nargs='+', type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+    return args
+
+
+def make_embeddings(rng: np.random.Generator,
+                    centers: np.ndarray,
+                    size: int,
+                    noise: float,
+                    block_size: int = 100000,
+                    ) -> np.ndarray:
+    """簇中心为单位向量, 噪声的模长约为 noise."""
+    embeddings = np.empty(shape=(size, centers.shape[1]), dtype=np.float32)
+    for begin in range(0, size, block_size):
+        end = min(begin + block_size, size)
+        labels = rng.integers(0, len(centers), size=end - begin)
+        offsets = rng.standard_normal(size=(end - begin, centers.shape[1]), dtype=np.float32)
+        offsets *= noise / np.sqrt(centers.shape[1])
+        embeddings[begin: end] = l2_normalize(centers[labels] + offsets)
+    return embeddings
+
+
+def exact_search(embeddings: np.ndarray, query_embeddings: np.ndarray, top_k: int, block_size: int = 100000):
+    """分块矩阵乘法, 合并各块的 top_k."""
+    best_ids = np.zeros(shape=(len(query_embeddings), 0), dtype=np.int64)
+    best_scores = np.zeros(shape=(len(query_embeddings), 0), dtype=np.float32)
+    for begin in range(0, len(embeddings), block_size):
+        scores = query_embeddings @ embeddings[begin: begin + block_size].T
+        ids, scores = top_k_rows(scores, top_k)
+        ids = np.concatenate([best_ids, ids + begin], axis=1)
+        scores = np.concatenate([best_scores, scores], axis=1)
+        order, best_scores = top_k_rows(scores, top_k)
+        best_ids = np.take_along_axis(ids, order, axis=1)
+    return best_ids
+
+
+def main():
+    args = get_args()
+    rng = np.random.default_rng(args.seed)
+    centers = rng.standard_normal(size=(args.num_clusters, args.dim)).astype(np.float32)
+    centers = l2_normalize(centers)
+
+    for size in args.sizes:
+        embeddings = make_embeddings(rng, centers, size, args.noise)
+        query_embeddings = make_embeddings(rng, centers, args.num_queries, args.noise)
+        expected = exact_search(embeddings, query_embeddings, args.top_k)
+
+        begin = time.perf_counter()
+        for query_embedding in query_embeddings:
+            scores = embeddings @ query_embedding
+            top_k_rows(scores[None, :], args.top_k)
+        exact_qps = len(query_embeddings) / (time.perf_counter() - begin)
+
+        begin = time.perf_counter()
+        index = IVFIndex().build(embeddings)
+        build_cost = time.perf_counter() - begin
+
+        print('size: {}, dim: {}, nlist: {}, build: {:.2f}s, float32: {:.1f}MB, int8: {:.1f}MB'.format(
+            size, args.dim, index.nlist, build_cost, embeddings.nbytes / 2**20, index._state[0][1].nbytes / 2**20
+        ))
+        print('  exact      qps: {:8.1f}'.format(exact_qps))
+        for nprobe in args.nprobe:
+            begin = time.perf_counter()
+            result = [index.search(query_embedding, top_k=args.top_k, nprobe=nprobe) for query_embedding in query_embeddings]
+            qps = len(query_embeddings) / (time.perf_counter() - begin)
+            recall = np.mean([
+                len(set(doc_ids.tolist()) & set(row.tolist())) / args.top_k
+                for (doc_ids, _), row in zip(result, expected)
+            ])
+            print('  nprobe {:3d} qps: {:8.1f}, recall@{}: {:.4f}'.format(nprobe, qps, args.top_k, recall))
+        del embeddings, index
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+并发基准测试.
+
+使用本地的 stand-in 服务模拟 Elasticsearch 与 LLM 的网络延迟 (不消耗 CPU),
+分别在 gevent monkey patch 开启/关闭时启动问答服务, 统计不同客户端并发数下的吞吐量.
+
+python3 concurrency_benchmark.py --concurrency 1 4 16 64
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+pwd = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(pwd, '../../../'))
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--role', default='benchmark', choices=['benchmark', 'upstream', 'server'], type=str)
+    parser.add_argument('--upstream_port', default=12091, type=int)
+    parser.add_argument('--server_port', default=12092, type=int)
+    parser.add_argument('--es_latency', default=0.02, type=float)
+    parser.add_argument('--llm_latency', default=0.5, type=float)
+    parser.add_argument('--concurrency', default=[1, 4, 16, 64], nargs='+', type=int)
+    parser.add_argument('--requests_per_client', default=4, type=int)
+    args = parser.parse_args()
+    return args
+
+
+def run_upstream(args):
+    """stand-in: GET /sleep?seconds=x, 协程 sleep 后返回 json."""
+    from gevent import pywsgi, sleep
+    from urllib.parse import parse_qs
+
+    def application(environ, start_response):
+        params = parse_qs(environ.get('QUERY_STRING', ''))
+        sleep(float(params.get('seconds', ['0'])[0]))
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [b'{"ok": true}']
+
+    server = pywsgi.WSGIServer(listener=('127.0.0.1', args.upstream_port), application=application, log=None)
+    server.serve_forever()
+
+
+def run_server(args):
+    # run_nxlink_question_answer 在导入时根据配置 gevent_monkey_patch 执行 monkey patch.
+    from server.nxlink_question_answer.run_nxlink_question_answer import flask_app
+    from gevent import pywsgi
+    import requests
+
+    from server.nxlink_question_answer.service import nxlink_qa
+
+    upstream = 'http://127.0.0.1:{}/sleep'.format(args.upstream_port)
+
+    class StandInFAQIndex(nxlink_qa.NXLinkFAQIndex):
+        index_version = 'stand_in'
+
+        def query(self, query: str, product: str = 'nxlink'):
+            requests.get(upstream, params={'seconds': args.es_latency})
+            return [{
+                'score': 1.0,
+                'question': query,
+                'answer': 'stand-in answer',
+                'filename': 'stand_in.md',
+                'header': '# stand-in',
+                'product': product,
+            }]
+
+    class StandInNXLinkQA(nxlink_qa.NXLinkQA):
+        def predict(self, query: str, faq_recall):
+            requests.get(upstream, params={'seconds': args.llm_latency})
+            return 'stand-in llm answer'
+
+    nxlink_qa._nxlink_qa_service = StandInNXLinkQA(
+        faq_elastic_index=StandInFAQIndex(),
+        openai_api_key='stand_in',
+        llm_timeout=60,
+        llm_max_workers=256,
+        retrieval_max_workers=256,
+    )
+
+    server = pywsgi.WSGIServer(listener=('127.0.0.1', args.server_port), application=flask_app, log=None)
+    server.serve_forever()
+
+
+def wait_for_port(port: int, timeout: float = 30):
+    import socket
+
+    begin = time.time()
+    while time.time() - begin < timeout:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise AssertionError('port not ready: {}'.format(port))
+
+
+def run_clients(args, concurrency: int) -> float:
+    from concurrent.futures import ThreadPoolExecutor
+    import requests
+
+    url = 'http://127.0.0.1:{}/NXLinkQA/query'.format(args.server_port)
+
+    def client(client_idx: int):
+        session = requests.Session()
+        for i in range(args.requests_per_client):
+            # 每个请求的 query 不同, 避免缓存与 single flight.
+            resp = session.post(url, data={'query': 'benchmark query {} {} {}'.format(concurrency, client_idx, i)})
+            assert resp.json()['status_code'] == 60200, resp.text
+
+    begin = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(client, range(concurrency)))
+    cost = time.time() - begin
+    return concurrency * args.requests_per_client / cost
+
+
+def benchmark(args):
+    script = os.path.abspath(__file__)
+    common = [
+        '--upstream_port', str(args.upstream_port),
+        '--server_port', str(args.server_port),
+        '--es_latency', str(args.es_latency),
+        '--llm_latency', str(args.llm_latency),
+    ]
+
+    upstream = subprocess.Popen([sys.executable, script, '--role', 'upstream'] + common)
+    wait_for_port(args.upstream_port)
+
+    result = dict()
+    try:
+        for patch in ['false', 'true']:
+            env = dict(os.environ, gevent_monkey_patch=patch)
+            server = subprocess.Popen([sys.executable, script, '--role', 'server'] + common, env=env)
+            try:
+                wait_for_port(args.server_port)
+                for concurrency in args.concurrency:
+                    qps = run_clients(args, concurrency)
+                    result[(patch, concurrency)] = qps
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+    print('es_latency: {}s, llm_latency: {}s'.format(args.es_latency, args.llm_latency))
+    print('{:>12} {:>16} {:>16}'.format('concurrency', 'no_patch qps', 'monkey_patch qps'))
+    for concurrency in args.concurrency:
+        print('{:>12} {:>16.2f} {:>16.2f}'.format(
+            concurrency, result[('false', concurrency)], result[('true', concurrency)]
+        ))
+    return
+
+
+def main():
+    args = get_args()
+    if args.role == 'upstream':
+        run_upstream(args)
+    elif args.role == 'server':
+        run_server(args)
+    else:
+        benchmark(args)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+启动耗时分析.
+
+在子进程中以 python -X importtime 导入服务入口模块, 统计导入耗时, 按顶层包汇总 self 耗时.
+(1)--budget: 导入耗时 (多次运行取最小值) 超过预算 (秒) 时, 以非零状态码退出. CI 的回归检查见 tests/test_startup_budget.py.
+(2)--forbid: 入口模块导入时不应加载的重量级依赖, 被加载时以非零状态码退出.
+
+python3 startup_profile.py --budget 1.5
+"""
+import argparse
+from collections import defaultdict
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+pwd = os.path.abspath(os.path.dirname(__file__))
+project_path = os.path.abspath(os.path.join(pwd, '../../../'))
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='server.nxlink_question_answer.run_nxlink_question_answer', type=str)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--top_k', default=15, type=int)
+    parser.add_argument('--budget', default=None, type=float, help='seconds')
+    parser.add_argument(
+        '--forbid',
+        default=['langchain', 'elasticsearch', 'jieba', 'sentence_transformers', 'llama_index'],
+        nargs='*',
+        type=str
+    )
+    args = parser.parse_args()
+    return args
+
+
+def profile_import(module: str) -> Tuple[float, List[Tuple[str, int, int]]]:
+    """
+    :return: (wall time in seconds, [(module name, self us, cumulative us), ...])
+    """
+    code = 'import time; begin = time.perf_counter(); import {}; print(time.perf_counter() - begin)'.format(module)
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=project_path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if process.returncode != 0:
+        raise AssertionError('import failed: {}\n{}'.format(module, process.stderr[-4000:]))
+
+    wall_time = float(process.stdout.strip().splitlines()[-1])
+
+    records = list()
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        # import time:       196 |      49151 |       flask.globals
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        records.append((name.strip(), int(self_us), int(cumulative_us)))
+    return wall_time, records
+
+
+def main():
+    args = get_args()
+
+    wall_times = list()
+    records = list()
+    for _ in range(args.repeat):
+        wall_time, records = profile_import(args.module)
+        wall_times.append(wall_time)
+    wall_time = min(wall_times)
+
+    package_cost: Dict[str, int] = defaultdict(int)
+    for name, self_us, _ in records:
+        package_cost[name.split('.')[0]] += self_us
+
+    print('module: {}'.format(args.module))
+    print('import wall time: {:.3f}s (min of {})'.format(wall_time, args.repeat))
+    print('modules imported: {}'.format(len(records)))
+
+    print('\n{:>10}  {}'.format('self [ms]', 'top-level package'))
+    for package, cost in sorted(package_cost.items(), key=lambda x: x[1], reverse=True)[:args.top_k]:
+        print('{:>10.1f}  {}'.format(cost / 1000, package))
+
+    print('\n{:>10}  {:>10}  {}'.format('self [ms]', 'cum [ms]', 'module'))
+    for name, self_us, cumulative_us in sorted(records, key=lambda x: x[1], reverse=True)[:args.top_k]:
+        print('{:>10.1f}  {:>10.1f}  {}'.format(self_us / 1000, cumulative_us / 1000, name))
+
+    failed = False
+    imported = set(package_cost.keys())
+    forbidden = sorted(imported & set(args.forbid))
+    if len(forbidden) != 0:
+        print('\nFAIL: heavy dependencies imported at startup: {}'.format(forbidden))
+        failed = True
+    if args.budget is not None:
+        if wall_time > args.budget:
+            print('\nFAIL: import wall time {:.3f}s exceeds budget {:.3f}s'.format(wall_time, args.budget))
+            failed = True
+        else:
+            print('\nOK: import wall time {:.3f}s within budget {:.3f}s'.format(wall_time, args.budget))
+
+    if failed:
+        sys.exit(1)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+query 分词的微基准测试.
+
+从 FAQ 问题中按 Zipf 分布采样 query (少数问题反复出现), 对比:
+(1)baseline: 每次 str.lower() + jieba lcut.
+(2)cached: CachedTokenizer.tokenize, LRU 记忆化.
+
+python3 tokenization_benchmark.py --nxlink_faq_file ../../../data/nxlink_question_answer/nxlink_faq.jsonl
+"""
+import argparse
+import os
+import sys
+import time
+
+pwd = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(pwd, '../../../'))
+
+import numpy as np
+
+from toolbox.text.tokenizer import CachedTokenizer, JiebaTokenizer
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nxlink_faq_file', default=None, type=str)
+    parser.add_argument('--num_queries', default=20000, type=int)
+    parser.add_argument('--zipf_a', default=1.2, type=float)
+    parser.add_argument('--cache_max_size', default=10000, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+    return args
+
+
+def load_questions(nxlink_faq_file: str):
+    if nxlink_faq_file is None:
+        return [
+            '怎样注册 Facebook 账号？', 'facebook注册官网是多少', '什么是NXLink ?', 'WhatsApp 账号如何认证？',
+            '企业微信渠道如何配置', '短信营销的计费方式', 'Viber 账号被封怎么办', '如何开通 RCS 富媒体消息',
+        ]
+    from server.nxlink_question_answer.service.nxlink_qa import iter_nxlink_faq
+    return sorted(set(row['question'] for row in iter_nxlink_faq(nxlink_faq_file)))
+
+
+def main():
+    args = get_args()
+
+    questions = load_questions(args.nxlink_faq_file)
+    rng = np.random.default_rng(args.seed)
+    ranks = rng.zipf(args.zipf_a, size=args.num_queries) - 1
+    queries = [questions[rank % len(questions)] for rank in ranks.tolist()]
+
+    tokenizer = JiebaTokenizer()
+    tokenizer.initialize()
+    cached_tokenizer = CachedTokenizer(tokenizer=tokenizer, max_size=args.cache_max_size)
+
+    begin = time.perf_counter()
+    for query in queries:
+        tokenizer.lcut(query)
+    baseline_cost = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    for query in queries:
+        cached_tokenizer.tokenize(query)
+    cached_cost = time.perf_counter() - begin
+
+    stats = cached_tokenizer.stats()['tokenize']
+    print('questions: {}, queries: {}, distinct queries: {}'.format(len(questions), len(queries), len(set(queries))))
+    print('baseline: {:.2f}us/query'.format(baseline_cost / len(queries) * 1e6))
+    print('cached:   {:.2f}us/query, hit_rate: {}'.format(cached_cost / len(queries) * 1e6, stats['hit_rate']))
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -1,36 +1,46 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
+import json
 import logging
 import os
 from typing import List
 
-from flask import render_template, request
+from flask import Response, render_template, request, stream_with_context
 import jsonschema
-import requests
 
 from server.exception import ExpectedError
+from server.flask_server.route_wrap.admission_route_wrap import AdmissionController, ClientRateLimiter, admission_route_wrap
 from server.flask_server.route_wrap.common_route_wrap import common_route_wrap
+from server.nxlink_question_answer import settings
 from server.nxlink_question_answer.schema import nxlink_qa
-from server.nxlink_question_answer.service.nxlink_qa import get_nxlink_qa_instance
+from server.nxlink_question_answer.service.nxlink_qa import get_nxlink_qa_instance, readiness
 
 from toolbox.logging.misc import json_2_str
+from toolbox.metrics.span import Trace
 
 
 logger = logging.getLogger("server")
 
+admission_controller = AdmissionController(
+    max_in_flight=settings.admission_max_in_flight,
+    max_queue_size=settings.admission_max_queue_size,
+    queue_timeout=settings.admission_queue_timeout,
+    retry_after=settings.admission_retry_after,
+)
+
+rate_limiter = ClientRateLimiter(
+    rate=settings.rate_limit_rate,
+    burst=settings.rate_limit_burst,
+) if settings.rate_limit_enable else None
+
 
 def nxlink_qa_page():
     return render_template("nxlink_qa.html")
 
 
-@common_route_wrap
-def query_view_func():
-    args = request.form
-    logger.info("query_view_func, args: {}".format(json_2_str(args)))
-
-    # request body verification
+def validate_request_body(args, schema: dict):
     try:
-        jsonschema.validate(args, nxlink_qa.nxlink_qa_request_schema)
+        jsonschema.validate(args, schema)
     except (jsonschema.exceptions.ValidationError,
             jsonschema.exceptions.SchemaError, ) as e:
         raise ExpectedError(
@@ -39,11 +49,156 @@ def query_view_func():
             detail=str(e)
         )
 
+
+@admission_route_wrap(admission_controller=admission_controller, rate_limiter=rate_limiter)
+@common_route_wrap
+def query_view_func():
+    args = request.form
+    logger.info("query_view_func, args: {}".format(json_2_str(args)))
+
+    # request body verification
+    validate_request_body(args, nxlink_qa.nxlink_qa_request_schema)
+
     query = args['query']
     service = get_nxlink_qa_instance()
 
-    result = service.query(query)
+    with Trace() as trace:
+        result = service.query(query)
+
+    result = {
+        "result": result,
+        "debug": {
+            "time_cost": trace.to_dict(),
+        }
+    }
+    return result
+
+
+@admission_route_wrap(admission_controller=admission_controller, rate_limiter=rate_limiter)
+@common_route_wrap
+def batch_query_view_func():
+    """
+    请求体为 json: {"queries": [...]}. 也支持 form 表单, queries 为 json 字符串.
+    """
+    args = request.get_json(silent=True)
+    if args is None:
+        args = dict(request.form)
+        if "queries" in args:
+            try:
+                args["queries"] = json.loads(args["queries"])
+            except json.JSONDecodeError as e:
+                raise ExpectedError(
+                    status_code=60401,
+                    message="request body invalid. ",
+                    detail=str(e)
+                )
+    logger.info("batch_query_view_func, args: {}".format(json_2_str(args)))
+
+    # request body verification
+    validate_request_body(args, nxlink_qa.nxlink_qa_batch_request_schema)
 
+    queries = args['queries']
+    service = get_nxlink_qa_instance()
+
+    with Trace() as trace:
+        results = service.batch_query(queries)
+
+    result = {
+        "result": {
+            "results": results,
+        },
+        "debug": {
+            "time_cost": trace.to_dict(),
+        }
+    }
+    return result
+
+
+@admission_route_wrap(admission_controller=admission_controller, rate_limiter=rate_limiter)
+def query_stream_view_func():
+    """
+    server-sent events. 事件类型: faq_recall, token, done, error.
+    """
+    args = request.form
+    logger.info("query_stream_view_func, args: {}".format(json_2_str(args)))
+
+    try:
+        validate_request_body(args, nxlink_qa.nxlink_qa_request_schema)
+    except ExpectedError as e:
+        response = {
+            'status_code': e.status_code,
+            'result': None,
+            'message': e.message,
+            'detail': e.detail,
+            'traceback': e.traceback,
+        }
+        return response, 400
+
+    query = args['query']
+
+    def generate():
+        try:
+            service = get_nxlink_qa_instance()
+            for event in service.query_stream(query):
+                yield sse_format(event["event"], event["data"])
+        except ExpectedError as e:
+            yield sse_format("error", {
+                'status_code': e.status_code,
+                'message': e.message,
+                'detail': e.detail,
+            })
+        except Exception as e:
+            logger.exception("query_stream_view_func failed: {}".format(e))
+            yield sse_format("error", {
+                'status_code': 60500,
+                'message': str(e),
+                'detail': None,
+            })
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
+
+
+def sse_format(event: str, data) -> str:
+    data = json.dumps(data, ensure_ascii=False)
+    return "event: {}\ndata: {}\n\n".format(event, data)
+
+
+def ready_view_func():
+    """
+    readiness probe, 就绪时返回 200, 否则返回 503. 存活探针使用 /HeartBeat.
+    """
+    result = readiness()
+    if result["ready"]:
+        response = {
+            'status_code': 60200,
+            'result': result,
+            'message': 'success',
+            'detail': None,
+        }
+        return response, 200
+
+    response = {
+        'status_code': 60503,
+        'result': result,
+        'message': 'not ready. ',
+        'detail': result["error"],
+    }
+    return response, 503
+
+
+@common_route_wrap
+def stats_view_func():
+    service = get_nxlink_qa_instance()
+    result = service.stats()
+    result["admission"] = admission_controller.stats()
+    result["rate_limiter"] = rate_limiter.stats() if rate_limiter is not None else None
     return result
 
 
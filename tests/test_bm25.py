@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import math
+import unittest
+
+from toolbox.retrieval.bm25 import BM25Index
+
+
+class TestBM25Index(unittest.TestCase):
+    def setUp(self):
+        self.index = BM25Index().build([
+            ["a", "b"],
+            ["a", "c", "c", "d"],
+            ["e"],
+        ])
+
+    def test_lucene8_score(self):
+        # Lucene 8 BM25Similarity, 手工计算:
+        # N = 3, avgdl = 7 / 3. "c": df = 1, idf = ln(1 + (3 - 1 + 0.5) / (1 + 0.5)) = ln(8 / 3).
+        # doc 1: tf = 2, dl = 4, norm = 1.2 * (1 - 0.75 + 0.75 * 4 / (7 / 3)) = 1.842857...
+        # score = idf * tf / (tf + norm) = 0.510468...
+        idf = math.log(8 / 3)
+        norm = 1.2 * (0.25 + 0.75 * 4 / (7 / 3))
+        expected = idf * 2 / (2 + norm)
+        self.assertAlmostEqual(expected, 0.510468, places=5)
+
+        doc_ids, scores = self.index.search(["c"], top_k=3)
+        self.assertEqual(doc_ids.tolist(), [1])
+        self.assertAlmostEqual(float(scores[0]), expected, places=5)
+
+    def test_multi_term_score_is_sum(self):
+        # "a": df = 2, idf = ln(1 + 1.5 / 2.5). doc 0: tf = 1, dl = 2.
+        idf_a = math.log(1 + 1.5 / 2.5)
+        norm_0 = 1.2 * (0.25 + 0.75 * 2 / (7 / 3))
+        norm_1 = 1.2 * (0.25 + 0.75 * 4 / (7 / 3))
+        score_0 = idf_a / (1 + norm_0)
+        score_1 = idf_a / (1 + norm_1) + math.log(8 / 3) * 2 / (2 + norm_1)
+
+        scores = self.index.get_scores(["a", "c"])
+        self.assertAlmostEqual(float(scores[0]), score_0, places=5)
+        self.assertAlmostEqual(float(scores[1]), score_1, places=5)
+        self.assertEqual(float(scores[2]), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+服务入口模块的导入耗时预算. 耗时分解见 server/nxlink_question_answer/test/startup_profile.py.
+"""
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+project_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+ENTRY_MODULE = 'server.nxlink_question_answer.run_nxlink_question_answer'
+# 导入耗时预算 (秒), 多次运行取最小值.
+STARTUP_BUDGET = 1.5
+REPEAT = 3
+FORBIDDEN_PACKAGES = ['langchain', 'elasticsearch', 'jieba', 'sentence_transformers', 'llama_index']
+
+
+def import_entry_module():
+    """
+    在子进程中导入入口模块.
+    :return: (wall time in seconds, 已加载的 FORBIDDEN_PACKAGES)
+    """
+    code = (
+        'import json, sys, time\n'
+        'begin = time.perf_counter()\n'
+        'import {module}\n'
+        'cost = time.perf_counter() - begin\n'
+        'loaded = sorted(name for name in {forbidden} if name in sys.modules)\n'
+        'print(json.dumps([cost, loaded]))\n'
+    ).format(module=ENTRY_MODULE, forbidden=FORBIDDEN_PACKAGES)
+    process = subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=project_path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if process.returncode != 0:
+        raise AssertionError('import failed: {}\n{}'.format(ENTRY_MODULE, process.stderr[-4000:]))
+    cost, loaded = json.loads(process.stdout.strip().splitlines()[-1])
+    return cost, loaded
+
+
+@unittest.skipIf(
+    any(importlib.util.find_spec(name) is None for name in ['flask', 'gevent', 'dotenv']),
+    'server dependencies are not installed'
+)
+class TestStartupBudget(unittest.TestCase):
+    def test_startup_budget(self):
+        costs = list()
+        for _ in range(REPEAT):
+            cost, loaded = import_entry_module()
+            self.assertEqual(loaded, list(), 'heavy dependencies imported at startup: {}'.format(loaded))
+            costs.append(cost)
+        self.assertLessEqual(min(costs), STARTUP_BUDGET, 'import wall time {:.3f}s exceeds budget {:.3f}s'.format(
+            min(costs), STARTUP_BUDGET
+        ))
+
+
+if __name__ == '__main__':
+    unittest.main()
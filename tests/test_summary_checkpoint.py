@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import os
+from pathlib import Path
+import tempfile
+import unittest
+from unittest import mock
+
+try:
+    from llama_index.response.schema import Response
+    from llama_index.utils import globals_helper
+except ImportError:
+    Response = None
+
+if Response is not None:
+    from toolbox.llama_index.indices.markdown_index.summarizer import DocumentSummarizer
+    from toolbox.llama_index.readers.file.markdown_reader import MarkdownReader
+    from toolbox.llama_index.storage.summary_checkpoint import SummaryCheckpoint
+
+
+class MockSynthesizer(object):
+    def __init__(self):
+        self.queries = list()
+
+    def synthesize(self, query, nodes):
+        text = nodes[0].node.text
+        self.queries.append(text)
+        return Response(response="summary: {}".format(text))
+
+
+@unittest.skipIf(Response is None, "llama_index is not installed")
+class TestSummaryCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = Path(self.directory.name) / "a.md"
+        self.checkpoint_file = os.path.join(self.directory.name, "summary_checkpoint.jsonl")
+        # tiktoken 需要下载词表, 这里只用于估计 token 数.
+        patcher = mock.patch.object(globals_helper, "_tokenizer", str.split)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.directory.cleanup)
+
+    def summarize(self, text: str):
+        self.filename.write_text(text, encoding="utf-8")
+        documents = MarkdownReader().load_data(self.filename)
+        synthesizer = MockSynthesizer()
+        summarizer = DocumentSummarizer(
+            synthesizer,
+            checkpoint=SummaryCheckpoint(self.checkpoint_file, namespace="v1"),
+        )
+        summaries = {document.metadata["header"]: summary for document, summary in summarizer.iter_summaries(documents)}
+        return summaries, synthesizer.queries
+
+    def test_subsection_change_regenerates_parent(self):
+        summaries1, queries1 = self.summarize("# A\ntext a\n## B\ntext b\n# C\ntext c\n")
+        self.assertEqual(len(queries1), 3)
+
+        summaries2, queries2 = self.summarize("# A\ntext a\n## B\ntext b changed\n# C\ntext c\n")
+        # A 自身的文本未变化, 但合并后的文本包含 B, 需要重新生成.
+        self.assertEqual(len(queries2), 2)
+        self.assertNotEqual(summaries1["# A"], summaries2["# A"])
+        self.assertIn("text b changed", summaries2["# A"])
+        self.assertNotEqual(summaries1["## B"], summaries2["## B"])
+        self.assertEqual(summaries1["# C"], summaries2["# C"])
+
+        _, queries3 = self.summarize("# A\ntext a\n## B\ntext b changed\n# C\ntext c\n")
+        self.assertEqual(len(queries3), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+import numpy as np
+
+
+class SemanticCache(object):
+    """
+    语义缓存.
+
+    数据结构:
+    (1)最近 max_size 条 query 的归一化向量保存在一个连续的 float32 矩阵中, 以环形缓冲区 (FIFO) 的方式淘汰.
+    (2)values, expire_at 与矩阵的行一一对应.
+
+    检索方法:
+    (1)query 向量与矩阵做一次矩阵乘法得到余弦相似度, 取 top1.
+    (2)top1 相似度不低于 threshold 且未过期时命中.
+
+    """
+    def __init__(self,
+                 embed_fn: Callable[[List[str]], np.ndarray],
+                 max_size: int = 2048,
+                 threshold: float = 0.92,
+                 ttl: Optional[float] = None,
+                 ):
+        self.embed_fn = embed_fn
+        self.max_size = max_size
+        self.threshold = threshold
+        self.ttl = ttl if ttl is not None and ttl > 0 else None
+
+        self._embeddings: np.ndarray = None
+        self._values: List[Any] = [None] * max_size
+        self._expire_at = np.full(shape=(max_size,), fill_value=np.inf, dtype=np.float64)
+        self._valid = np.zeros(shape=(max_size,), dtype=bool)
+        self._cursor = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def embed(self, text: str) -> np.ndarray:
+        embedding = np.asarray(self.embed_fn([text])[0], dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        if norm > 0:
+            embedding = embedding / norm
+        return embedding
+
+    def get(self, embedding: np.ndarray) -> Any:
+        with self._lock:
+            if self._embeddings is None or not self._valid.any():
+                self.misses += 1
+                return None
+
+            scores = self._embeddings @ embedding
+            mask = self._valid & (self._expire_at > time.time())
+            scores = np.where(mask, scores, -np.inf)
+            idx = int(np.argmax(scores))
+            if scores[idx] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._values[idx]
+
+    def set(self, embedding: np.ndarray, value: Any):
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = np.zeros(shape=(self.max_size, len(embedding)), dtype=np.float32)
+            idx = self._cursor
+            self._embeddings[idx] = embedding
+            self._values[idx] = value
+            self._expire_at[idx] = time.time() + self.ttl if self.ttl is not None else np.inf
+            self._valid[idx] = True
+            self._cursor = (self._cursor + 1) % self.max_size
+
+    def clear(self):
+        with self._lock:
+            self._values = [None] * self.max_size
+            self._valid[:] = False
+            self._cursor = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": int(self._valid.sum()),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total > 0 else 0.0,
+        }
+
+
+def demo1():
+    def embed_fn(texts: List[str]):
+        # 字符袋向量, 仅用于演示.
+        result = np.zeros(shape=(len(texts), 256), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for c in text:
+                result[i, ord(c) % 256] += 1
+        return result
+
+    cache = SemanticCache(embed_fn=embed_fn, max_size=2, threshold=0.8)
+    cache.set(cache.embed("facebook注册官网"), "https://www.facebook.com")
+    print(cache.get(cache.embed("facebook 注册的官网是哪个")))
+    print(cache.get(cache.embed("whatsapp 认证")))
+    print(cache.stats())
+    return
+
+
+if __name__ == '__main__':
+    demo1()
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+
+class CircuitBreaker(object):
+    """
+    熔断器.
+
+    状态:
+    (1)closed: 正常放行. 连续失败 failure_threshold 次后进入 open.
+    (2)open: 拒绝请求. recovery_timeout 秒后进入 half_open.
+    (3)half_open: 只放行一个探测请求, 成功则 closed, 失败则重新 open.
+
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+
+        self._state = self.CLOSED
+        self._failure_count = 0
+        self._opened_at = 0.0
+        self._half_open_probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.time() - self._opened_at >= self.recovery_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.time() - self._opened_at < self.recovery_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._half_open_probing = False
+            # half_open
+            if self._half_open_probing:
+                return False
+            self._half_open_probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failure_count = 0
+            self._half_open_probing = False
+
+    def release(self):
+        """调用被放弃 (如客户端断开), 既不是成功也不是失败. 释放 half_open 的探测名额, 以便下一个请求探测."""
+        with self._lock:
+            self._half_open_probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failure_count += 1
+            if self._state == self.HALF_OPEN or self._failure_count >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.time()
+                self._half_open_probing = False
+
+
+def demo1():
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=0.1)
+    breaker.record_failure()
+    breaker.record_failure()
+    print(breaker.state, breaker.allow_request())
+    time.sleep(0.1)
+    print(breaker.state, breaker.allow_request(), breaker.allow_request())
+    breaker.record_success()
+    print(breaker.state)
+    return
+
+
+if __name__ == '__main__':
+    demo1()
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextvars
+import threading
+from typing import Callable, Optional
+
+
+class BlockingCallExecutor(object):
+    """
+    有界的阻塞调用执行器, 用于 Elasticsearch, LLM 等阻塞调用.
+
+    (1)最多 max_workers 个调用同时执行, 其余排队, 以限制对下游服务的并发.
+    (2)gevent monkey patch 之后, 工作线程是协程, 阻塞的网络 IO 会让出 hub. 否则为系统线程.
+    (3)call 支持超时, 超时后调用方不再等待, 工作线程中的调用会继续执行到结束.
+    (4)调用在提交方 contextvars 的副本中执行, 以便记录分阶段耗时等请求级的上下文.
+
+    """
+    def __init__(self, max_workers: int, name: str = "blocking_call"):
+        self.max_workers = max_workers
+        self.name = name
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+
+        self.submitted = 0
+        self.completed = 0
+
+    def _on_done(self, future: Future):
+        with self._lock:
+            self.completed += 1
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        with self._lock:
+            self.submitted += 1
+        context = contextvars.copy_context()
+        future = self._executor.submit(context.run, fn, *args, **kwargs)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def call(self, fn: Callable, *args, timeout: Optional[float] = None, **kwargs):
+        future = self.submit(fn, *args, **kwargs)
+        return future.result(timeout=timeout)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "pending": self.submitted - self.completed,
+        }
+
+
+if __name__ == '__main__':
+    pass
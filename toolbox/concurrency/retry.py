@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import logging
+import random
+import time
+from typing import Callable, Tuple, Type
+
+logger = logging.getLogger("toolbox")
+
+
+def get_backoff(attempt: int, backoff_factor: float = 1.0, max_backoff: float = 30.0) -> float:
+    """指数退避: backoff_factor * 2^attempt, 不超过 max_backoff. 乘以 [0.5, 1) 的随机数, 避免并发的调用同时重试."""
+    backoff = min(max_backoff, backoff_factor * (2 ** attempt))
+    return backoff * random.uniform(0.5, 1.0)
+
+
+def call_with_retry(fn: Callable,
+                    *args,
+                    max_retries: int = 3,
+                    backoff_factor: float = 1.0,
+                    max_backoff: float = 30.0,
+                    retry_exceptions: Tuple[Type[BaseException], ...] = (Exception,),
+                    before_attempt: Callable = None,
+                    **kwargs):
+    """
+    调用 fn, 抛出 retry_exceptions 时退避后重试, 最多重试 max_retries 次. 仍然失败时抛出最后一次的异常.
+
+    :param before_attempt: 每次调用 (包括重试) 之前执行, 如 TokenBucket.acquire 限流.
+    """
+    attempt = 0
+    while True:
+        if before_attempt is not None:
+            before_attempt()
+        try:
+            return fn(*args, **kwargs)
+        except retry_exceptions as e:
+            if attempt >= max_retries:
+                raise
+            backoff = get_backoff(attempt, backoff_factor=backoff_factor, max_backoff=max_backoff)
+            logger.warning("call {} failed (attempt {}/{}), retry in {:.2f}s: {}".format(
+                getattr(fn, "__name__", fn), attempt + 1, max_retries + 1, backoff, e
+            ))
+            time.sleep(backoff)
+            attempt += 1
+
+
+def demo1():
+    state = {"count": 0}
+
+    def flaky():
+        state["count"] += 1
+        if state["count"] < 3:
+            raise ConnectionError("count: {}".format(state["count"]))
+        return state["count"]
+
+    print(call_with_retry(flaky, max_retries=3, backoff_factor=0.1))
+    return
+
+
+if __name__ == '__main__':
+    demo1()
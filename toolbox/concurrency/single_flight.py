@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import threading
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception: BaseException = None
+        self.abandoned = False
+
+
+class SingleFlight(object):
+    """
+    合并相同 key 的并发调用.
+    同一时刻相同 key 只有一个调用 (leader) 真正执行 fn, 其余调用 (follower) 等待并共享其结果或异常.
+
+    备注:
+    (1)使用 threading 原语. 在 gevent monkey patch 之后, 它们是协程友好的, follower 等待时会让出 hub.
+    (2)不能用一次函数调用表示的 leader (如流式问答, 结果随生成器逐步产生) 使用 begin, wait, finish.
+    leader 放弃时 (如客户端断开) 以 abandoned=True 结束, follower 重新竞争 leader, 而不是得到一个失败.
+    """
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = dict()
+        self._lock = threading.Lock()
+
+        self.leaders = 0
+        self.coalesced = 0
+
+    def begin(self, key: Hashable) -> Tuple[_Call, bool]:
+        """
+        :return: (call, leader). leader 为 True 时, 调用方必须以 finish 结束该 call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+                return call, True
+            self.coalesced += 1
+            return call, False
+
+    @staticmethod
+    def wait(call: _Call) -> Tuple[Any, bool]:
+        """
+        :return: (result, abandoned). abandoned 为 True 时 leader 没有结果, 调用方应重新 begin.
+        """
+        call.event.wait()
+        if call.abandoned:
+            return None, True
+        if call.exception is not None:
+            raise call.exception
+        return call.result, False
+
+    def finish(self, key: Hashable, call: _Call, result: Any = None, exception: BaseException = None, abandoned: bool = False):
+        call.result = result
+        call.exception = exception
+        call.abandoned = abandoned
+        with self._lock:
+            del self._calls[key]
+        call.event.set()
+
+    def do(self, key: Hashable, fn: Callable, *args, **kwargs) -> Tuple[Any, bool]:
+        """
+        :return: (result, coalesced). coalesced 为 True 表示结果来自其它调用.
+        """
+        while True:
+            call, leader = self.begin(key)
+            if leader:
+                break
+            result, abandoned = self.wait(call)
+            if not abandoned:
+                return result, True
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.finish(key, call, exception=e)
+            raise
+        self.finish(key, call, result=result)
+        return result, False
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
+
+
+def demo1():
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    single_flight = SingleFlight()
+
+    def slow_square(x):
+        time.sleep(0.2)
+        return x * x
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(single_flight.do, "key", slow_square, 3) for _ in range(8)]
+        print([future.result() for future in futures])
+    print(single_flight.stats())
+    return
+
+
+if __name__ == '__main__':
+    demo1()
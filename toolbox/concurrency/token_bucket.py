@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import threading
+import time
+from typing import Optional
+
+
+class TokenBucket(object):
+    """
+    令牌桶限流.
+    令牌以 rate 个/秒的速度补充, 最多积累 capacity 个.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def time_until_available(self, tokens: float = 1) -> float:
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                return 0.0
+            if self.rate <= 0:
+                return float("inf")
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1, timeout: Optional[float] = None) -> bool:
+        """阻塞直到获得令牌. 超过 timeout 秒仍未获得时返回 False."""
+        begin = time.monotonic()
+        while True:
+            if self.try_acquire(tokens):
+                return True
+            wait = self.time_until_available(tokens)
+            if timeout is not None:
+                remain = timeout - (time.monotonic() - begin)
+                if remain <= 0 or wait > remain:
+                    return False
+            time.sleep(max(wait, 0.001))
+
+
+def demo1():
+    bucket = TokenBucket(rate=10, capacity=2)
+    print([bucket.try_acquire() for _ in range(3)])
+    print(round(bucket.time_until_available(), 2))
+    print(bucket.acquire(timeout=1))
+    return
+
+
+if __name__ == '__main__':
+    demo1()
@@ -1,7 +1,9 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 from collections import defaultdict
-from typing import Any, Dict, Generic, List, Optional, Sequence, Type, TypeVar
+import logging
+import threading
+from typing import Any, Dict, Generic, Iterable, List, Optional, Sequence, Tuple, Type, TypeVar
 
 from llama_index.data_structs.data_structs import IndexDict
 from llama_index.indices.base import BaseIndex, IndexType
@@ -9,8 +11,7 @@ from llama_index.indices.base_retriever import BaseRetriever
 from llama_index.indices.service_context import ServiceContext
 from llama_index.langchain_helpers.text_splitter import TokenTextSplitter
 from llama_index.node_parser.simple import SimpleNodeParser
-from llama_index.response.schema import Response
-from llama_index.response_synthesizers import BaseSynthesizer, get_response_synthesizer
+from llama_index.response_synthesizers import BaseSynthesizer, ResponseMode, get_response_synthesizer
 from llama_index.schema import (
     BaseNode, Document, ImageNode, IndexNode, MetadataMode,
     NodeRelationship, NodeWithScore,
@@ -22,13 +23,10 @@ from llama_index.storage.storage_context import StorageContext
 from llama_index.vector_stores.types import NodeWithEmbedding, VectorStore
 from tqdm import tqdm
 
+from toolbox.llama_index.indices.markdown_index.summarizer import DEFAULT_SUMMARY_QUERY, DocumentSummarizer
 from toolbox.llama_index.schema import EmbedTextNode
 
-
-DEFAULT_SUMMARY_QUERY = (
-    "Give a concise summary of this document. Also describe some of the questions "
-    "that this document can answer. "
-)
+logger = logging.getLogger("toolbox")
 
 
 class MarkDownIndex(BaseIndex[IndexDict]):
@@ -44,6 +42,15 @@ class MarkDownIndex(BaseIndex[IndexDict]):
     检索方法:
     (1)对各单元进行 summary 然后执行 embedding 向量召回.
 
+    构建:
+    (1)summary 由 DocumentSummarizer 执行, 可以配置并发数, 限流, 重试与检查点. 默认为单线程, 不限流, 无检查点.
+
+    增量更新:
+    (1)insert, delete_ref_doc, update_file, delete_file 同时维护 vector_store, docstore 与 index_struct.
+    (2)写操作之间由 self._lock 串行, 查询不加锁. MarkDownIndexRetriever 跳过查询过程中被删除的节点.
+    (3)update_file 先在锁外完成 summary 与 embedding, 再插入新节点, 最后删除旧节点, 查询期间该文件的内容不会缺失.
+    (4)MarkdownReader 每次解析生成新的 doc_id, 所以按文件 (metadata 中的 filename) 而不是按 doc_id 更新.
+
     """
 
     index_struct_cls = IndexDict
@@ -55,10 +62,20 @@ class MarkDownIndex(BaseIndex[IndexDict]):
         service_context: Optional[ServiceContext] = None,
         storage_context: Optional[StorageContext] = None,
         store_nodes_override: bool = False,
+        response_synthesizer: Optional[BaseSynthesizer] = None,
+        summary_query: str = DEFAULT_SUMMARY_QUERY,
+        summarizer: Optional[DocumentSummarizer] = None,
         show_progress: bool = False,
         **kwargs: Any,
     ) -> None:
         self._store_nodes_override = store_nodes_override
+        self._response_synthesizer = response_synthesizer
+        self._summary_query = summary_query
+        self._summarizer = summarizer
+        self._lock = threading.RLock()
+        # ref_doc_id -> RefDocInfo, node_id -> (text_id, ref_doc_id). 删除时不需要扫描 index_struct.
+        self._ref_doc_infos: Dict[str, RefDocInfo] = dict()
+        self._node_entries: Dict[str, Tuple[str, Optional[str]]] = dict()
         super().__init__(
             nodes=nodes,
             index_struct=index_struct,
@@ -67,6 +84,38 @@ class MarkDownIndex(BaseIndex[IndexDict]):
             show_progress=show_progress,
             **kwargs,
         )
+        if index_struct is not None:
+            self._load_node_entries()
+
+    def _load_node_entries(self) -> None:
+        """从已持久化的 index_struct 加载时, 按 docstore 中的节点建立 ref_doc_id 与 node_id 的映射, 只执行一次."""
+        text_ids = list(self._index_struct.nodes_dict.keys())
+        nodes = self._docstore.get_nodes([self._index_struct.nodes_dict[text_id] for text_id in text_ids])
+        for text_id, node in zip(text_ids, nodes):
+            self._track_node(node, text_id)
+
+    def _track_node(self, node: BaseNode, text_id: str) -> None:
+        if node.node_id in self._node_entries:
+            self._untrack_node(node.node_id)
+        ref_doc_id = node.ref_doc_id
+        self._node_entries[node.node_id] = (text_id, ref_doc_id)
+        if ref_doc_id is None:
+            return
+        if ref_doc_id not in self._ref_doc_infos:
+            self._ref_doc_infos[ref_doc_id] = RefDocInfo(node_ids=list(), metadata=node.metadata)
+        self._ref_doc_infos[ref_doc_id].node_ids.append(node.node_id)
+
+    def _untrack_node(self, node_id: str) -> Optional[str]:
+        entry = self._node_entries.pop(node_id, None)
+        if entry is None:
+            return None
+        text_id, ref_doc_id = entry
+        ref_doc_info = self._ref_doc_infos.get(ref_doc_id)
+        if ref_doc_info is not None:
+            ref_doc_info.node_ids.remove(node_id)
+            if len(ref_doc_info.node_ids) == 0:
+                self._ref_doc_infos.pop(ref_doc_id)
+        return text_id
 
     def _get_node_embedding_results(
         self,
@@ -116,6 +165,7 @@ class MarkDownIndex(BaseIndex[IndexDict]):
             for result, new_id in zip(embedding_results, new_ids):
                 index_struct.add_node(result.node, text_id=new_id)
                 self._docstore.add_documents([result.node], allow_update=True)
+                self._track_node(result.node, new_id)
         else:
             # NOTE: if the vector store keeps text,
             # we only need to add image and index nodes
@@ -123,6 +173,7 @@ class MarkDownIndex(BaseIndex[IndexDict]):
                 if isinstance(result.node, (ImageNode, IndexNode)):
                     index_struct.add_node(result.node, text_id=new_id)
                     self._docstore.add_documents([result.node], allow_update=True)
+                    self._track_node(result.node, new_id)
 
     def _build_index_from_nodes(self, nodes: Sequence[BaseNode]) -> IndexDict:
         index_struct = self.index_struct_cls()
@@ -131,91 +182,240 @@ class MarkDownIndex(BaseIndex[IndexDict]):
         )
         return index_struct
 
+    @staticmethod
+    def get_summarizer(
+        service_context: ServiceContext,
+        response_synthesizer: Optional[BaseSynthesizer] = None,
+        summary_query: str = DEFAULT_SUMMARY_QUERY,
+    ) -> DocumentSummarizer:
+        response_synthesizer = response_synthesizer or get_response_synthesizer(
+            service_context=service_context,
+            response_mode=ResponseMode.TREE_SUMMARIZE,
+        )
+        return DocumentSummarizer(response_synthesizer, summary_query=summary_query)
+
+    @classmethod
+    def get_nodes_from_document(
+        cls,
+        document: Document,
+        service_context: ServiceContext,
+        summary: Optional[str] = None,
+        show_progress: bool = False,
+    ) -> List[EmbedTextNode]:
+        """header=-1 的 Document 按 node_parser 切分, 其它的 Document 以 summary 做 embedding."""
+        if document.metadata["header"] == -1:
+            nodes_: List[TextNode] = service_context.node_parser.get_nodes_from_documents(
+                [document], show_progress=show_progress
+            )
+            nodes = list()
+            for node_ in nodes_:
+                node = EmbedTextNode(
+                    text=node_.text,
+                    embed_text=node_.text,
+                    embedding=node_.embedding,
+                    metadata=node_.metadata,
+                    excluded_embed_metadata_keys=node_.excluded_embed_metadata_keys,
+                    excluded_llm_metadata_keys=node_.excluded_llm_metadata_keys,
+                    metadata_seperator=node_.metadata_seperator,
+                    text_template=node_.text_template,
+                    relationships=node_.relationships,
+                )
+                nodes.append(node)
+            return nodes
+
+        if summary is None:
+            raise ValueError("summary is required for header document, doc_id: {}".format(document.doc_id))
+        node = EmbedTextNode(
+            text=document.text,
+            embed_text=summary,
+            embedding=document.embedding,
+            metadata=document.metadata,
+            excluded_embed_metadata_keys=document.excluded_embed_metadata_keys,
+            excluded_llm_metadata_keys=document.excluded_llm_metadata_keys,
+            metadata_seperator=document.metadata_seperator,
+            text_template=document.text_template,
+            relationships={
+                NodeRelationship.SOURCE: document.as_related_node_info()
+            },
+        )
+        return [node]
+
     @classmethod
     def from_documents(
         cls: Type[IndexType],
-        documents: Sequence[Document],
+        documents: Iterable[Document],
         storage_context: Optional[StorageContext] = None,
         service_context: Optional[ServiceContext] = None,
         response_synthesizer: Optional[BaseSynthesizer] = None,
         summary_query: str = DEFAULT_SUMMARY_QUERY,
+        summarizer: Optional[DocumentSummarizer] = None,
         show_progress: bool = False,
         **kwargs: Any,
     ) -> IndexType:
-
+        """
+        summarizer 为 None 时, 由 response_synthesizer, summary_query 创建单线程的 DocumentSummarizer.
+        """
         storage_context = storage_context or StorageContext.from_defaults()
         service_context = service_context or ServiceContext.from_defaults()
         docstore = storage_context.docstore
+        summarizer = summarizer or cls.get_summarizer(service_context, response_synthesizer, summary_query)
 
         with service_context.callback_manager.as_trace("index_construction"):
-            for doc in documents:
-                docstore.set_document_hash(doc.get_doc_id(), doc.hash)
-
+            # 只遍历一次 documents, 可以传入 iter_markdown_documents 等生成器.
+            # iter_summaries 按输入顺序返回, 节点顺序与 summarizer 的并发数无关.
             nodes = list()
-            for document in tqdm(documents):
-                if document.metadata["header"] == -1:
-                    nodes_: List[TextNode] = service_context.node_parser.get_nodes_from_documents(
-                        [document], show_progress=show_progress
-                    )
-                    for node_ in nodes_:
-                        node = EmbedTextNode(
-                            text=node_.text,
-                            embed_text=node_.text,
-                            embedding=node_.embedding,
-                            metadata=node_.metadata,
-                            excluded_embed_metadata_keys=node_.excluded_embed_metadata_keys,
-                            excluded_llm_metadata_keys=node_.excluded_llm_metadata_keys,
-                            metadata_seperator=node_.metadata_seperator,
-                            text_template=node_.text_template,
-                            relationships=node_.relationships,
-                        )
-                        nodes.append(node)
-                else:
-                    summary_response: Response = response_synthesizer.synthesize(
-                        query=summary_query,
-                        nodes=[NodeWithScore(node=document)],
-                    )
-                    node = EmbedTextNode(
-                        text=document.text,
-                        embed_text=summary_response.response,
-                        embedding=document.embedding,
-                        metadata=document.metadata,
-                        excluded_embed_metadata_keys=document.excluded_embed_metadata_keys,
-                        excluded_llm_metadata_keys=document.excluded_llm_metadata_keys,
-                        metadata_seperator=document.metadata_seperator,
-                        text_template=document.text_template,
-                        relationships={
-                            NodeRelationship.SOURCE: document.as_related_node_info()
-                        },
-                    )
-                    nodes.append(node)
+            for document, summary in tqdm(summarizer.iter_summaries(documents)):
+                docstore.set_document_hash(document.get_doc_id(), document.hash)
+                nodes.extend(cls.get_nodes_from_document(
+                    document,
+                    service_context=service_context,
+                    summary=summary,
+                    show_progress=show_progress,
+                ))
+        logger.info("summarizer stats: {}".format(summarizer.stats()))
 
         return cls(
             nodes=nodes,
             storage_context=storage_context,
             service_context=service_context,
+            response_synthesizer=response_synthesizer,
+            summary_query=summary_query,
+            summarizer=summarizer,
             show_progress=show_progress,
             **kwargs,
         )
 
-    def _delete_node(self, node_id: str, **delete_kwargs: Any) -> None:
-        pass
+    def _get_nodes_from_documents(self, documents: Sequence[Document]) -> List[BaseNode]:
+        """summary 与 embedding (耗时的 LLM 调用) 在锁外完成, 写入时只需要修改索引."""
+        if self._summarizer is None:
+            self._summarizer = self.get_summarizer(
+                self._service_context, self._response_synthesizer, self._summary_query
+            )
+        nodes = list()
+        for document, summary in self._summarizer.iter_summaries(documents):
+            nodes.extend(self.get_nodes_from_document(
+                document,
+                service_context=self._service_context,
+                summary=summary,
+            ))
+        for result in self._get_node_embedding_results(nodes):
+            result.node.embedding = result.embedding
+        return nodes
+
+    def insert(self, document: Document, **insert_kwargs: Any) -> None:
+        with self._service_context.callback_manager.as_trace("insert"):
+            nodes = self._get_nodes_from_documents([document])
+            with self._lock:
+                self.insert_nodes(nodes, **insert_kwargs)
+                self._docstore.set_document_hash(document.get_doc_id(), document.hash)
+
+    def insert_nodes(self, nodes: Sequence[BaseNode], **insert_kwargs: Any) -> None:
+        with self._lock:
+            super().insert_nodes(nodes, **insert_kwargs)
 
     def _insert(self, nodes: Sequence[BaseNode], **insert_kwargs: Any) -> None:
-        pass
+        self._add_nodes_to_index(self._index_struct, nodes)
+
+    def _delete_node(self, node_id: str, **delete_kwargs: Any) -> None:
+        """只从 index_struct 中删除. 向量库只能按 ref_doc_id 删除, 见 delete_ref_doc."""
+        with self._lock:
+            text_id = self._untrack_node(node_id)
+            if text_id is not None:
+                self._index_struct.delete(text_id)
+
+    def delete_nodes(
+        self,
+        node_ids: List[str],
+        delete_from_docstore: bool = False,
+        **delete_kwargs: Any,
+    ) -> None:
+        with self._lock:
+            super().delete_nodes(node_ids, delete_from_docstore=delete_from_docstore, **delete_kwargs)
+
+    def _delete_ref_docs(self, ref_doc_ids: List[str], delete_from_docstore: bool = False) -> None:
+        """
+        先从向量库中删除, 新的查询不再召回这些节点; 再从 index_struct 与 docstore 中删除.
+        """
+        with self._lock:
+            for ref_doc_id in ref_doc_ids:
+                self._vector_store.delete(ref_doc_id)
+                ref_doc_info = self._ref_doc_infos.get(ref_doc_id)
+                if ref_doc_info is None:
+                    continue
+                for node_id in list(ref_doc_info.node_ids):
+                    self._delete_node(node_id)
+                    if delete_from_docstore:
+                        self._docstore.delete_document(node_id, raise_error=False)
+                if delete_from_docstore:
+                    # 同时删除 set_document_hash 记录的 hash.
+                    self._docstore.delete_document(ref_doc_id, raise_error=False)
+
+            self._storage_context.index_store.add_index_struct(self._index_struct)
+
+    def delete_ref_doc(
+        self, ref_doc_id: str, delete_from_docstore: bool = False, **delete_kwargs: Any
+    ) -> None:
+        self._delete_ref_docs([ref_doc_id], delete_from_docstore=delete_from_docstore)
+
+    def update_ref_doc(self, document: Document, **update_kwargs: Any) -> None:
+        """doc_id 不变, 新旧节点的 ref_doc_id 相同, 只能先删除再插入. summary 与 embedding 在锁外完成, 删除与插入之间的间隔很短."""
+        with self._service_context.callback_manager.as_trace("update"):
+            nodes = self._get_nodes_from_documents([document])
+            with self._lock:
+                self.delete_ref_doc(document.get_doc_id(), **update_kwargs.pop("delete_kwargs", {}))
+                self.insert_nodes(nodes, **update_kwargs.pop("insert_kwargs", {}))
+                self._docstore.set_document_hash(document.get_doc_id(), document.hash)
+
+    def get_ref_doc_ids_by_filename(self, filename: str) -> List[str]:
+        return [ref_doc_id for ref_doc_id, ref_doc_info in self.ref_doc_info.items()
+                if ref_doc_info.metadata.get("filename") == filename]
+
+    def update_file(self, filename: str, documents: Sequence[Document]) -> None:
+        """
+        用 MarkdownReader 重新解析得到的 documents 替换文件 filename 的全部节点.
+        """
+        with self._service_context.callback_manager.as_trace("update_file"):
+            nodes = self._get_nodes_from_documents(documents)
+            with self._lock:
+                old_ref_doc_ids = self.get_ref_doc_ids_by_filename(filename)
+                self.insert_nodes(nodes)
+                for document in documents:
+                    self._docstore.set_document_hash(document.get_doc_id(), document.hash)
+                self._delete_ref_docs(old_ref_doc_ids, delete_from_docstore=True)
+        logger.info("update file: {}, documents: {}, nodes: {}, deleted ref docs: {}".format(
+            filename, len(documents), len(nodes), len(old_ref_doc_ids)
+        ))
+
+    def delete_file(self, filename: str) -> None:
+        with self._lock:
+            old_ref_doc_ids = self.get_ref_doc_ids_by_filename(filename)
+            self._delete_ref_docs(old_ref_doc_ids, delete_from_docstore=True)
+        logger.info("delete file: {}, deleted ref docs: {}".format(filename, len(old_ref_doc_ids)))
 
     def as_retriever(self, **kwargs: Any) -> BaseRetriever:
         # NOTE: lazy import
-        from llama_index.indices.vector_store.retrievers import VectorIndexRetriever
+        from toolbox.llama_index.indices.markdown_index.retriever import MarkDownIndexRetriever
 
-        return VectorIndexRetriever(
+        return MarkDownIndexRetriever(
             self,
             **kwargs,
         )
 
     @property
     def ref_doc_info(self) -> Dict[str, RefDocInfo]:
-        raise NotImplementedError
+        """
+        EmbedTextNode 不是 TextNode, docstore.add_documents 不记录其 RefDocInfo. 这里返回插入与删除时维护的 ref_doc_id 映射的副本.
+        """
+        if self._vector_store.stores_text and not self._store_nodes_override:
+            raise NotImplementedError(
+                "Vector store integrations that store text in the vector store are "
+                "not supported by ref_doc_info yet."
+            )
+        with self._lock:
+            return {
+                ref_doc_id: RefDocInfo(node_ids=list(ref_doc_info.node_ids), metadata=ref_doc_info.metadata)
+                for ref_doc_id, ref_doc_info in self._ref_doc_infos.items()
+            }
 
     @property
     def vector_store(self) -> VectorStore:
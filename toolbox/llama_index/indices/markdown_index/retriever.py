@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import logging
+from typing import List
+
+from llama_index.indices.query.schema import QueryBundle
+from llama_index.indices.utils import log_vector_store_query_result
+from llama_index.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.schema import NodeWithScore
+from llama_index.vector_stores.types import VectorStoreQuery
+
+logger = logging.getLogger("toolbox")
+
+
+class MarkDownIndexRetriever(VectorIndexRetriever):
+    """
+    MarkDownIndex 的向量召回.
+
+    备注:
+    (1)与 VectorIndexRetriever 相同, 只是容忍召回到的节点在查询过程中被删除.
+    MarkDownIndex 增量更新时不阻塞查询, 向量库返回 id 之后, 该节点可能已从 index_struct 或 docstore 中删除, 此时跳过该节点.
+    (2)向量库保存文本 (stores_text) 时不经过 index_struct 与 docstore, 直接使用 VectorIndexRetriever 的实现.
+
+    """
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if self._vector_store.stores_text:
+            return super()._retrieve(query_bundle)
+
+        if self._vector_store.is_embedding_query:
+            if query_bundle.embedding is None:
+                query_bundle.embedding = (
+                    self._service_context.embed_model.get_agg_embedding_from_queries(
+                        query_bundle.embedding_strs
+                    )
+                )
+
+        query = VectorStoreQuery(
+            query_embedding=query_bundle.embedding,
+            similarity_top_k=self._similarity_top_k,
+            node_ids=self._node_ids,
+            doc_ids=self._doc_ids,
+            query_str=query_bundle.query_str,
+            mode=self._vector_store_query_mode,
+            alpha=self._alpha,
+            filters=self._filters,
+        )
+        query_result = self._vector_store.query(query, **self._kwargs)
+        if query_result.ids is None:
+            raise ValueError("Vector store query result should return ids.")
+
+        nodes_dict = self._index.index_struct.nodes_dict
+        similarities = query_result.similarities or [None] * len(query_result.ids)
+
+        node_with_scores: List[NodeWithScore] = list()
+        for text_id, score in zip(query_result.ids, similarities):
+            node_id = nodes_dict.get(text_id)
+            node = None if node_id is None else self._docstore.get_document(node_id, raise_error=False)
+            if node is None:
+                logger.debug("node deleted during retrieval, text_id: {}".format(text_id))
+                continue
+            node_with_scores.append(NodeWithScore(node=node, score=score))
+
+        query_result.nodes = [node_with_score.node for node_with_score in node_with_scores]
+        query_result.ids = [node_with_score.node.node_id for node_with_score in node_with_scores]
+        query_result.similarities = [node_with_score.score for node_with_score in node_with_scores]
+        log_vector_store_query_result(query_result)
+        return node_with_scores
+
+
+if __name__ == '__main__':
+    pass
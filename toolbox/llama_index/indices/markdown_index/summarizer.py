@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+import threading
+from typing import Iterable, Iterator, Optional, Tuple
+
+from llama_index.response.schema import Response
+from llama_index.response_synthesizers import BaseSynthesizer
+from llama_index.schema import Document, NodeWithScore
+from llama_index.utils import globals_helper
+
+from toolbox.concurrency.retry import call_with_retry
+from toolbox.concurrency.token_bucket import TokenBucket
+from toolbox.llama_index.storage.summary_checkpoint import SummaryCheckpoint
+
+logger = logging.getLogger("toolbox")
+
+
+DEFAULT_SUMMARY_QUERY = (
+    "Give a concise summary of this document. Also describe some of the questions "
+    "that this document can answer. "
+)
+
+
+class DocumentSummarizer(object):
+    """
+    MarkDownIndex 构建时, 对 MarkdownReader 的各 header Document 做 summary (header=-1 的 Document 不需要).
+
+    (1)num_workers 个线程并发调用 response_synthesizer.synthesize. iter_summaries 按输入顺序返回, 结果与 num_workers 无关.
+    (2)限流: requests_per_minute 限制请求数, tokens_per_minute 限制 prompt 的 token 数 (按 document.text 估计). 重试也计入限流.
+    (3)失败时指数退避重试 max_retries 次, 仍然失败时抛出异常, 终止构建.
+    (4)checkpoint 不为 None 时, 先查检查点, 命中则不调用 LLM; 每完成一个 summary 立即写入检查点, 中断后重新运行从断点继续.
+    检查点按 LLM 实际看到的内容 (text 与 LLM 可见的 metadata) 查找, 子 section 变化时父 section 的 summary 重新生成.
+    (5)最多 max_pending 个 Document 已提交但未被消费 (默认 4 * num_workers), documents 可以是 iter_markdown_documents 等生成器.
+
+    """
+    def __init__(self,
+                 response_synthesizer: BaseSynthesizer,
+                 summary_query: str = DEFAULT_SUMMARY_QUERY,
+                 num_workers: int = 1,
+                 requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None,
+                 max_retries: int = 3,
+                 backoff_factor: float = 1.0,
+                 max_backoff: float = 30.0,
+                 checkpoint: Optional[SummaryCheckpoint] = None,
+                 max_pending: Optional[int] = None,
+                 ):
+        self.response_synthesizer = response_synthesizer
+        self.summary_query = summary_query
+        self.num_workers = max(1, num_workers)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.checkpoint = checkpoint
+        self.max_pending = max_pending or 4 * self.num_workers
+
+        self._request_bucket = None
+        if requests_per_minute is not None:
+            self._request_bucket = TokenBucket(rate=requests_per_minute / 60, capacity=self.num_workers)
+        self._token_bucket = None
+        if tokens_per_minute is not None:
+            self._token_bucket = TokenBucket(rate=tokens_per_minute / 60, capacity=tokens_per_minute)
+
+        self._lock = threading.Lock()
+        self.cached = 0
+        self.summarized = 0
+
+    @staticmethod
+    def need_summary(document: Document) -> bool:
+        return document.metadata["header"] != -1
+
+    def _acquire(self, tokens: int):
+        if self._request_bucket is not None:
+            self._request_bucket.acquire()
+        if self._token_bucket is not None:
+            self._token_bucket.acquire(tokens=min(tokens, self._token_bucket.capacity))
+
+    def _synthesize(self, document: Document) -> str:
+        response: Response = self.response_synthesizer.synthesize(
+            query=self.summary_query,
+            nodes=[NodeWithScore(node=document)],
+        )
+        if response.response is None:
+            raise ValueError("empty summary response, doc_id: {}".format(document.doc_id))
+        return response.response
+
+    def summarize(self, document: Document) -> str:
+        key = None
+        if self.checkpoint is not None:
+            metadata = {k: v for k, v in document.metadata.items() if k not in document.excluded_llm_metadata_keys}
+            key = self.checkpoint.get_key(document.text, metadata, self.summary_query)
+            summary = self.checkpoint.get(key)
+            if summary is not None:
+                with self._lock:
+                    self.cached += 1
+                return summary
+
+        tokens = len(globals_helper.tokenizer(document.text)) + len(globals_helper.tokenizer(self.summary_query))
+        summary = call_with_retry(
+            self._synthesize, document,
+            max_retries=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            max_backoff=self.max_backoff,
+            before_attempt=partial(self._acquire, tokens),
+        )
+        if self.checkpoint is not None:
+            self.checkpoint.put(key, summary)
+        with self._lock:
+            self.summarized += 1
+        return summary
+
+    def iter_summaries(self, documents: Iterable[Document]) -> Iterator[Tuple[Document, Optional[str]]]:
+        """按输入顺序返回 (document, summary), 不需要 summary 的 Document 返回 None."""
+        if self.num_workers <= 1:
+            for document in documents:
+                yield document, self.summarize(document) if self.need_summary(document) else None
+            return
+
+        executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="summarize")
+        try:
+            pending = deque()
+            for document in documents:
+                future = executor.submit(self.summarize, document) if self.need_summary(document) else None
+                pending.append((document, future))
+                while len(pending) >= self.max_pending:
+                    document_, future_ = pending.popleft()
+                    yield document_, None if future_ is None else future_.result()
+
+            while len(pending) != 0:
+                document_, future_ = pending.popleft()
+                yield document_, None if future_ is None else future_.result()
+        finally:
+            # 失败或提前停止时, 取消未开始的任务. 正在执行的任务完成后仍会写入检查点.
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "num_workers": self.num_workers,
+            "cached": self.cached,
+            "summarized": self.summarized,
+        }
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple, Union
+
+from llama_index.schema import Document
+
+from toolbox.llama_index.readers.file.markdown_reader import MarkdownReader
+
+
+def list_markdown_files(document_dir: Union[str, Path], pattern: str = "**/*.md") -> List[Path]:
+    """按路径排序, 保证各次运行的文件顺序一致."""
+    return sorted(Path(document_dir).glob(pattern))
+
+
+def _load_markdown_file(reader: MarkdownReader, filename: Path) -> List[Document]:
+    return reader.load_data(file=filename)
+
+
+def iter_markdown_files(document_dir: Union[str, Path],
+                        reader: Optional[MarkdownReader] = None,
+                        num_workers: int = None,
+                        max_pending: int = None,
+                        pattern: str = "**/*.md",
+                        filenames: Optional[List[Path]] = None,
+                        ) -> Iterator[Tuple[Path, List[Document]]]:
+    """
+    流式解析文档目录下的 Markdown 文件, 按文件路径顺序返回 (filename, documents).
+
+    (1)num_workers > 1 时在进程池中解析. 默认为 CPU 核数.
+    (2)最多有 max_pending 个文件已提交但未被消费 (默认 2 * num_workers). 下游 (如 summary, embedding) 消费较慢时,
+    解析随之暂停, 内存中只保留这些文件的 Document.
+    (3)消费方提前停止迭代时, 取消未开始的任务.
+    (4)filenames 不为 None 时只解析这些文件 (如增量构建时变化的文件), 按给定顺序返回.
+    """
+    reader = reader or MarkdownReader()
+    if filenames is None:
+        filenames = list_markdown_files(document_dir, pattern=pattern)
+    num_workers = num_workers or os.cpu_count() or 1
+    num_workers = min(num_workers, max(1, len(filenames)))
+
+    if num_workers <= 1:
+        for filename in filenames:
+            yield filename, _load_markdown_file(reader, filename)
+        return
+
+    max_pending = max_pending or 2 * num_workers
+    executor = ProcessPoolExecutor(max_workers=num_workers)
+    try:
+        filenames_iter = iter(filenames)
+        pending = deque()
+        for filename in filenames_iter:
+            pending.append((filename, executor.submit(_load_markdown_file, reader, filename)))
+            if len(pending) >= max_pending:
+                break
+
+        while len(pending) != 0:
+            filename, future = pending.popleft()
+            documents = future.result()
+            next_filename = next(filenames_iter, None)
+            if next_filename is not None:
+                pending.append((next_filename, executor.submit(_load_markdown_file, reader, next_filename)))
+            yield filename, documents
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def iter_markdown_documents(document_dir: Union[str, Path],
+                            reader: Optional[MarkdownReader] = None,
+                            num_workers: int = None,
+                            max_pending: int = None,
+                            pattern: str = "**/*.md",
+                            ) -> Iterator[Document]:
+    """同 iter_markdown_files, 逐个返回 Document."""
+    for _, documents in iter_markdown_files(
+            document_dir,
+            reader=reader,
+            num_workers=num_workers,
+            max_pending=max_pending,
+            pattern=pattern,
+    ):
+        yield from documents
+
+
+def demo1():
+    import time
+
+    from project_settings import project_path
+
+    document_dir = project_path / "data/NXLink"
+
+    for num_workers in [1, os.cpu_count()]:
+        begin = time.time()
+        count = 0
+        for _ in iter_markdown_documents(document_dir, num_workers=num_workers):
+            count += 1
+        print("num_workers: {}, documents: {}, cost: {:.2f}s".format(num_workers, count, time.time() - begin))
+    return
+
+
+if __name__ == '__main__':
+    demo1()
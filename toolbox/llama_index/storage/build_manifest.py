@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger("toolbox")
+
+
+def get_file_hash(filename: str) -> str:
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class BuildManifest(object):
+    """
+    增量构建的清单, 记录每个源文件的内容哈希与其产生的节点.
+
+    数据结构:
+    (1)config_hash: 构建配置 (reader 参数, summary prompt, embedding 模型等) 的哈希. 配置变化时清单作废, 全部重建.
+    (2)files: {key: {"hash": 文件内容哈希, "node_ids": [...], ...}}. key 一般为相对 document_dir 的路径.
+
+    用法:
+    (1)diff 比较当前文件与清单, 得到新增, 变化, 删除, 未变化的文件. 只处理前三者.
+    (2)每处理完一个文件即 update + save, 构建中断后重新运行, 已完成的文件不再处理.
+    (3)save 写入临时文件后重命名.
+
+    """
+    def __init__(self, manifest_file: str, config: dict = None):
+        self.manifest_file = manifest_file
+        js = json.dumps(config or dict(), ensure_ascii=False, sort_keys=True)
+        self.config_hash = hashlib.sha256(js.encode("utf-8")).hexdigest()[:16]
+
+        self.files: Dict[str, dict] = dict()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.manifest_file):
+            return
+        with open(self.manifest_file, "r", encoding="utf-8") as f:
+            js = json.load(f)
+        if js.get("config_hash") != self.config_hash:
+            logger.info("build config changed, discard manifest: {}".format(self.manifest_file))
+            return
+        self.files = js["files"]
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.manifest_file))
+        os.makedirs(directory, exist_ok=True)
+        temp_file = "{}.{}.tmp".format(self.manifest_file, os.getpid())
+        js = {
+            "config_hash": self.config_hash,
+            "files": self.files,
+        }
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(js, f, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(temp_file, self.manifest_file)
+
+    def diff(self, file_hashes: Dict[str, str]) -> Tuple[List[str], List[str], List[str], List[str]]:
+        """
+        :param file_hashes: {key: 文件内容哈希}, 当前的全部文件.
+        :return: (added, changed, deleted, unchanged), 各自按 key 排序.
+        """
+        added = list()
+        changed = list()
+        unchanged = list()
+        for key in sorted(file_hashes.keys()):
+            entry = self.files.get(key)
+            if entry is None:
+                added.append(key)
+            elif entry["hash"] != file_hashes[key]:
+                changed.append(key)
+            else:
+                unchanged.append(key)
+        deleted = sorted(key for key in self.files.keys() if key not in file_hashes)
+        return added, changed, deleted, unchanged
+
+    def get(self, key: str) -> dict:
+        return self.files.get(key)
+
+    def update(self, key: str, file_hash: str, node_ids: List[str], **kwargs):
+        self.files[key] = {
+            "hash": file_hash,
+            "node_ids": list(node_ids),
+            **kwargs
+        }
+
+    def remove(self, key: str):
+        self.files.pop(key, None)
+
+
+def demo1():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        manifest_file = os.path.join(directory, "build_manifest.json")
+        manifest = BuildManifest(manifest_file, config={"summary_query": "v1"})
+        manifest.update("a.md", "h1", ["n1", "n2"])
+        manifest.update("b.md", "h2", ["n3"])
+        manifest.save()
+
+        manifest = BuildManifest(manifest_file, config={"summary_query": "v1"})
+        print(manifest.diff({"a.md": "h1", "b.md": "h2-new", "c.md": "h3"}))
+
+        manifest = BuildManifest(manifest_file, config={"summary_query": "v2"})
+        print(manifest.diff({"a.md": "h1"}))
+    return
+
+
+if __name__ == '__main__':
+    demo1()
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger("toolbox")
+
+
+class SummaryCheckpoint(object):
+    """
+    summary 结果的检查点, 构建中断后重新运行时, 已完成的 summary 不再调用 LLM.
+
+    数据结构:
+    (1)JSONL 文件, 每行 {"key": ..., "summary": ...}. 每完成一个 summary 追加一行并 flush.
+    (2)key 为 namespace, summary_query 与 Document 的 text, metadata 的哈希, 与 doc_id 无关 (MarkdownReader 每次生成新的 doc_id).
+    不使用 Document.hash: MarkdownReader 按 section 自身的文本计算 hash, 之后 text 替换为子树的文本, 子 section 变化时 hash 不变.
+    namespace 一般为构建配置的哈希 (如 BuildManifest.config_hash), 配置变化后旧的结果不再命中.
+
+    备注:
+    (1)进程在写入过程中退出时, 最后一行可能不完整, 加载时跳过无法解析的行.
+    (2)同一个 key 出现多次时, 以最后一次为准.
+
+    """
+    def __init__(self, checkpoint_file: str, namespace: str = ""):
+        self.checkpoint_file = checkpoint_file
+        self.namespace = namespace
+
+        self._summaries: Dict[str, str] = dict()
+        self._lock = threading.Lock()
+        # 上次中断时最后一行可能没有换行符, 追加之前先补一个换行.
+        self._needs_newline = False
+        self.load()
+
+    def get_key(self, text: str, metadata: dict, summary_query: str) -> str:
+        js = json.dumps([self.namespace, summary_query, text, metadata], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(js.encode("utf-8")).hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.checkpoint_file):
+            return
+        broken = 0
+        with open(self.checkpoint_file, "r", encoding="utf-8") as f:
+            for row in f:
+                self._needs_newline = not row.endswith("\n")
+                try:
+                    js = json.loads(row)
+                except json.JSONDecodeError:
+                    broken += 1
+                    continue
+                self._summaries[js["key"]] = js["summary"]
+        logger.info("load summary checkpoint: {}, summaries: {}, broken rows: {}".format(
+            self.checkpoint_file, len(self._summaries), broken
+        ))
+
+    def get(self, key: str) -> Optional[str]:
+        return self._summaries.get(key)
+
+    def put(self, key: str, summary: str):
+        row = json.dumps({"key": key, "summary": summary}, ensure_ascii=False)
+        with self._lock:
+            self._summaries[key] = summary
+            directory = os.path.dirname(os.path.abspath(self.checkpoint_file))
+            os.makedirs(directory, exist_ok=True)
+            with open(self.checkpoint_file, "a", encoding="utf-8") as f:
+                if self._needs_newline:
+                    f.write("\n")
+                    self._needs_newline = False
+                f.write("{}\n".format(row))
+                f.flush()
+
+    def __len__(self):
+        return len(self._summaries)
+
+
+def demo1():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoint_file = os.path.join(directory, "summary_checkpoint.jsonl")
+        checkpoint = SummaryCheckpoint(checkpoint_file, namespace="v1")
+        key = checkpoint.get_key("text", {"header": "# title"}, "summary query")
+        checkpoint.put(key, "summary")
+        with open(checkpoint_file, "a", encoding="utf-8") as f:
+            f.write('{"key": "broken')
+
+        checkpoint = SummaryCheckpoint(checkpoint_file, namespace="v1")
+        print(checkpoint.get(key))
+        checkpoint.put("other", "summary2")
+        print(len(SummaryCheckpoint(checkpoint_file, namespace="v1")))
+    return
+
+
+if __name__ == '__main__':
+    demo1()
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+import fsspec
+import numpy as np
+from llama_index.vector_stores.types import (
+    NodeWithEmbedding,
+    VectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+
+from toolbox.retrieval.embedding_store import Int8EmbeddingStore
+
+DEFAULT_PERSIST_DIR = "./storage"
+
+
+class Int8VectorStore(VectorStore):
+    """
+    基于 Int8EmbeddingStore 的 llama_index 向量库, 替代 SimpleVectorStore (vector_store.json).
+
+    数据结构:
+    (1)已持久化的向量为 Int8EmbeddingStore, 从目录以只读 mmap 加载.
+    (2)新 add 的向量暂存在内存中 (float32), 查询或持久化时只量化暂存的行, 追加到 Int8EmbeddingStore 之后.
+    (3)text_id_to_ref_doc_id: node_id 到 ref_doc_id 的映射, 用于 delete.
+
+    检索方法:
+    (1)只支持 VectorStoreQueryMode.DEFAULT. keep_float=True 时 int8 初筛 + float32 重打分, 否则只用 int8 得分.
+    (2)支持 node_ids, doc_ids 过滤, 不支持 metadata filters.
+
+    备注:
+    (1)StorageContext.persist 传入的 persist_path 为 {persist_dir}/vector_store.json,
+    实际写入目录 {persist_dir}/vector_store_int8.
+    (2)只支持本地文件系统, 忽略 fs 参数.
+    (3)add, delete 与 query 可以在不同线程并发调用 (线上查询时增量更新). 合并暂存向量在锁内进行, 检索在锁外进行.
+    (4)加载: StorageContext.from_defaults(persist_dir=..., vector_store=Int8VectorStore.from_persist_dir(persist_dir)).
+
+    """
+    stores_text: bool = False
+    is_embedding_query: bool = True
+
+    text_id_to_ref_doc_id_filename = "text_id_to_ref_doc_id.json"
+
+    def __init__(self,
+                 store: Optional[Int8EmbeddingStore] = None,
+                 text_id_to_ref_doc_id: Optional[Dict[str, str]] = None,
+                 rescore_k: Optional[int] = None,
+                 keep_float: bool = False,
+                 **kwargs: Any,
+                 ) -> None:
+        self._store = store
+        self._text_id_to_ref_doc_id: Dict[str, str] = text_id_to_ref_doc_id or dict()
+        self._rescore_k = rescore_k
+        self._keep_float = keep_float
+
+        self._pending_ids: List[str] = list()
+        self._pending_embeddings: List[List[float]] = list()
+        self._deleted = set()
+        self._lock = threading.Lock()
+
+    @property
+    def client(self) -> None:
+        return None
+
+    def add(self, embedding_results: List[NodeWithEmbedding]) -> List[str]:
+        with self._lock:
+            for result in embedding_results:
+                self._pending_ids.append(result.id)
+                self._pending_embeddings.append(result.embedding)
+                self._text_id_to_ref_doc_id[result.id] = result.ref_doc_id
+            if len(self._deleted) != 0:
+                self._deleted = self._deleted - {result.id for result in embedding_results}
+        return [result.id for result in embedding_results]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        with self._lock:
+            text_ids_to_delete = [text_id for text_id, ref_doc_id_ in self._text_id_to_ref_doc_id.items()
+                                  if ref_doc_id_ == ref_doc_id]
+            for text_id in text_ids_to_delete:
+                del self._text_id_to_ref_doc_id[text_id]
+            # 替换而不是原地修改, 正在进行的 query 持有的是旧的集合.
+            self._deleted = self._deleted | set(text_ids_to_delete)
+
+    def _get_store(self, compact: bool = False) -> Optional[Int8EmbeddingStore]:
+        """
+        只量化暂存的向量, 追加到已有的 store 之后. compact 时同时去掉已删除的行. 调用方持有 self._lock.
+        """
+        if len(self._pending_ids) == 0 and not (compact and len(self._deleted) != 0):
+            return self._store
+
+        store = self._store
+        if len(self._pending_ids) != 0:
+            pending_ids = self._pending_ids
+            duplicated = len(set(pending_ids)) != len(pending_ids) or (
+                store is not None and store.num_docs != 0 and bool(np.isin(store.ids_array, pending_ids).any())
+            )
+            if store is None:
+                store = Int8EmbeddingStore.from_embeddings(list(), np.zeros(shape=(0, 0), dtype=np.float32))
+            store = store.append(
+                pending_ids,
+                np.asarray(self._pending_embeddings, dtype=np.float32),
+                keep_float=self._keep_float,
+            )
+            if duplicated:
+                # 同一个 node_id 重复 add 时, 保留最后一次. 按行选取, 不重新量化.
+                last_row = {text_id: row for row, text_id in enumerate(store.ids)}
+                store = store.take(np.array(sorted(last_row.values()), dtype=np.int64))
+
+        if compact and len(self._deleted) != 0 and store is not None:
+            keep = ~np.isin(store.ids_array, list(self._deleted))
+            if not keep.all():
+                store = store.take(np.flatnonzero(keep))
+        self._store = store if store is not None and store.num_docs != 0 else None
+
+        self._pending_ids = list()
+        self._pending_embeddings = list()
+        if compact:
+            self._deleted = set()
+        return self._store
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.filters is not None:
+            raise ValueError("Metadata filters not implemented for Int8VectorStore yet.")
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError("Invalid query mode: {}".format(query.mode))
+
+        with self._lock:
+            store = self._get_store()
+            deleted = self._deleted
+            text_id_to_ref_doc_id = self._text_id_to_ref_doc_id
+        if store is None or store.num_docs == 0:
+            return VectorStoreQueryResult(similarities=list(), ids=list())
+
+        doc_mask = None
+        if len(deleted) != 0:
+            doc_mask = ~np.isin(store.ids_array, list(deleted))
+        if query.node_ids:
+            mask = np.isin(store.ids_array, list(query.node_ids))
+            doc_mask = mask if doc_mask is None else doc_mask & mask
+        if query.doc_ids:
+            doc_ids = set(query.doc_ids)
+            text_ids = [text_id for text_id, ref_doc_id in list(text_id_to_ref_doc_id.items()) if ref_doc_id in doc_ids]
+            mask = np.isin(store.ids_array, text_ids)
+            doc_mask = mask if doc_mask is None else doc_mask & mask
+
+        rows, scores = store.search(
+            np.asarray(query.query_embedding, dtype=np.float32),
+            top_k=query.similarity_top_k,
+            doc_mask=doc_mask,
+            rescore_k=self._rescore_k,
+        )
+        return VectorStoreQueryResult(
+            similarities=scores.tolist(),
+            ids=[store.ids[row] for row in rows.tolist()],
+        )
+
+    @staticmethod
+    def get_directory(persist_path: str) -> str:
+        return "{}_int8".format(os.path.splitext(persist_path)[0])
+
+    def persist(self,
+                persist_path: str = os.path.join(DEFAULT_PERSIST_DIR, "vector_store.json"),
+                fs: Optional[fsspec.AbstractFileSystem] = None,
+                ) -> None:
+        directory = self.get_directory(persist_path)
+
+        with self._lock:
+            store = self._get_store(compact=True)
+            if store is None:
+                store = Int8EmbeddingStore.from_embeddings(list(), np.zeros(shape=(0, 0), dtype=np.float32))
+            text_id_to_ref_doc_id = {text_id: self._text_id_to_ref_doc_id[text_id] for text_id in store.ids}
+        # 映射与向量写入同一个临时目录, 一起重命名, 不会出现新的向量与旧的映射.
+        store.save(directory, extra_json={self.text_id_to_ref_doc_id_filename: text_id_to_ref_doc_id})
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str, mmap: bool = True, **kwargs: Any) -> "Int8VectorStore":
+        directory = cls.get_directory(persist_path)
+        if not Int8EmbeddingStore.exists(directory):
+            raise ValueError("No existing Int8VectorStore found at {}.".format(directory))
+
+        store = Int8EmbeddingStore.load(directory, mmap=mmap)
+        with open(os.path.join(directory, cls.text_id_to_ref_doc_id_filename), "r", encoding="utf-8") as f:
+            text_id_to_ref_doc_id = json.load(f)
+        return cls(store=store, text_id_to_ref_doc_id=text_id_to_ref_doc_id, **kwargs)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str = DEFAULT_PERSIST_DIR, **kwargs: Any) -> "Int8VectorStore":
+        return cls.from_persist_path(os.path.join(persist_dir, "vector_store.json"), **kwargs)
+
+
+if __name__ == '__main__':
+    pass
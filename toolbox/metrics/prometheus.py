@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+进程内的 Prometheus 指标, 以 text exposition format 导出.
+
+(1)Counter, Gauge, Histogram 按标签值分组, 记录时只做一次加锁的字典查找与加法.
+(2)Gauge 可以设置 function, 在导出时取值, 用于缓存命中率等已有统计.
+(3)多进程部署时, 每个进程各自导出.
+"""
+from bisect import bisect_left
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+def format_labels(label_names: Tuple[str, ...], label_values: Tuple[str, ...], extra: str = None) -> str:
+    labels = ["{}=\"{}\"".format(k, escape_label_value(v)) for k, v in zip(label_names, label_values)]
+    if extra is not None:
+        labels.append(extra)
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(labels) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric(object):
+    metric_type: str = None
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+
+        self._lock = threading.Lock()
+
+    def label_values(self, labels: dict) -> Tuple[str, ...]:
+        if len(labels) != len(self.label_names):
+            raise AssertionError("labels mismatch, expected: {}, got: {}".format(self.label_names, tuple(labels.keys())))
+        return tuple(str(labels[k]) for k in self.label_names)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.metric_type),
+        ]
+        lines.extend(self.samples())
+        return lines
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple[str, ...], float] = dict()
+
+    def inc(self, value: float = 1.0, **labels):
+        key = self.label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def get(self, **labels) -> float:
+        return self._values.get(self.label_values(labels), 0.0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return ["{}{} {}".format(self.name, format_labels(self.label_names, k), format_value(v)) for k, v in items]
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple[str, ...], float] = dict()
+        self._functions: Dict[Tuple[str, ...], Callable[[], Optional[float]]] = dict()
+
+    def set(self, value: float, **labels):
+        key = self.label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, fn: Callable[[], Optional[float]], **labels):
+        """导出时调用 fn 取值, 返回 None 时不导出."""
+        key = self.label_values(labels)
+        with self._lock:
+            self._functions[key] = fn
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, fn in functions.items():
+            value = fn()
+            if value is not None:
+                values[key] = value
+        return ["{}{} {}".format(self.name, format_labels(self.label_names, k), format_value(v))
+                for k, v in sorted(values.items())]
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+        # label_values -> [bucket counts (不累加, 最后一个为 +Inf), sum]
+        self._values: Dict[Tuple[str, ...], list] = dict()
+
+    def observe(self, value: float, **labels):
+        key = self.label_values(labels)
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = [[0] * (len(self.buckets) + 1), 0.0]
+                self._values[key] = item
+            item[0][idx] += 1
+            item[1] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1])) for k, v in self._values.items())
+
+        lines = list()
+        for key, (counts, total) in items:
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                extra = "le=\"{}\"".format(format_value(upper_bound))
+                lines.append("{}_bucket{} {}".format(self.name, format_labels(self.label_names, key, extra), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, format_labels(self.label_names, key), format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, format_labels(self.label_names, key), cumulative))
+        return lines
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = dict()
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, documentation: str, label_names: Tuple[str, ...], **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, documentation, label_names, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls) or metric.label_names != tuple(label_names):
+                raise AssertionError("metric already registered with another type or labels: {}".format(name))
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, label_names)
+
+    def gauge(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, label_names)
+
+    def histogram(self, name: str, documentation: str, label_names: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, label_names, buckets=buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = list()
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+default_registry = MetricsRegistry()
+
+
+def demo1():
+    import time
+
+    histogram = default_registry.histogram("demo_latency_seconds", "demo latency.", ("stage",))
+    counter = default_registry.counter("demo_requests_total", "demo requests.", ("result",))
+
+    n = 100000
+    begin = time.perf_counter()
+    for i in range(n):
+        histogram.observe(0.003, stage="es")
+        counter.inc(result="success")
+    cost = time.perf_counter() - begin
+    print("observe + inc: {:.2f}us".format(cost / n * 1e6))
+
+    print(default_registry.render())
+    return
+
+
+if __name__ == '__main__':
+    demo1()
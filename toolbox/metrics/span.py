@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+分阶段计时.
+
+用法:
+with Trace() as trace:
+    with Span("es_search"):
+        ...
+    trace.to_dict()
+
+(1)Span 结束时记录到 stage_latency_seconds 直方图, 抛出异常时 stage_errors_total 加一.
+(2)当前请求的 Trace 保存在 contextvars 中 (协程/线程隔离), Span 同时记录到 Trace, 用于返回 debug 信息.
+(3)BlockingCallExecutor 提交任务时复制 context, 工作线程中的 Span 也记录到调用方的 Trace.
+"""
+from contextvars import ContextVar
+import functools
+import threading
+import time
+from typing import Callable, Optional
+
+from toolbox.metrics.prometheus import default_registry
+
+
+stage_latency = default_registry.histogram(
+    "stage_latency_seconds",
+    "latency of each processing stage.",
+    ("stage",),
+)
+stage_errors = default_registry.counter(
+    "stage_errors_total",
+    "exceptions raised in each processing stage.",
+    ("stage",),
+)
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+
+
+class Trace(object):
+    """一次请求内各阶段的耗时. 同名阶段的耗时累加."""
+    def __init__(self):
+        self._costs = dict()
+        self._lock = threading.Lock()
+        self._token = None
+
+    def add(self, name: str, cost: float):
+        with self._lock:
+            self._costs[name] = self._costs.get(name, 0.0) + cost
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {k: round(v, 4) for k, v in self._costs.items()}
+
+    def __enter__(self):
+        self._token = _current_trace.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _current_trace.reset(self._token)
+        self._token = None
+
+
+def get_current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+class Span(object):
+    __slots__ = ("name", "begin")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.begin = None
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        cost = time.perf_counter() - self.begin
+        stage_latency.observe(cost, stage=self.name)
+        if exc_type is not None:
+            stage_errors.inc(stage=self.name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(self.name, cost)
+
+
+def timed(name: str):
+    """装饰器, 函数调用作为一个 Span."""
+    def wrap(f: Callable):
+        @functools.wraps(f)
+        def inner(*args, **kwargs):
+            with Span(name):
+                return f(*args, **kwargs)
+        return inner
+    return wrap
+
+
+def demo1():
+    n = 100000
+    with Trace() as trace:
+        begin = time.perf_counter()
+        for _ in range(n):
+            with Span("noop"):
+                pass
+        cost = time.perf_counter() - begin
+    print("span overhead: {:.2f}us".format(cost / n * 1e6))
+    print(trace.to_dict())
+    return
+
+
+if __name__ == '__main__':
+    demo1()
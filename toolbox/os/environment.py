@@ -47,10 +47,17 @@ class EnvironmentManager(object):
         return result
 
 
+def str2bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('true', '1', 'yes', 'on')
+
+
 _DEFAULT_DTYPE_MAP = {
     'int': int,
     'float': float,
     'str': str,
+    'bool': str2bool,
     'json.loads': json.loads
 }
 
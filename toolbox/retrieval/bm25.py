@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+from collections import Counter
+import math
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class BM25Index(object):
+    """
+    内存倒排索引, 使用 BM25 打分.
+
+    数据结构:
+    (1)postings 以 CSR 形式存储: 词 term_id 的倒排表位于 [indptr[term_id], indptr[term_id + 1]) 区间.
+    (2)doc_ids 为 int32, weights 为 float32, 其中 weights 是预先计算好的 BM25 词项得分 idf * tf / (tf + k1 * (1 - b + b * dl / avgdl)).
+
+    检索方法:
+    (1)取出 query 各词的倒排表, 拼接后使用 np.bincount 一次性累加得分.
+    (2)使用 doc_mask 过滤, np.argpartition 取 top_k.
+
+    备注:
+    (1)打分公式与 Elasticsearch 7.x (Lucene 8 BM25Similarity) 保持一致, k1=1.2, b=0.75.
+    Lucene 8 去掉了分子中的常数 (k1 + 1), 这里同样不乘, 得分与 Elasticsearch 可以直接比较 (min_score 等阈值可以沿用).
+    (2)Lucene 对文档长度做有损编码 (SmallFloat), 长文档的得分与 Elasticsearch 有很小的差异.
+
+    """
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+
+        self.vocab: Dict[str, int] = dict()
+        self.indptr = np.zeros(shape=(1,), dtype=np.int64)
+        self.doc_ids = np.zeros(shape=(0,), dtype=np.int32)
+        self.weights = np.zeros(shape=(0,), dtype=np.float32)
+        self.doc_lengths = np.zeros(shape=(0,), dtype=np.float32)
+
+    @property
+    def num_docs(self) -> int:
+        return len(self.doc_lengths)
+
+    def build(self, documents: List[List[str]]):
+        num_docs = len(documents)
+
+        vocab: Dict[str, int] = dict()
+        postings: List[List[Tuple[int, int]]] = list()
+        doc_lengths = np.zeros(shape=(num_docs,), dtype=np.float32)
+        for doc_id, tokens in enumerate(documents):
+            doc_lengths[doc_id] = len(tokens)
+            for token, tf in Counter(tokens).items():
+                term_id = vocab.get(token)
+                if term_id is None:
+                    term_id = len(vocab)
+                    vocab[token] = term_id
+                    postings.append(list())
+                postings[term_id].append((doc_id, tf))
+
+        avg_doc_length = float(doc_lengths.mean()) if num_docs > 0 else 0.0
+        # 每个文档的长度归一化因子, k1 * (1 - b + b * dl / avgdl).
+        if avg_doc_length > 0:
+            norms = self.k1 * (1 - self.b + self.b * doc_lengths / avg_doc_length)
+        else:
+            norms = np.full(shape=(num_docs,), fill_value=self.k1, dtype=np.float32)
+
+        indptr = np.zeros(shape=(len(postings) + 1,), dtype=np.int64)
+        for term_id, posting in enumerate(postings):
+            indptr[term_id + 1] = indptr[term_id] + len(posting)
+
+        doc_ids = np.empty(shape=(indptr[-1],), dtype=np.int32)
+        tfs = np.empty(shape=(indptr[-1],), dtype=np.float32)
+        idfs = np.empty(shape=(indptr[-1],), dtype=np.float32)
+        for term_id, posting in enumerate(postings):
+            begin, end = indptr[term_id], indptr[term_id + 1]
+            doc_ids[begin: end] = [doc_id for doc_id, _ in posting]
+            tfs[begin: end] = [tf for _, tf in posting]
+            df = len(posting)
+            idfs[begin: end] = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+
+        weights = idfs * tfs / (tfs + norms[doc_ids])
+
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights.astype(np.float32)
+        self.doc_lengths = doc_lengths
+        return self
+
+    def get_scores(self, tokens: List[str]) -> np.ndarray:
+        slices = list()
+        for token, qtf in Counter(tokens).items():
+            term_id = self.vocab.get(token)
+            if term_id is None:
+                continue
+            slices.append((self.indptr[term_id], self.indptr[term_id + 1], qtf))
+
+        if len(slices) == 0:
+            return np.zeros(shape=(self.num_docs,), dtype=np.float32)
+
+        doc_ids = np.concatenate([self.doc_ids[begin: end] for begin, end, _ in slices])
+        weights = np.concatenate([self.weights[begin: end] * qtf for begin, end, qtf in slices])
+        scores = np.bincount(doc_ids, weights=weights, minlength=self.num_docs)
+        return scores.astype(np.float32)
+
+    def search(self,
+               tokens: List[str],
+               top_k: int,
+               doc_mask: Optional[np.ndarray] = None,
+               ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param tokens: query 分词结果.
+        :param top_k: 返回数量.
+        :param doc_mask: bool 数组, 为 False 的文档被过滤.
+        :return: (doc_ids, scores), 按得分降序. 只返回至少命中一个词的文档.
+        """
+        if top_k <= 0:
+            return np.zeros(shape=(0,), dtype=np.int64), np.zeros(shape=(0,), dtype=np.float32)
+
+        scores = self.get_scores(tokens)
+        if doc_mask is not None:
+            scores = np.where(doc_mask, scores, 0)
+
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > top_k:
+            candidate_scores = scores[candidates]
+            top = np.argpartition(-candidate_scores, top_k - 1)[:top_k]
+            candidates = candidates[top]
+
+        order = np.argsort(-scores[candidates], kind="stable")
+        doc_ids = candidates[order]
+        return doc_ids, scores[doc_ids]
+
+
+def demo1():
+    index = BM25Index()
+    index.build([
+        ["什么", "是", "nxlink"],
+        ["怎样", "注册", "facebook", "账号"],
+        ["facebook", "注册", "官网", "是", "多少"],
+    ])
+    doc_ids, scores = index.search(["facebook", "注册", "官网"], top_k=2)
+    print(doc_ids, scores)
+    return
+
+
+if __name__ == '__main__':
+    demo1()
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+def l2_normalize(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+
+def top_k_rows(scores: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :param scores: (n, num_docs) 得分矩阵.
+    :return: (doc_ids, scores), 形状均为 (n, min(top_k, num_docs)), 每行按得分降序.
+    """
+    num_docs = scores.shape[1]
+    top_k = min(top_k, num_docs)
+    if top_k <= 0:
+        return np.zeros(shape=(scores.shape[0], 0), dtype=np.int64), np.zeros(shape=(scores.shape[0], 0), dtype=np.float32)
+
+    if top_k < num_docs:
+        candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    else:
+        candidates = np.tile(np.arange(num_docs), (scores.shape[0], 1))
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind="stable")
+    doc_ids = np.take_along_axis(candidates, order, axis=1)
+    return doc_ids, np.take_along_axis(candidate_scores, order, axis=1)
+
+
+class DenseIndex(object):
+    """
+    向量检索, 精确 (暴力) 内积.
+
+    数据结构:
+    (1)embeddings 为 (num_docs, dim) 的 float32 连续矩阵, 行向量 L2 归一化, 内积即余弦相似度.
+
+    检索方法:
+    (1)多个 query 向量组成 (n, dim) 矩阵, 与 embeddings 一次矩阵乘法得到 (n, num_docs) 得分.
+    (2)被 doc_mask 过滤的文档得分置为 -inf, 每行 np.argpartition 取 top_k.
+
+    """
+    def __init__(self):
+        self.embeddings = np.zeros(shape=(0, 0), dtype=np.float32)
+
+    @property
+    def num_docs(self) -> int:
+        return self.embeddings.shape[0]
+
+    def build(self, embeddings: np.ndarray):
+        self.embeddings = np.ascontiguousarray(l2_normalize(embeddings))
+        return self
+
+    def get_scores(self, query_embeddings: np.ndarray) -> np.ndarray:
+        query_embeddings = l2_normalize(np.atleast_2d(query_embeddings))
+        return query_embeddings @ self.embeddings.T
+
+    def batch_search(self,
+                     query_embeddings: np.ndarray,
+                     top_k: int,
+                     doc_mask: Optional[np.ndarray] = None,
+                     ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        :param query_embeddings: (n, dim).
+        :param top_k: 每个 query 返回的数量.
+        :param doc_mask: bool 数组, 为 False 的文档被过滤.
+        :return: [(doc_ids, scores), ...], 与 query 顺序一致, 按得分降序.
+        """
+        query_embeddings = np.atleast_2d(query_embeddings)
+        if self.num_docs == 0:
+            empty = (np.zeros(shape=(0,), dtype=np.int64), np.zeros(shape=(0,), dtype=np.float32))
+            return [empty for _ in range(len(query_embeddings))]
+
+        scores = self.get_scores(query_embeddings)
+        if doc_mask is not None:
+            scores = np.where(doc_mask[None, :], scores, -np.inf)
+        doc_ids, top_scores = top_k_rows(scores, top_k)
+
+        result = list()
+        for row_doc_ids, row_scores in zip(doc_ids, top_scores):
+            keep = np.isfinite(row_scores)
+            result.append((row_doc_ids[keep], row_scores[keep]))
+        return result
+
+    def search(self,
+               query_embedding: np.ndarray,
+               top_k: int,
+               doc_mask: Optional[np.ndarray] = None,
+               ) -> Tuple[np.ndarray, np.ndarray]:
+        return self.batch_search(query_embedding, top_k=top_k, doc_mask=doc_mask)[0]
+
+
+def demo1():
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal(size=(10000, 384)).astype(np.float32)
+
+    index = DenseIndex().build(embeddings)
+    doc_ids, scores = index.search(embeddings[42], top_k=3)
+    print(doc_ids, scores)
+    return
+
+
+if __name__ == '__main__':
+    demo1()
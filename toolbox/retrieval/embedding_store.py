@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from toolbox.retrieval.dense import l2_normalize, top_k_rows
+
+
+def quantize(embeddings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    按行对称量化: codes = round(x / scale), scale = max(|x|) / 127.
+    :return: (codes int8 (n, dim), scales float32 (n,))
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    scales = np.abs(embeddings).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.rint(embeddings / scales[:, None]).clip(-127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class Int8EmbeddingStore(object):
+    """
+    int8 量化的向量库, 保存在目录中, 以只读 mmap 加载.
+
+    数据结构:
+    (1)codes.npy: (n, dim) int8, L2 归一化后的向量按行量化. scales.npy: (n,) float32.
+    (2)ids.json: 每一行的 id.
+    (3)embeddings.npy: 可选 (keep_float=True 时保存), L2 归一化后的 float32 向量, 用于 top 候选的重打分.
+
+    检索方法:
+    (1)score = scale * (codes @ query). codes 分块转换为 float32 后做矩阵乘法, 临时内存不超过一个分块.
+    (2)rescore_k 大于 top_k 且有 float32 向量时, 先按 int8 得分取 rescore_k 个候选, 再用 float32 向量重打分取 top_k.
+    没有 float32 向量时直接返回 int8 得分的 top_k.
+
+    备注:
+    (1)np.load(mmap_mode="r") 加载, 各 worker 进程共享操作系统的页缓存, 加载几乎不耗时.
+    (2)int8 的内存是 float32 的 1/4. 默认不保存 float32 向量, 需要重打分时显式指定 keep_float=True (磁盘占用为 5 倍).
+    (3)append 只量化新增的行, take 按行选取, 已有的行不重新量化.
+
+    """
+    codes_filename = "codes.npy"
+    scales_filename = "scales.npy"
+    ids_filename = "ids.json"
+    embeddings_filename = "embeddings.npy"
+
+    def __init__(self,
+                 codes: np.ndarray,
+                 scales: np.ndarray,
+                 ids: List[str],
+                 embeddings: Optional[np.ndarray] = None,
+                 block_size: int = 65536,
+                 ):
+        if len(codes) != len(scales) or len(codes) != len(ids):
+            raise AssertionError("codes, scales, ids length mismatch: {}, {}, {}".format(len(codes), len(scales), len(ids)))
+        self.codes = codes
+        self.scales = scales
+        self.ids = ids
+        self.embeddings = embeddings
+        self.block_size = block_size
+        self._ids_array = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def num_docs(self) -> int:
+        return len(self.ids)
+
+    @property
+    def ids_array(self) -> np.ndarray:
+        """ids 的 numpy 数组, 用于 np.isin 构造过滤条件. 首次访问时创建."""
+        if self._ids_array is None:
+            self._ids_array = np.asarray(self.ids, dtype=str)
+        return self._ids_array
+
+    @property
+    def dim(self) -> int:
+        return self.codes.shape[1] if self.codes.ndim == 2 else 0
+
+    @classmethod
+    def from_embeddings(cls, ids: List[str], embeddings: np.ndarray, keep_float: bool = False, **kwargs):
+        embeddings = np.ascontiguousarray(l2_normalize(embeddings)) if len(ids) != 0 else np.zeros(shape=(0, 0), dtype=np.float32)
+        codes, scales = quantize(embeddings) if len(ids) != 0 else (np.zeros(shape=(0, 0), dtype=np.int8), np.zeros(shape=(0,), dtype=np.float32))
+        return cls(
+            codes=codes,
+            scales=scales,
+            ids=list(ids),
+            embeddings=embeddings if keep_float else None,
+            **kwargs
+        )
+
+    def take(self, rows: np.ndarray) -> "Int8EmbeddingStore":
+        rows = np.asarray(rows, dtype=np.int64)
+        return Int8EmbeddingStore(
+            codes=np.asarray(self.codes[rows]),
+            scales=np.asarray(self.scales[rows]),
+            ids=[self.ids[row] for row in rows.tolist()],
+            embeddings=None if self.embeddings is None else np.asarray(self.embeddings[rows]),
+            block_size=self.block_size,
+        )
+
+    def append(self, ids: List[str], embeddings: np.ndarray, keep_float: bool = False) -> "Int8EmbeddingStore":
+        """
+        返回新的 store, 只量化新增的 embeddings.
+        原 store 非空时, 与原 store 一致: 原 store 有 float32 向量才保存新增行的 float32 向量, 忽略 keep_float.
+        """
+        if len(ids) == 0:
+            return self
+        if self.num_docs == 0:
+            return self.from_embeddings(ids, embeddings, keep_float=keep_float, block_size=self.block_size)
+
+        other = self.from_embeddings(ids, embeddings, keep_float=self.embeddings is not None)
+        return Int8EmbeddingStore(
+            codes=np.concatenate([self.codes, other.codes], axis=0),
+            scales=np.concatenate([self.scales, other.scales], axis=0),
+            ids=self.ids + other.ids,
+            embeddings=None if self.embeddings is None else np.concatenate([self.embeddings, other.embeddings], axis=0),
+            block_size=self.block_size,
+        )
+
+    def save(self, directory: str, extra_json: Dict[str, Any] = None):
+        """
+        写入临时目录后重命名, 读取方不会看到写了一半的文件.
+        :param extra_json: {文件名: 可 JSON 序列化的对象}, 与向量写入同一个临时目录, 重命名后同时可见.
+        """
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        temp_directory = "{}.{}.tmp".format(directory, os.getpid())
+        os.makedirs(temp_directory, exist_ok=True)
+
+        np.save(os.path.join(temp_directory, self.codes_filename), np.asarray(self.codes))
+        np.save(os.path.join(temp_directory, self.scales_filename), np.asarray(self.scales))
+        with open(os.path.join(temp_directory, self.ids_filename), "w", encoding="utf-8") as f:
+            json.dump(self.ids, f, ensure_ascii=False)
+        if self.embeddings is not None:
+            np.save(os.path.join(temp_directory, self.embeddings_filename), np.asarray(self.embeddings, dtype=np.float32))
+        for filename, js in (extra_json or dict()).items():
+            with open(os.path.join(temp_directory, filename), "w", encoding="utf-8") as f:
+                json.dump(js, f, ensure_ascii=False)
+
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.replace(temp_directory, directory)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True, **kwargs):
+        mmap_mode = "r" if mmap else None
+        codes = np.load(os.path.join(directory, cls.codes_filename), mmap_mode=mmap_mode)
+        scales = np.load(os.path.join(directory, cls.scales_filename), mmap_mode=mmap_mode)
+        with open(os.path.join(directory, cls.ids_filename), "r", encoding="utf-8") as f:
+            ids = json.load(f)
+        embeddings = None
+        embeddings_file = os.path.join(directory, cls.embeddings_filename)
+        if os.path.exists(embeddings_file):
+            embeddings = np.load(embeddings_file, mmap_mode=mmap_mode)
+        return cls(codes=codes, scales=scales, ids=ids, embeddings=embeddings, **kwargs)
+
+    @classmethod
+    def exists(cls, directory: str) -> bool:
+        return os.path.exists(os.path.join(directory, cls.ids_filename))
+
+    def get_embeddings(self, rows: np.ndarray) -> np.ndarray:
+        """float32 向量, 没有保存 float32 时由 int8 反量化."""
+        if self.embeddings is not None:
+            return np.asarray(self.embeddings[rows], dtype=np.float32)
+        return self.codes[rows].astype(np.float32) * self.scales[rows][:, None]
+
+    def get_scores(self, query_embeddings: np.ndarray) -> np.ndarray:
+        """
+        :param query_embeddings: (n, dim), 已 L2 归一化.
+        :return: (n, num_docs) float32.
+        """
+        scores = np.empty(shape=(len(query_embeddings), self.num_docs), dtype=np.float32)
+        query_t = np.ascontiguousarray(query_embeddings.T, dtype=np.float32)
+        for begin in range(0, self.num_docs, self.block_size):
+            end = min(begin + self.block_size, self.num_docs)
+            block = np.asarray(self.codes[begin: end], dtype=np.float32)
+            scores[:, begin: end] = (block @ query_t).T * self.scales[begin: end]
+        return scores
+
+    def batch_search(self,
+                     query_embeddings: np.ndarray,
+                     top_k: int,
+                     doc_mask: Optional[np.ndarray] = None,
+                     rescore_k: Optional[int] = None,
+                     ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        :param query_embeddings: (n, dim).
+        :param top_k: 每个 query 返回的数量.
+        :param doc_mask: bool 数组, 为 False 的行被过滤.
+        :param rescore_k: int8 初筛的候选数量, 大于 top_k 时用 float32 向量重打分. None 表示 4 * top_k.
+        :return: [(rows, scores), ...], 与 query 顺序一致, 按得分降序.
+        """
+        query_embeddings = l2_normalize(np.atleast_2d(query_embeddings))
+        if self.num_docs == 0 or top_k <= 0:
+            empty = (np.zeros(shape=(0,), dtype=np.int64), np.zeros(shape=(0,), dtype=np.float32))
+            return [empty for _ in range(len(query_embeddings))]
+
+        rescore_k = 4 * top_k if rescore_k is None else rescore_k
+        rescore = self.embeddings is not None and rescore_k > top_k
+
+        scores = self.get_scores(query_embeddings)
+        if doc_mask is not None:
+            scores = np.where(doc_mask[None, :], scores, -np.inf)
+        rows, top_scores = top_k_rows(scores, rescore_k if rescore else top_k)
+
+        result = list()
+        for query_embedding, row_rows, row_scores in zip(query_embeddings, rows, top_scores):
+            keep = np.isfinite(row_scores)
+            row_rows, row_scores = row_rows[keep], row_scores[keep]
+            if rescore and len(row_rows) != 0:
+                order = np.argsort(row_rows)
+                candidates = row_rows[order]
+                candidate_scores = self.get_embeddings(candidates) @ query_embedding
+                top = np.argsort(-candidate_scores, kind="stable")[:top_k]
+                row_rows, row_scores = candidates[top], candidate_scores[top]
+            result.append((row_rows, row_scores.astype(np.float32)))
+        return result
+
+    def search(self,
+               query_embedding: np.ndarray,
+               top_k: int,
+               doc_mask: Optional[np.ndarray] = None,
+               rescore_k: Optional[int] = None,
+               ) -> Tuple[np.ndarray, np.ndarray]:
+        return self.batch_search(query_embedding, top_k=top_k, doc_mask=doc_mask, rescore_k=rescore_k)[0]
+
+
+def demo1():
+    import tempfile
+    import time
+
+    from toolbox.retrieval.dense import DenseIndex
+
+    rng = np.random.default_rng(0)
+    num_docs, dim = 50000, 384
+    embeddings = rng.standard_normal(size=(num_docs, dim)).astype(np.float32)
+    queries = embeddings[:100] + 0.5 * rng.standard_normal(size=(100, dim)).astype(np.float32)
+    ids = [str(i) for i in range(num_docs)]
+
+    dense_index = DenseIndex().build(embeddings)
+    expected = [set(doc_ids.tolist()) for doc_ids, _ in dense_index.batch_search(queries, top_k=10)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        directory = os.path.join(directory, "store")
+        Int8EmbeddingStore.from_embeddings(ids, embeddings, keep_float=True).save(directory)
+
+        begin = time.time()
+        store = Int8EmbeddingStore.load(directory)
+        print("load: {:.4f}s".format(time.time() - begin))
+        print("int8 bytes: {}, float32 bytes: {}".format(store.codes.nbytes, dense_index.embeddings.nbytes))
+
+        for rescore_k in [10, 40]:
+            begin = time.time()
+            result = store.batch_search(queries, top_k=10, rescore_k=rescore_k)
+            cost = time.time() - begin
+            recall = np.mean([len(set(rows.tolist()) & e) / 10 for (rows, _), e in zip(result, expected)])
+            print("rescore_k: {}, recall@10: {:.4f}, cost: {:.4f}s".format(rescore_k, recall, cost))
+    return
+
+
+if __name__ == '__main__':
+    demo1()
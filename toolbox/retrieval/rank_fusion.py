@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+from typing import Dict, Hashable, List, Optional, Tuple
+
+
+def reciprocal_rank_fusion(rankings: List[List[Hashable]],
+                           k: int = 60,
+                           weights: Optional[List[float]] = None,
+                           top_k: Optional[int] = None,
+                           ) -> List[Tuple[Hashable, float]]:
+    """
+    Reciprocal Rank Fusion (Cormack et al., 2009).
+    score(d) = sum_i weights[i] / (k + rank_i(d)), rank 从 1 开始. 不依赖各路检索得分的尺度.
+
+    :param rankings: 多路检索结果, 每路为按相关性降序的 key 列表.
+    :param k: 平滑常数, 越大则排名靠后的结果权重衰减越慢.
+    :param weights: 各路的权重, 默认均为 1.
+    :param top_k: 返回数量, None 表示全部.
+    :return: [(key, score), ...], 按得分降序. 得分相同时, 先出现的 key 在前.
+    """
+    if weights is None:
+        weights = [1.0] * len(rankings)
+    if len(weights) != len(rankings):
+        raise AssertionError("weights and rankings length mismatch: {} != {}".format(len(weights), len(rankings)))
+
+    scores: Dict[Hashable, float] = defaultdict(float)
+    for ranking, weight in zip(rankings, weights):
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] += weight / (k + rank)
+
+    result = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    if top_k is not None:
+        result = result[:top_k]
+    return result
+
+
+def demo1():
+    sparse = ["a", "b", "c", "d"]
+    dense = ["c", "a", "e"]
+    print(reciprocal_rank_fusion([sparse, dense], top_k=3))
+    return
+
+
+if __name__ == '__main__':
+    demo1()
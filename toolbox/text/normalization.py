@@ -0,0 +1,29 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import unicodedata
+
+
+def normalize_text(text: str) -> str:
+    """
+    文本归一化, 用于精确匹配与缓存的 key.
+    (1)NFKC, 全角转半角.
+    (2)转小写.
+    (3)去除标点符号, 空白符与控制字符.
+    """
+    text = unicodedata.normalize("NFKC", str(text))
+    text = text.lower()
+    text = "".join([
+        c for c in text
+        if not unicodedata.category(c)[0] in ("P", "Z", "C") and not c.isspace()
+    ])
+    return text
+
+
+def demo1():
+    for text in ["Facebook 注册官网是多少？", "ＦＡＣＥＢＯＯＫ注册官网是多少?", " facebook注册官网，是多少 "]:
+        print(normalize_text(text))
+    return
+
+
+if __name__ == '__main__':
+    demo1()